@@ -0,0 +1,147 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the implementations of the convolution aggregation.
+
+For random graphs of every size, it times the forward and backward pass of --iterations message-passing iterations
+of a convolution (gathering the messages from the source states) with:
+    - segment_sum: gather plus segment sum, with the normalization computed once per forward pass,
+    - sparse: sparse-dense matrix product, with the normalization computed once per forward pass,
+    - uncached: gather plus segment sum, recomputing the normalization in every iteration.
+
+Usage:
+    python benchmarks/conv_aggregation.py --sizes 1000:10000 10000:100000 100000:1000000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ignnition.aggregation_classes import Conv_aggr
+
+
+def create_step(variant, src_idx, dst_idx, num_nodes, iterations, kernel):
+    """
+    Returns a compiled function computing the gradients of the message-passing iterations with the given variant.
+
+    Parameters
+    ----------
+    variant:    str
+        Name of the variant (segment_sum, sparse or uncached)
+    src_idx:    tensor
+        Source indexes of the edges
+    dst_idx:    tensor
+        Destination indexes of the edges
+    num_nodes:    tensor
+        Number of nodes of the graph
+    iterations:    int
+        Number of message-passing iterations
+    kernel:    tf.Variable
+        Kernel of the convolution
+    """
+
+    implementation = 'sparse' if variant == 'sparse' else 'segment_sum'
+    aggr = Conv_aggr({'type': 'convolution', 'normalization': 'symmetric', 'implementation': implementation})
+
+    @tf.function
+    def step(states):
+        with tf.GradientTape() as tape:
+            normalization = aggr.get_normalization([(src_idx, num_nodes)], dst_idx, num_nodes)
+            for _ in range(iterations):
+                if variant == 'uncached':
+                    normalization = aggr.get_normalization([(src_idx, num_nodes)], dst_idx, num_nodes)
+                messages = tf.gather(states, src_idx)
+                states = aggr.calculate_input(messages, dst_idx, states, num_nodes, kernel, normalization)
+            loss = tf.reduce_sum(states)
+        return tape.gradient(loss, kernel)
+
+    return step
+
+
+def run(num_nodes, num_edges, dimension, iterations, repetitions, seed):
+    """
+    Parameters
+    ----------
+    num_nodes:    int
+        Number of nodes of the random graph
+    num_edges:    int
+        Number of (directed) edges of the random graph
+    dimension:    int
+        Dimension of the hidden states
+    iterations:    int
+        Number of message-passing iterations
+    repetitions:    int
+        Number of timed repetitions (after one warm-up repetition)
+    seed:    int
+        Seed of the random graph
+    """
+
+    rng = np.random.default_rng(seed)
+    src_idx = tf.constant(rng.integers(0, num_nodes, num_edges), dtype=tf.int64)
+    dst_idx = tf.constant(rng.integers(0, num_nodes, num_edges), dtype=tf.int64)
+    states = tf.constant(rng.normal(size=(num_nodes, dimension)), dtype=tf.float32)
+    kernel = tf.Variable(rng.normal(size=(dimension, dimension)) / np.sqrt(dimension), dtype=tf.float32)
+    num_nodes_tensor = tf.constant(num_nodes, dtype=tf.int64)
+
+    result = {'nodes': num_nodes, 'edges': num_edges}
+    for variant in ['segment_sum', 'sparse', 'uncached']:
+        step = create_step(variant, src_idx, dst_idx, num_nodes_tensor, iterations, kernel)
+        step(states).numpy()
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            step(states).numpy()
+        result[variant + '_ms'] = 1000 * (time.perf_counter() - start) / repetitions
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the implementations of the convolution aggregation.')
+    parser.add_argument('--sizes', nargs='+', default=['1000:10000', '10000:100000', '100000:1000000'],
+                        help='Sizes of the random graphs, as nodes:edges')
+    parser.add_argument('--dimension', type=int, default=32, help='Dimension of the hidden states')
+    parser.add_argument('--iterations', type=int, default=8, help='Number of message-passing iterations')
+    parser.add_argument('--repetitions', type=int, default=10, help='Number of timed repetitions')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random graphs')
+    parser.add_argument('--output', default=None, help='Path of the json file where the results are written')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        num_nodes, num_edges = [int(s) for s in size.split(':')]
+        result = run(num_nodes, num_edges, args.dimension, args.iterations, args.repetitions, args.seed)
+        results.append(result)
+        print('nodes: {nodes}  edges: {edges}  segment_sum: {segment_sum_ms:.2f} ms  sparse: {sparse_ms:.2f} ms  '
+              'uncached: {uncached_ms:.2f} ms'.format(**result))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
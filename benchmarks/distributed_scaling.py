@@ -0,0 +1,198 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+"""
+Scaling benchmark of the multi-worker data-parallel training.
+
+For every number of workers from 1 to --max_workers, it launches that many local processes (each of them being one
+worker of a MultiWorkerMirroredStrategy cluster defined by TF_CONFIG), trains the model of --model_dir for
+--steps steps after --warmup_steps steps of warm-up, and reports the training steps per second.
+
+Usage:
+    python benchmarks/distributed_scaling.py --model_dir examples/Shortest_Path --max_workers 4
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def create_benchmark_dir(model_dir, output_dir):
+    """
+    Copies the yaml files of the model to a new directory, with the absolute paths of the original model and the
+    multi-worker strategy enabled.
+
+    Parameters
+    ----------
+    model_dir:    str
+        Path of the model directory to be benchmarked
+    output_dir:    str
+        Path of the new model directory
+    """
+
+    model_dir = os.path.abspath(model_dir)
+    for file in os.listdir(model_dir):
+        if file.endswith('.yaml'):
+            shutil.copy(os.path.join(model_dir, file), output_dir)
+
+    with open(os.path.join(model_dir, 'train_options.yaml')) as stream:
+        config = yaml.safe_load(stream)
+
+    for key in ['train_dataset', 'validation_dataset', 'additional_functions_file']:
+        if key in config:
+            config[key] = os.path.normpath(os.path.join(model_dir, config[key]))
+    config['output_path'] = output_dir
+    config['distribution_strategy'] = 'multi_worker'
+
+    with open(os.path.join(output_dir, 'train_options.yaml'), 'w') as stream:
+        yaml.safe_dump(config, stream)
+
+
+def run_worker(model_dir, steps, warmup_steps, result_file):
+    """
+    Trains the model as one of the workers of the cluster defined in TF_CONFIG, and writes the elapsed time.
+
+    Parameters
+    ----------
+    model_dir:    str
+        Path of the model directory
+    steps:    int
+        Number of timed training steps
+    warmup_steps:    int
+        Number of training steps before the timing starts (tracing, pipeline warm-up)
+    result_file:    str
+        Path of the json file where the result of this worker is written
+    """
+
+    import tensorflow as tf
+    import ignnition
+
+    model = ignnition.create_model(model_dir)
+    model.build_gnn(verbose=False)
+    dataset = model.get_dataset(distribute=True)
+
+    times = {}
+
+    class Epoch_timer(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            times[epoch] = time.time()
+
+        def on_epoch_end(self, epoch, logs=None):
+            times[epoch] = time.time() - times[epoch]
+
+    # the first epoch is the warm-up and the second one is timed
+    model.gnn_model.fit(dataset, epochs=1, steps_per_epoch=warmup_steps, callbacks=[Epoch_timer()], verbose=0)
+    model.gnn_model.fit(dataset, initial_epoch=1, epochs=2, steps_per_epoch=steps, callbacks=[Epoch_timer()],
+                        verbose=0)
+
+    with open(result_file, 'w') as f:
+        json.dump({'elapsed': times[1], 'steps': steps}, f)
+
+
+def run_cluster(model_dir, num_workers, steps, warmup_steps):
+    """
+    Parameters
+    ----------
+    model_dir:    str
+        Path of the benchmark model directory
+    num_workers:    int
+        Number of local worker processes
+    steps:    int
+        Number of timed training steps
+    warmup_steps:    int
+        Number of training steps before the timing starts
+    """
+
+    workers = ['localhost:' + str(get_free_port()) for _ in range(num_workers)]
+    result_files = [os.path.join(model_dir, 'worker_' + str(i) + '.json') for i in range(num_workers)]
+
+    processes = []
+    for i in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': i}})
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker',
+                                           '--model_dir', model_dir, '--steps', str(steps),
+                                           '--warmup_steps', str(warmup_steps), '--result_file', result_files[i]],
+                                          env=env, stdout=subprocess.DEVNULL))
+
+    for p in processes:
+        if p.wait() != 0:
+            raise RuntimeError('One of the workers failed (exit code ' + str(p.returncode) + ')')
+
+    # the steps are synchronous, so the slowest worker determines the throughput of the cluster
+    elapsed = max(json.load(open(f))['elapsed'] for f in result_files)
+    return {'workers': num_workers,
+            'elapsed': elapsed,
+            'steps_per_sec': steps / elapsed,
+            'samples_per_sec': steps * num_workers / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmark of the multi-worker data-parallel training.')
+    parser.add_argument('--model_dir', required=True, help='Model directory (with its train_options.yaml)')
+    parser.add_argument('--max_workers', type=int, default=4, help='Maximum number of local workers')
+    parser.add_argument('--steps', type=int, default=100, help='Number of timed training steps')
+    parser.add_argument('--warmup_steps', type=int, default=10, help='Number of warm-up training steps')
+    parser.add_argument('--output', default=None, help='Path of the json file where the results are written')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.model_dir, args.steps, args.warmup_steps, args.result_file)
+        return
+
+    results = []
+    for num_workers in range(1, args.max_workers + 1):
+        benchmark_dir = tempfile.mkdtemp()
+        try:
+            create_benchmark_dir(args.model_dir, benchmark_dir)
+            result = run_cluster(benchmark_dir, num_workers, args.steps, args.warmup_steps)
+        finally:
+            shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+        result['speedup'] = result['samples_per_sec'] / results[0]['samples_per_sec'] if results else 1.0
+        results.append(result)
+        print('workers: {workers}  steps/sec: {steps_per_sec:.2f}  samples/sec: {samples_per_sec:.2f}  '
+              'speedup: {speedup:.2f}'.format(**result))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the computation of the first dense layer before gathering the node states (gather_after_transform option).
+
+For random graphs with many more edges than nodes, it measures:
+    - the forward and backward time of a message neural network over [source, destination], computed per edge
+      (gather, concatenate and transform) or factorized (transform per node and gather), together with the number of
+      floating-point operations of its first layer,
+    - the training time per step and the peak resident memory of the Shortest_Path (message neural network) and
+      Graph_query_networks (edge attention) examples with gather_after_transform enabled and disabled, each one in a
+      separate process.
+
+Usage:
+    python benchmarks/gather_after_transform.py --sizes 1000:50000 10000:500000 --models Shortest_Path
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_benchmarks import create_benchmark_dir
+
+# example models whose networks are factorized
+MODELS = ['Shortest_Path', 'Graph_query_networks']
+
+
+def create_step(variant, operation, model, src_idx, dst_idx):
+    """
+    Returns a compiled function computing the gradients of the message neural network with the given variant.
+
+    Parameters
+    ----------
+    variant:    str
+        Name of the variant (per_edge or factorized)
+    operation:    Feed_forward_operation
+        Operation of the message neural network
+    model:    tf.keras.Model
+        Message neural network
+    src_idx:    tensor
+        Source indexes of the edges
+    dst_idx:    tensor
+        Destination indexes of the edges
+    """
+
+    import tensorflow as tf
+
+    @tf.function
+    def step(states):
+        with tf.GradientTape() as tape:
+            tape.watch(states)
+            if variant == 'factorized':
+                messages = operation.apply_nn_factorized(model, [(states, src_idx), (states, dst_idx)])
+            else:
+                messages = model(tf.concat([tf.gather(states, src_idx), tf.gather(states, dst_idx)], axis=1))
+            loss = tf.reduce_sum(messages)
+        # the gradient of the gathered states is sparse (IndexedSlices), and it is densified as in the optimizers
+        return [tf.convert_to_tensor(g) for g in tape.gradient(loss, [states] + model.trainable_variables)]
+
+    return step
+
+
+def run_layer(num_nodes, num_edges, dimension, units, repetitions, seed):
+    """
+    Parameters
+    ----------
+    num_nodes:    int
+        Number of nodes of the random graph
+    num_edges:    int
+        Number of (directed) edges of the random graph
+    dimension:    int
+        Dimension of the hidden states
+    units:    int
+        Number of units of the layers of the message neural network
+    repetitions:    int
+        Number of timed repetitions (after one warm-up repetition)
+    seed:    int
+        Seed of the random graph
+    """
+
+    import tensorflow as tf
+    from ignnition.operation_classes import Feed_forward_operation
+
+    rng = np.random.default_rng(seed)
+    src_idx = tf.constant(rng.integers(0, num_nodes, num_edges), dtype=tf.int64)
+    dst_idx = tf.constant(rng.integers(0, num_nodes, num_edges), dtype=tf.int64)
+    states = tf.constant(rng.normal(size=(num_nodes, dimension)), dtype=tf.float32)
+
+    operation = Feed_forward_operation({'type': 'neural_network', 'input': ['source', 'destination'],
+                                        'architecture': [{'type_layer': 'Dense', 'units': units, 'activation': 'relu'},
+                                                         {'type_layer': 'Dense', 'units': units}]},
+                                       model_role='message_creation')
+    model, _ = operation.model.construct_tf_model('message_function', 2 * dimension)
+
+    # multiply-adds of the first layer (the factorized one also adds the two gathered halves of every edge)
+    result = {'nodes': num_nodes, 'edges': num_edges,
+              'per_edge_mflops': 2 * num_edges * 2 * dimension * units / 1e6,
+              'factorized_mflops': (2 * num_nodes * 2 * dimension * units + num_edges * units) / 1e6}
+    for variant in ['per_edge', 'factorized']:
+        step = create_step(variant, operation, model, src_idx, dst_idx)
+        step(states)
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            [g.numpy() for g in step(states)]
+        result[variant + '_ms'] = 1000 * (time.perf_counter() - start) / repetitions
+    return result
+
+
+def run_benchmark(model_dir, steps, warmup_steps, result_file):
+    """
+    Trains the model of the benchmark directory, and writes the time per step and the peak memory.
+
+    Parameters
+    ----------
+    model_dir:    str
+        Path of the benchmark model directory
+    steps:    int
+        Number of timed training steps
+    warmup_steps:    int
+        Number of training steps before the timing starts (tracing, pipeline warm-up)
+    result_file:    str
+        Path of the json file where the results are written
+    """
+
+    import ignnition
+
+    model = ignnition.create_model(model_dir)
+    model.build_gnn(verbose=False)
+    ds = model.get_dataset()
+
+    model.gnn_model.fit(ds, epochs=1, steps_per_epoch=warmup_steps, verbose=0)
+    start = time.perf_counter()
+    model.gnn_model.fit(ds, epochs=1, steps_per_epoch=steps, verbose=0)
+    elapsed = time.perf_counter() - start
+
+    results = {'step_ms': 1000 * elapsed / steps,
+               # maximum resident set size of this process (in kilobytes in linux)
+               'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+    with open(result_file, 'w') as f:
+        json.dump(results, f)
+
+
+def benchmark(model_name, enabled, num_nodes, num_edges, args):
+    """
+    Runs the benchmark of one model, option and size in a new process, so that the peak memory is not shared with the
+    rest of configurations.
+
+    Parameters
+    ----------
+    model_name:    str
+        Name of the example model (one of MODELS)
+    enabled:    bool
+        Value of the gather_after_transform option
+    num_nodes:    int
+        Number of nodes of the topology of each sample
+    num_edges:    int
+        Number of (undirected) edges of the topology of each sample
+    args:    argparse.Namespace
+        Arguments of the benchmark
+    """
+
+    benchmark_dir = tempfile.mkdtemp()
+    try:
+        create_benchmark_dir(model_name, benchmark_dir, args.num_samples, num_nodes, num_edges, args.seed,
+                             config_options={'gather_after_transform': enabled})
+        result_file = os.path.join(benchmark_dir, 'result.json')
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker',
+                                  '--model_dir', benchmark_dir, '--steps', str(args.steps),
+                                  '--warmup_steps', str(args.warmup_steps), '--result_file', result_file],
+                                 stdout=subprocess.DEVNULL)
+        if process.returncode != 0:
+            raise RuntimeError('The benchmark of ' + model_name + ' with gather_after_transform=' + str(enabled) +
+                               ' failed (exit code ' + str(process.returncode) + ')')
+
+        with open(result_file) as f:
+            result = json.load(f)
+    finally:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    return dict({'model': model_name, 'gather_after_transform': enabled, 'nodes': num_nodes, 'edges': num_edges},
+                **result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the gather-after-transform factorization.')
+    parser.add_argument('--sizes', nargs='+', default=['1000:50000', '10000:500000'],
+                        help='Sizes of the random graphs, as nodes:edges')
+    parser.add_argument('--dimension', type=int, default=32, help='Dimension of the hidden states (layer benchmark)')
+    parser.add_argument('--units', type=int, default=64, help='Units of the message neural network (layer benchmark)')
+    parser.add_argument('--repetitions', type=int, default=10, help='Number of timed repetitions (layer benchmark)')
+    parser.add_argument('--models', nargs='*', default=[], choices=MODELS,
+                        help='Example models trained with and without the factorization (none by default)')
+    parser.add_argument('--num_samples', type=int, default=4, help='Number of samples of each synthetic dataset')
+    parser.add_argument('--steps', type=int, default=10, help='Number of timed training steps')
+    parser.add_argument('--warmup_steps', type=int, default=2, help='Number of warm-up training steps')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random graphs')
+    parser.add_argument('--output', default=None, help='Path of the json file where the results are written')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--model_dir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_benchmark(args.model_dir, args.steps, args.warmup_steps, args.result_file)
+        return
+
+    results = {'layer': [], 'models': []}
+    for size in args.sizes:
+        num_nodes, num_edges = [int(s) for s in size.split(':')]
+        result = run_layer(num_nodes, num_edges, args.dimension, args.units, args.repetitions, args.seed)
+        results['layer'].append(result)
+        print('nodes: {nodes}  edges: {edges}  per_edge: {per_edge_ms:.2f} ms ({per_edge_mflops:.0f} MFLOP)  '
+              'factorized: {factorized_ms:.2f} ms ({factorized_mflops:.0f} MFLOP)'.format(**result))
+
+        for model_name in args.models:
+            for enabled in [False, True]:
+                result = benchmark(model_name, enabled, num_nodes, num_edges, args)
+                results['models'].append(result)
+                print('model: {model}  nodes: {nodes}  edges: {edges}  gather_after_transform: '
+                      '{gather_after_transform}  step: {step_ms:.2f} ms  peak memory: {peak_memory_mb:.0f} MB'
+                      .format(**result))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
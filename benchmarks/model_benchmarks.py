@@ -0,0 +1,256 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the example models over synthetic datasets of increasing graph size.
+
+For every example model and every size (number of nodes and edges of the topology), it generates a synthetic dataset
+(see synthetic_datasets.py) and measures, in a separate process:
+    - the throughput of the input pipeline (samples/sec through the generator and the normalization),
+    - the training throughput (steps/sec of fit, after --warmup_steps steps of warm-up),
+    - the inference latency of one sample (mean and percentiles once traced, and mean including the tracing),
+    - the peak resident memory of the process.
+
+The Q-size example is not included, since it requires its external dataset (and its interleave definition).
+
+Usage:
+    python benchmarks/model_benchmarks.py --sizes 10:30 50:150 200:600 --output results.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_datasets import GENERATORS, generate_dataset
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+
+def create_benchmark_dir(model_name, output_dir, num_samples, num_nodes, num_edges, seed, config_options=None,
+                         **sample_options):
+    """
+    Copies the yaml files of the example model to a new directory, and generates its synthetic training dataset.
+
+    Parameters
+    ----------
+    model_name:    str
+        Name of the example model
+    output_dir:    str
+        Path of the new model directory
+    num_samples:    int
+        Number of samples of the synthetic dataset
+    num_nodes:    int
+        Number of nodes of the topology of each sample
+    num_edges:    int
+        Number of (undirected) edges of the topology of each sample
+    seed:    int
+        Seed of the synthetic dataset
+    config_options:    dict
+        Additional options of the train_options.yaml file of the model
+    sample_options:    dict
+        Additional arguments of the generator of the samples
+    """
+
+    model_dir = os.path.join(EXAMPLES_DIR, model_name)
+    for file in os.listdir(model_dir):
+        if file.endswith('.yaml'):
+            shutil.copy(os.path.join(model_dir, file), output_dir)
+
+    with open(os.path.join(model_dir, 'train_options.yaml')) as stream:
+        config = yaml.safe_load(stream)
+
+    train_path = os.path.join(output_dir, 'data', 'train')
+    generate_dataset(os.path.join(train_path, 'data.json'), model_name, num_samples, num_nodes, num_edges, seed,
+                     **sample_options)
+
+    config['train_dataset'] = train_path
+    config['validation_dataset'] = train_path
+    config['additional_functions_file'] = os.path.join(model_dir, 'main.py')
+    config['output_path'] = output_dir
+    config['tensorboard'] = {'enabled': False}
+    config.update(config_options or {})
+
+    with open(os.path.join(output_dir, 'train_options.yaml'), 'w') as stream:
+        yaml.safe_dump(config, stream)
+
+
+def run_benchmark(model_dir, steps, warmup_steps, inference_samples, result_file):
+    """
+    Measures the model of the benchmark directory, and writes the results.
+
+    Parameters
+    ----------
+    model_dir:    str
+        Path of the benchmark model directory
+    steps:    int
+        Number of timed training steps
+    warmup_steps:    int
+        Number of training steps before the timing starts (tracing, pipeline warm-up)
+    inference_samples:    int
+        Number of samples whose inference latency is measured
+    result_file:    str
+        Path of the json file where the results are written
+    """
+
+    import tensorflow as tf
+    import ignnition
+
+    model = ignnition.create_model(model_dir)
+    model.build_gnn(verbose=False)
+
+    # input pipeline: one full pass over the dataset (the first sample includes the creation of the pipeline)
+    ds = iter(model.get_dataset(repeat=False))
+    next(ds)
+    num_samples = 0
+    start = time.perf_counter()
+    for _ in ds:
+        num_samples += 1
+    input_elapsed = time.perf_counter() - start
+
+    # training: the first epoch is the warm-up and the second one is timed
+    times = {}
+
+    class Epoch_timer(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            times[epoch] = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            times[epoch] = time.perf_counter() - times[epoch]
+
+    ds = model.get_dataset()
+    model.gnn_model.fit(ds, epochs=1, steps_per_epoch=warmup_steps, callbacks=[Epoch_timer()], verbose=0)
+    model.gnn_model.fit(ds, initial_epoch=1, epochs=2, steps_per_epoch=steps, callbacks=[Epoch_timer()], verbose=0)
+
+    # inference: latency of the forward pass of each (already processed) sample. The first pass includes the
+    # tracing of the model for each new shape of the inputs, so that the latency is measured in a second pass
+    ds = model.get_dataset(training=False, iterator=True)
+    samples = [next(ds) for _ in range(inference_samples)]
+    latencies = []
+    for _ in range(2):
+        latencies.append([])
+        for features in samples:
+            start = time.perf_counter()
+            _ = model.gnn_model(features, training=False).numpy()
+            latencies[-1].append(1000 * (time.perf_counter() - start))
+    cold_latencies, latencies = np.array(latencies[0]), np.array(latencies[1])
+
+    results = {'input_samples_per_sec': num_samples / input_elapsed,
+               'train_steps_per_sec': steps / times[1],
+               'inference_latency_ms': {'mean': float(np.mean(latencies)),
+                                        'p50': float(np.percentile(latencies, 50)),
+                                        'p90': float(np.percentile(latencies, 90)),
+                                        'p99': float(np.percentile(latencies, 99))},
+               'inference_cold_latency_ms': float(np.mean(cold_latencies)),
+               # maximum resident set size of this process (in kilobytes in linux)
+               'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+    with open(result_file, 'w') as f:
+        json.dump(results, f)
+
+
+def benchmark(model_name, num_nodes, num_edges, args):
+    """
+    Runs the benchmark of one model and size in a new process, so that the peak memory is not shared with the rest of
+    configurations.
+
+    Parameters
+    ----------
+    model_name:    str
+        Name of the example model
+    num_nodes:    int
+        Number of nodes of the topology of each sample
+    num_edges:    int
+        Number of (undirected) edges of the topology of each sample
+    args:    argparse.Namespace
+        Arguments of the benchmark
+    """
+
+    benchmark_dir = tempfile.mkdtemp()
+    try:
+        create_benchmark_dir(model_name, benchmark_dir, args.num_samples, num_nodes, num_edges, args.seed)
+        result_file = os.path.join(benchmark_dir, 'result.json')
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker',
+                                  '--model_dir', benchmark_dir, '--steps', str(args.steps),
+                                  '--warmup_steps', str(args.warmup_steps),
+                                  '--inference_samples', str(args.inference_samples),
+                                  '--result_file', result_file],
+                                 stdout=subprocess.DEVNULL)
+        if process.returncode != 0:
+            raise RuntimeError('The benchmark of ' + model_name + ' failed (exit code ' +
+                               str(process.returncode) + ')')
+
+        with open(result_file) as f:
+            result = json.load(f)
+    finally:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    return dict({'model': model_name, 'nodes': num_nodes, 'edges': num_edges}, **result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the example models over synthetic datasets.')
+    parser.add_argument('--models', nargs='+', default=sorted(GENERATORS), choices=sorted(GENERATORS),
+                        help='Example models to be benchmarked')
+    parser.add_argument('--sizes', nargs='+', default=['10:30', '50:150', '200:600'],
+                        help='Sizes of the topologies, as nodes:edges')
+    parser.add_argument('--num_samples', type=int, default=50, help='Number of samples of each synthetic dataset')
+    parser.add_argument('--steps', type=int, default=50, help='Number of timed training steps')
+    parser.add_argument('--warmup_steps', type=int, default=5, help='Number of warm-up training steps')
+    parser.add_argument('--inference_samples', type=int, default=20,
+                        help='Number of samples whose inference latency is measured')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic datasets')
+    parser.add_argument('--output', default=None, help='Path of the json file where the results are written')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--model_dir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_benchmark(args.model_dir, args.steps, args.warmup_steps, args.inference_samples, args.result_file)
+        return
+
+    results = []
+    for model_name in args.models:
+        for size in args.sizes:
+            num_nodes, num_edges = [int(s) for s in size.split(':')]
+            result = benchmark(model_name, num_nodes, num_edges, args)
+            results.append(result)
+            print('{model}  nodes: {nodes}  edges: {edges}  input samples/sec: {input_samples_per_sec:.2f}  '
+                  'train steps/sec: {train_steps_per_sec:.2f}  inference p50: {p50:.2f} ms  '
+                  'peak memory: {peak_memory_mb:.0f} MB'.format(p50=result['inference_latency_ms']['p50'], **result))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
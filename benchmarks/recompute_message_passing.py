@@ -0,0 +1,164 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the recomputation of the message passing in the backward pass (recompute_message_passing option).
+
+For large synthetic Routenet topologies (links and paths, where every path is connected to the links it crosses), it
+trains the Routenet example (8 message-passing iterations) with every recompute_message_passing option, each one in a
+separate process, and measures:
+    - the training time per step (after --warmup_steps steps of warm-up),
+    - the peak resident memory of the process.
+
+Usage:
+    python benchmarks/recompute_message_passing.py --sizes 1000:3000:20000 --output results.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_benchmarks import create_benchmark_dir
+
+# values of the recompute_message_passing option (none to keep all the intermediate tensors)
+MODES = ['none', 'iteration', 'stage']
+
+
+def run_benchmark(model_dir, steps, warmup_steps, result_file):
+    """
+    Trains the model of the benchmark directory, and writes the time per step and the peak memory.
+
+    Parameters
+    ----------
+    model_dir:    str
+        Path of the benchmark model directory
+    steps:    int
+        Number of timed training steps
+    warmup_steps:    int
+        Number of training steps before the timing starts (tracing, pipeline warm-up)
+    result_file:    str
+        Path of the json file where the results are written
+    """
+
+    import ignnition
+
+    model = ignnition.create_model(model_dir)
+    model.build_gnn(verbose=False)
+    ds = model.get_dataset()
+
+    model.gnn_model.fit(ds, epochs=1, steps_per_epoch=warmup_steps, verbose=0)
+    start = time.perf_counter()
+    model.gnn_model.fit(ds, epochs=1, steps_per_epoch=steps, verbose=0)
+    elapsed = time.perf_counter() - start
+
+    results = {'step_ms': 1000 * elapsed / steps,
+               # maximum resident set size of this process (in kilobytes in linux)
+               'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+    with open(result_file, 'w') as f:
+        json.dump(results, f)
+
+
+def benchmark(mode, num_nodes, num_edges, num_paths, args):
+    """
+    Runs the benchmark of one option and size in a new process, so that the peak memory is not shared with the rest of
+    configurations.
+
+    Parameters
+    ----------
+    mode:    str
+        Value of the recompute_message_passing option (one of MODES)
+    num_nodes:    int
+        Number of nodes (routers) of the topology of each sample
+    num_edges:    int
+        Number of (undirected) edges of the topology of each sample
+    num_paths:    int
+        Number of paths of each sample
+    args:    argparse.Namespace
+        Arguments of the benchmark
+    """
+
+    benchmark_dir = tempfile.mkdtemp()
+    try:
+        config_options = {'recompute_message_passing': None if mode == 'none' else mode}
+        create_benchmark_dir('Routenet', benchmark_dir, args.num_samples, num_nodes, num_edges, args.seed,
+                             config_options=config_options, num_paths=num_paths)
+        result_file = os.path.join(benchmark_dir, 'result.json')
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker',
+                                  '--model_dir', benchmark_dir, '--steps', str(args.steps),
+                                  '--warmup_steps', str(args.warmup_steps), '--result_file', result_file],
+                                 stdout=subprocess.DEVNULL)
+        if process.returncode != 0:
+            raise RuntimeError('The benchmark with recompute_message_passing=' + mode + ' failed (exit code ' +
+                               str(process.returncode) + ')')
+
+        with open(result_file) as f:
+            result = json.load(f)
+    finally:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    return dict({'recompute_message_passing': mode, 'nodes': num_nodes, 'edges': num_edges, 'paths': num_paths},
+                **result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the recomputation of the message passing.')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES,
+                        help='Values of the recompute_message_passing option')
+    parser.add_argument('--sizes', nargs='+', default=['200:600:2000', '1000:3000:20000'],
+                        help='Sizes of the topologies, as nodes:edges:paths')
+    parser.add_argument('--num_samples', type=int, default=4, help='Number of samples of each synthetic dataset')
+    parser.add_argument('--steps', type=int, default=10, help='Number of timed training steps')
+    parser.add_argument('--warmup_steps', type=int, default=2, help='Number of warm-up training steps')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic datasets')
+    parser.add_argument('--output', default=None, help='Path of the json file where the results are written')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--model_dir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_benchmark(args.model_dir, args.steps, args.warmup_steps, args.result_file)
+        return
+
+    results = []
+    for size in args.sizes:
+        num_nodes, num_edges, num_paths = [int(s) for s in size.split(':')]
+        for mode in args.modes:
+            result = benchmark(mode, num_nodes, num_edges, num_paths, args)
+            results.append(result)
+            print('nodes: {nodes}  edges: {edges}  paths: {paths}  recompute: {recompute_message_passing}  '
+                  'step: {step_ms:.2f} ms  peak memory: {peak_memory_mb:.0f} MB'.format(**result))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
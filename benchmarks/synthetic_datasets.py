@@ -0,0 +1,215 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+"""
+Generators of synthetic datasets for the example models, following the same format (networkx node-link json) as
+examples/Shortest_Path/data_generator.py, but with an exact number of nodes and edges so that the benchmarks can
+sweep the size of the graphs. All the generators are deterministic given the seed.
+"""
+
+import json
+import os
+import random
+
+import networkx as nx
+from networkx.readwrite import json_graph
+
+
+def random_connected_graph(num_nodes, num_edges, rng):
+    """
+    Returns an undirected connected graph with exactly num_nodes nodes and num_edges edges (at least a spanning tree,
+    and at most the complete graph).
+
+    Parameters
+    ----------
+    num_nodes:    int
+        Number of nodes of the graph
+    num_edges:    int
+        Number of (undirected) edges of the graph
+    rng:    random.Random
+        Random number generator
+    """
+
+    num_edges = min(max(num_edges, num_nodes - 1), num_nodes * (num_nodes - 1) // 2)
+    G = nx.Graph()
+    G.add_nodes_from(range(num_nodes))
+
+    # random spanning tree, so that every pair of nodes is connected
+    order = list(range(num_nodes))
+    rng.shuffle(order)
+    for i in range(1, num_nodes):
+        G.add_edge(order[i], order[rng.randrange(i)])
+
+    while G.number_of_edges() < num_edges:
+        u, v = rng.sample(range(num_nodes), 2)
+        G.add_edge(u, v)
+    return G
+
+
+def shortest_path_sample(num_nodes, num_edges, rng, min_edge_weight=1, max_edge_weight=10):
+    """
+    Sample of the Shortest_Path example: the label of each node indicates if it belongs to the shortest path between
+    the two nodes marked with src-tgt.
+
+    Parameters
+    ----------
+    num_nodes:    int
+        Number of nodes of the graph
+    num_edges:    int
+        Number of (undirected) edges of the graph
+    rng:    random.Random
+        Random number generator
+    min_edge_weight:    int
+        Minimum weight of the edges
+    max_edge_weight:    int
+        Maximum weight of the edges
+    """
+
+    G = random_connected_graph(num_nodes, num_edges, rng)
+    nx.set_node_attributes(G, 0, 'src-tgt')
+    nx.set_node_attributes(G, 0, 'sp')
+    nx.set_node_attributes(G, 'node', 'entity')
+    for (u, v, w) in G.edges(data=True):
+        w['weight'] = rng.randint(min_edge_weight, max_edge_weight)
+
+    src, tgt = rng.sample(list(G.nodes), 2)
+    G.nodes[src]['src-tgt'] = 1
+    G.nodes[tgt]['src-tgt'] = 1
+    for node in nx.shortest_path(G, source=src, target=tgt, weight='weight'):
+        G.nodes[node]['sp'] = 1
+
+    return json_graph.node_link_data(nx.DiGraph(G))
+
+
+def routenet_sample(num_nodes, num_edges, rng, num_paths=None):
+    """
+    Sample of the Routenet example: every directed edge of the topology is a link entity, and every route between two
+    random nodes is a path entity (with its traffic and delay), connected in both directions to the links it crosses.
+
+    Parameters
+    ----------
+    num_nodes:    int
+        Number of nodes (routers) of the topology
+    num_edges:    int
+        Number of (undirected) edges of the topology
+    rng:    random.Random
+        Random number generator
+    num_paths:    int
+        Number of paths (by default, one for each node)
+    """
+
+    topology = random_connected_graph(num_nodes, num_edges, rng)
+    num_paths = num_nodes if num_paths is None else num_paths
+
+    G = nx.DiGraph()
+    for (u, v) in topology.edges():
+        for (a, b) in [(u, v), (v, u)]:
+            G.add_node('l_' + str(a) + '_' + str(b), entity='link', capacity=rng.choice([10000, 40000, 100000]))
+
+    for i in range(num_paths):
+        src, dst = rng.sample(range(num_nodes), 2)
+        path = 'p_' + str(i)
+        route = nx.shortest_path(topology, source=src, target=dst)
+        G.add_node(path, entity='path', traffic=rng.uniform(20, 1000), delay=rng.uniform(0.01, 1.))
+        for (a, b) in zip(route[:-1], route[1:]):
+            link = 'l_' + str(a) + '_' + str(b)
+            G.add_edge(path, link)
+            G.add_edge(link, path)
+
+    return json_graph.node_link_data(G)
+
+
+def graph_query_sample(num_nodes, num_edges, rng, id_dimension=30):
+    """
+    Sample of the Graph_query_networks example: every node of the topology is a router entity and every directed edge
+    is an interface entity. The label of an interface indicates if it belongs to the route from a random router to the
+    target router.
+
+    Parameters
+    ----------
+    num_nodes:    int
+        Number of routers of the topology
+    num_edges:    int
+        Number of (undirected) edges of the topology
+    rng:    random.Random
+        Random number generator
+    id_dimension:    int
+        Dimension of the one-hot identifiers of the routers (which are reused modulo this dimension)
+    """
+
+    def one_hot(i):
+        return [1.0 if j == i % id_dimension else 0.0 for j in range(id_dimension)]
+
+    topology = random_connected_graph(num_nodes, num_edges, rng)
+    src, tgt = rng.sample(range(num_nodes), 2)
+    route = nx.shortest_path(topology, source=src, target=tgt)
+    route_edges = set(zip(route[:-1], route[1:]))
+
+    G = nx.DiGraph(target_router=one_hot(tgt))
+    for node in topology.nodes():
+        G.add_node(str(node), entity='router', router_id=one_hot(node))
+
+    for (u, v) in topology.edges():
+        for (a, b) in [(u, v), (v, u)]:
+            interface = 'int_' + str(a) + '_to_' + str(b)
+            G.add_node(interface, entity='interface', speed=rng.choice([10, 45, 100]),
+                       label=int((a, b) in route_edges))
+            G.add_edge(str(a), interface)
+            G.add_edge(interface, str(a))
+        G.add_edge('int_' + str(u) + '_to_' + str(v), 'int_' + str(v) + '_to_' + str(u))
+        G.add_edge('int_' + str(v) + '_to_' + str(u), 'int_' + str(u) + '_to_' + str(v))
+
+    return json_graph.node_link_data(G)
+
+
+# generator of the samples of each example model
+GENERATORS = {'Shortest_Path': shortest_path_sample,
+              'Routenet': routenet_sample,
+              'Graph_query_networks': graph_query_sample}
+
+
+def generate_dataset(file_name, model_name, num_samples, num_nodes, num_edges, seed=0, **sample_options):
+    """
+    Writes a json file with num_samples synthetic samples of the given example model.
+
+    Parameters
+    ----------
+    file_name:    str
+        Path of the json file
+    model_name:    str
+        Name of the example model (one of GENERATORS)
+    num_samples:    int
+        Number of samples
+    num_nodes:    int
+        Number of nodes of the topology of each sample
+    num_edges:    int
+        Number of (undirected) edges of the topology of each sample
+    seed:    int
+        Seed of the random number generator
+    sample_options:    dict
+        Additional arguments of the generator of the samples (e.g., num_paths of routenet_sample)
+    """
+
+    rng = random.Random(seed)
+    samples = [GENERATORS[model_name](num_nodes, num_edges, rng, **sample_options) for _ in range(num_samples)]
+
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w') as f:
+        json.dump(samples, f)
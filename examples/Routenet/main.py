@@ -22,21 +22,6 @@ import sys
 import tensorflow as tf
 import ignnition
 
-def normalization(feature, feature_name):
-    if feature_name == 'traffic':
-        feature = (feature - 170) / 130
-    elif feature_name == 'capacity':
-        feature = (feature - 25000) / 40000
-    elif feature_name == 'delay':
-        feature = tf.math.log(feature)
-    return feature
-
-def denormalization(feature, feature_name):
-    if feature_name == 'delay':
-        feature = tf.math.exp(feature)
-    return feature
-
-
 def main():
     model = ignnition.create_model(model_dir= './')
     model.computational_graph()
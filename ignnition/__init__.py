@@ -1,4 +1,5 @@
 from ignnition.ignnition_model import Ignnition_model
+from ignnition.utils import traceable
 
 
 def create_model(model_dir):
@@ -0,0 +1,103 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+import tensorflow as tf
+
+
+class Gradient_accumulator:
+    """
+    Class that accumulates the gradients of several micro-batches (training steps), and applies their mean with a single
+    update of the optimizer once all of them have been accumulated. Since the iterations of the optimizer only count
+    the updates, the learning-rate schedules advance once per accumulated batch.
+    The update is conditional (tf.cond), which is not supported by the synchronization of the gradients of the
+    distribution strategies, so that the accumulation can only be used without a distribution strategy.
+
+    Attributes
+    ----------
+    steps:    int
+        Number of micro-batches accumulated in each update
+    counter:    tf.Variable
+        Number of micro-batches accumulated since the last update
+    gradients:    [array]
+        Accumulated (mean) gradient of each variable
+
+    Methods:
+    ----------
+    build(self, variables)
+        Creates the accumulators of the variables
+    accumulate(self, gradients, variables, optimizer)
+        Accumulates the gradients, and applies them if all the micro-batches have been accumulated
+    """
+
+    def __init__(self, steps):
+        """
+        Parameters
+        ----------
+        steps:    int
+            Number of micro-batches accumulated in each update
+        """
+
+        self.steps = steps
+        self.counter = None
+        self.gradients = None
+
+    def build(self, variables):
+        """
+        Parameters
+        ----------
+        variables:    [array]
+            Trainable variables of the model
+        """
+
+        with tf.init_scope():
+            self.counter = tf.Variable(0, dtype=tf.int64, trainable=False, name='accumulated_steps')
+            self.gradients = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype), trainable=False,
+                                          name='accumulated_' + v.name.split(':')[0].replace('/', '_'))
+                              for v in variables]
+
+    def accumulate(self, gradients, variables, optimizer):
+        """
+        Parameters
+        ----------
+        gradients:    [array]
+            Gradients of the variables in this micro-batch (None for the variables not used)
+        variables:    [array]
+            Trainable variables of the model
+        optimizer:    tf.keras.optimizers.Optimizer
+            Optimizer that applies the accumulated gradients
+        """
+
+        if self.gradients is None:
+            self.build(variables)
+
+        for accumulated, gradient in zip(self.gradients, gradients):
+            if gradient is not None:
+                # the sparse gradients (e.g., of a gather) are accumulated as dense tensors
+                accumulated.assign_add(tf.convert_to_tensor(gradient) / self.steps)
+        self.counter.assign_add(1)
+
+        def apply_gradients():
+            optimizer.apply_gradients(zip([accumulated.read_value() for accumulated in self.gradients], variables))
+            for accumulated in self.gradients:
+                accumulated.assign(tf.zeros_like(accumulated))
+            self.counter.assign(0)
+            return tf.constant(True)
+
+        return tf.cond(self.counter >= self.steps, apply_gradients, lambda: tf.constant(False))
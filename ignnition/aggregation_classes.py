@@ -211,6 +211,12 @@ class Attention_aggr(Aggregation):
     ----------
     weight_initialization:    str
         Indicates how the weights are initialized (if any parameter is specified at all)
+    num_heads:    int
+        Number of attention heads. Each head weights its own slice of the features of the messages
+    edge_chunk_size:    int
+        Maximum number of edges processed at once (all of them if None), for graphs whose edge tensors do not fit in memory.
+        The intermediate tensors of each chunk are recomputed in the backward pass, so that the memory is also bounded
+        in training
 
     Methods:
     ----------
@@ -227,7 +233,53 @@ class Attention_aggr(Aggregation):
         """
         super(Attention_aggr, self).__init__(dict)
         self.weight_initialization = dict.get('weight_initialization', None)
+        self.num_heads = int(dict.get('num_heads', 1))
+        self.edge_chunk_size = dict.get('edge_chunk_size', None)
 
+    def __attention_logits(self, src_states, dst_idx, dst_states, node_kernel, attn_kernel):
+        """
+        Parameters
+        ----------
+        src_states:    tensor
+            Source hs of the edges (E x F1)
+        dst_idx:   tensor
+            Destination indexes of the edges
+        dst_states: tensor
+            Destination hs
+        node_kernel:    tf object
+            node_kernel object to transform the source's and destination's hs shape
+        attn_kernel:    tf.object
+            Attn_kernel object (one attention vector for each head)
+        """
+
+        # W h_j for every source and W h_i for every destination (E x F1)
+        transformed_states_sources = K.dot(src_states, node_kernel)
+        transformed_states_dest = K.dot(tf.gather(dst_states, dst_idx), node_kernel)
+
+        # apply the attention weight vectors    (E x 2F1) * (2F1 x H) = (E x H)
+        attention_input = tf.concat([transformed_states_sources, transformed_states_dest], axis=1)
+        attention_input = K.dot(attention_input, attn_kernel)
+
+        # apply the non linearity
+        return tf.nn.leaky_relu(attention_input, alpha=0.2)
+
+    def __weighted_messages(self, src_states, coef):
+        """
+        Parameters
+        ----------
+        src_states:    tensor
+            Source hs of the edges (E x F1)
+        coef:    tensor
+            Attention coefficient of each head for each edge (E x H)
+        """
+
+        # each head weights its own slice of the features of the message
+        num_edges = tf.shape(src_states)[0]
+        messages = tf.reshape(src_states, [num_edges, self.num_heads, -1])
+        weighted_inputs = messages * tf.expand_dims(coef, axis=-1)
+        return tf.reshape(weighted_inputs, tf.shape(src_states))
+
+    @tf.autograph.experimental.do_not_convert
     def calculate_input(self, comb_src_states, comb_dst_idx, dst_states, comb_seq, num_dst, node_kernel, attn_kernel):
         """
         Parameters
@@ -248,50 +300,98 @@ class Attention_aggr(Aggregation):
             Attn_kernel object
         """
 
-        # obtain the source states  (NxF1)
-        h_src = tf.identity(comb_src_states)
-
-        # dst_states <- (N x F2)
-        # F2 = int(self.dimensions[mp.destination_entity])
-
-        # new number of features (right now set to F1, but could be different)
-        # F_ = F1
-
-        # node_kernel = F1 x F1 (we could change the output dimension)
-        # transformed_states_sources = NxF1 X F1xF1 = NxF1
-        transformed_states_sources = K.dot(h_src, node_kernel)  # (W h_i for every source)
+        # the softmax of the neighbours of each destination is computed directly on the edge list (segment softmax),
+        # so that neither the time nor the memory depend on the maximum degree
+        if self.edge_chunk_size is None:
+            logits = self.__attention_logits(comb_src_states, comb_dst_idx, dst_states, node_kernel, attn_kernel)
 
-        # node_kernel = F2 x F1 (we change the shape of the output hidden state to the same of the source)
-        # transformed_states_dest = NxF2 X F2xF1 = NxF1
-        dst_states_2 = tf.gather(dst_states, comb_dst_idx)
-        transformed_states_dest = K.dot(dst_states_2, node_kernel)  # NxF1   (W h_i for every dst)
-
-        # concat source and dest for each edge
-        attention_input = tf.concat([transformed_states_sources, transformed_states_dest], axis=1)  # Nx2F1
-
-        # apply the attention weight vector    (N x 2F1) * (2F1 x 1) = (N x 1)
-        # atnn_kernel = 2F1 x 1
-        attention_input = K.dot(attention_input, attn_kernel)  # Nx1
-
-        # apply the non linearity
-        attention_input = tf.keras.layers.LeakyReLU(alpha=0.2)(attention_input)
+            # subtract the maximum of each destination for numerical stability
+            max_logits = tf.math.unsorted_segment_max(logits, comb_dst_idx, num_dst)
+            exp_logits = tf.math.exp(logits - tf.gather(max_logits, comb_dst_idx))
+            denominator = tf.math.unsorted_segment_sum(exp_logits, comb_dst_idx, num_dst)
+            coef = exp_logits / tf.gather(denominator, comb_dst_idx)
 
-        # reshape into a matrix where every row is a destination node and every column is one of its neighbours
-        ids = tf.stack([comb_dst_idx, comb_seq], axis=1)
-        max_len = tf.reduce_max(comb_seq) + 1
-        shape = tf.stack([num_dst, max_len, 1])
-        aux = tf.scatter_nd(ids, attention_input, shape)
+            weighted_inputs = self.__weighted_messages(comb_src_states, coef)
+            return tf.math.unsorted_segment_sum(weighted_inputs, comb_dst_idx, num_dst)
 
-        # apply softmax to it (by rows)
-        coef = tf.keras.activations.softmax(aux, axis=0)
+        return self.__chunked_attention(comb_src_states, comb_dst_idx, dst_states, num_dst, node_kernel, attn_kernel)
 
-        # sum them all together using the coefficients (average)
-        final_coef = tf.gather_nd(coef, ids)
-        weighted_inputs = comb_src_states * final_coef
+    def __chunked_attention(self, comb_src_states, comb_dst_idx, dst_states, num_dst, node_kernel, attn_kernel):
+        """
+        Parameters
+        ----------
+        comb_src_states:    tensor
+            Source hs
+        comb_dst_idx:   tensor
+            Destination indexes to be combined with (src -> dst)
+        dst_states: tensor
+            Destination hs
+        num_dst:    int
+            Number of destination entity nodes
+        node_kernel:    tf object
+            node_kernel object to transform the source's and destination's hs shape
+        attn_kernel:    tf.object
+            Attn_kernel object
+        """
 
-        src_input = tf.math.unsorted_segment_sum(weighted_inputs, comb_dst_idx,
-                                                 num_dst)
-        return src_input
+        # the edges are processed in chunks, so that only the intermediate tensors of one chunk are in memory at once.
+        # A first pass finds the maximum logit of each destination, and a second one accumulates the normalized sums.
+        # The intermediate tensors of each chunk of the second pass are recomputed in the backward pass (otherwise the
+        # loop would keep the ones of every chunk for the gradients, E x heads in total)
+        chunk_size = int(self.edge_chunk_size)
+        attention_logits, weighted_messages = self.__attention_logits, self.__weighted_messages
+        num_edges = tf.shape(comb_dst_idx)[0]
+        num_chunks = (num_edges + chunk_size - 1) // chunk_size
+
+        def get_chunk(i):
+            start = i * chunk_size
+            size = tf.minimum(chunk_size, num_edges - start)
+            return comb_src_states[start:start + size], comb_dst_idx[start:start + size]
+
+        def max_step(i, max_logits):
+            src_states, dst_idx = get_chunk(i)
+            logits = attention_logits(src_states, dst_idx, dst_states, node_kernel, attn_kernel)
+            return i + 1, tf.maximum(max_logits, tf.math.unsorted_segment_max(logits, dst_idx, num_dst))
+
+        # the kernels are read once and passed as tensors, since the gradients of the recomputed function cannot
+        # capture the variables from inside the loop
+        node_kernel_value, attn_kernel_value = tf.convert_to_tensor(node_kernel), tf.convert_to_tensor(attn_kernel)
+
+        def sum_step(i, denominator, numerator):
+            src_states, dst_idx = get_chunk(i)
+
+            # the indices are captured (only the floating-point inputs of a recomputed function are differentiated)
+            @tf.recompute_grad
+            def chunk_sums(src_states, dst_states, max_logits, node_kernel, attn_kernel):
+                logits = attention_logits(src_states, dst_idx, dst_states, node_kernel, attn_kernel)
+                exp_logits = tf.math.exp(logits - tf.gather(max_logits, dst_idx))
+                return (tf.math.unsorted_segment_sum(exp_logits, dst_idx, num_dst),
+                        tf.math.unsorted_segment_sum(weighted_messages(src_states, exp_logits), dst_idx, num_dst))
+
+            chunk_denominator, chunk_numerator = chunk_sums(src_states, dst_states, max_logits, node_kernel_value,
+                                                            attn_kernel_value)
+            return i + 1, denominator + chunk_denominator, numerator + chunk_numerator
+
+        num_rows = tf.cast(num_dst, tf.int32)
+        num_features = tf.shape(comb_src_states)[1]
+        invariant = tf.TensorShape(None)
+
+        max_logits = tf.fill(tf.stack([num_rows, self.num_heads]), tf.float32.min)
+        _, max_logits = tf.while_loop(lambda i, *_: i < num_chunks, max_step, [tf.constant(0), max_logits],
+                                      shape_invariants=[tf.TensorShape([]), invariant])
+        # the softmax does not depend on the subtracted maximum, so that the first pass needs no gradients
+        max_logits = tf.stop_gradient(max_logits)
+
+        denominator = tf.zeros(tf.stack([num_rows, self.num_heads]))
+        numerator = tf.zeros(tf.stack([num_rows, num_features]))
+        _, denominator, numerator = tf.while_loop(lambda i, *_: i < num_chunks, sum_step,
+                                                  [tf.constant(0), denominator, numerator],
+                                                  shape_invariants=[tf.TensorShape([]), invariant, invariant])
+
+        # normalize the sum of each head (destinations without neighbours remain zero)
+        numerator = tf.reshape(numerator, [num_rows, self.num_heads, -1])
+        src_input = tf.math.divide_no_nan(numerator, tf.expand_dims(denominator, axis=-1))
+        return tf.reshape(src_input, [num_rows, num_features])
 
 
 class Edge_attention_aggr(Aggregation):
@@ -344,7 +444,7 @@ class Edge_attention_aggr(Aggregation):
         # apply the attention mechanism
         weighted_inputs = weights * comb_src_states
         # sum by destination nodes
-        src_input = tf.math.unsorted_segment_sum(weighted_inputs, comb_dst_idx, int(num_dst))
+        src_input = tf.math.unsorted_segment_sum(weighted_inputs, comb_dst_idx, num_dst)
         return src_input
 
 
@@ -358,10 +458,16 @@ class Conv_aggr(Aggregation):
         Name of the activation function to be used (if any)
     weight_initialization:    str
         Indicates how the weights are initialized (if any parameter is specified at all)
+    normalization:    str
+        Normalization of the messages: destination (1 / sqrt(deg(i))) or symmetric (1 / (sqrt(deg(i)) * sqrt(deg(j))), as in the graph convolutional NN)
+    implementation:    str
+        How the messages are aggregated: segment_sum (gather plus segment sum) or sparse (sparse-dense matrix product, for large graphs)
 
     Methods:
     ----------
-    calculate_input(self, comb_src_states, comb_dst_idx, dst_states, num_dst, kernel)
+    get_normalization(self, src_adjacencies, comb_dst_idx, num_dst)
+        Computes the normalization coefficients of the adjacencies, which only depend on the graph and can thus be reused by all the iterations of the message passing
+    calculate_input(self, comb_src_states, comb_dst_idx, dst_states, num_dst, kernel, normalization)
         Calculates the result of applying the convolution mechanism (proposed for the graph convolutional NN)
     """
 
@@ -375,8 +481,48 @@ class Conv_aggr(Aggregation):
         super(Conv_aggr, self).__init__(attr)
         self.activation_function = attr.get('activation_function', 'relu')
         self.weight_initialization = attr.get('weight_initialization', None)
+        self.normalization = attr.get('normalization', 'destination')
+        self.implementation = attr.get('implementation', 'segment_sum')
 
-    def calculate_input(self, comb_src_states, comb_dst_idx, dst_states, num_dst, kernel):
+    def get_normalization(self, src_adjacencies, comb_dst_idx, num_dst):
+        """
+        Parameters
+        ----------
+        src_adjacencies:    [array]
+            Pairs (src_idx, num_src) of each of the source entities, in the same order as their messages were combined
+        comb_dst_idx:   tensor
+            Destination indexes to be combined with (src -> dst)
+        num_dst:    int
+            Number of destination entity nodes
+        """
+
+        # obtain the degrees of each dst_node considering only the entities involved
+        dst_deg = tf.math.unsorted_segment_sum(tf.ones_like(comb_dst_idx), comb_dst_idx, num_dst)
+        dst_deg = tf.reshape(tf.math.sqrt(tf.cast(dst_deg, dtype=tf.float32)), (-1, 1))
+
+        # each message is divided by sqrt(deg(i)) and, if symmetric, also by sqrt(deg(j))
+        edge_coef = tf.math.divide_no_nan(1., tf.gather(dst_deg, comb_dst_idx))
+        if self.normalization == 'symmetric':
+            src_deg = [tf.gather(tf.math.unsorted_segment_sum(tf.ones_like(src_idx), src_idx, num_src), src_idx)
+                       for src_idx, num_src in src_adjacencies]
+            src_deg = tf.reshape(tf.math.sqrt(tf.cast(tf.concat(src_deg, axis=0), dtype=tf.float32)), (-1, 1))
+            edge_coef = tf.math.divide_no_nan(edge_coef, src_deg)
+
+        # the destination state itself is divided by deg(i)
+        self_coef = tf.math.divide_no_nan(1., tf.math.square(dst_deg))
+
+        adjacency = None
+        if self.implementation == 'sparse':
+            # matrix of shape (num_dst x num_edges) with the coefficient of each message
+            num_edges = tf.shape(comb_dst_idx, out_type=tf.int64)[0]
+            indices = tf.stack([tf.cast(comb_dst_idx, tf.int64), tf.range(num_edges)], axis=1)
+            adjacency = tf.sparse.reorder(tf.sparse.SparseTensor(indices, tf.reshape(edge_coef, [-1]),
+                                                                 tf.stack([tf.cast(num_dst, tf.int64), num_edges])))
+
+        return edge_coef, self_coef, adjacency
+
+    @tf.autograph.experimental.do_not_convert
+    def calculate_input(self, comb_src_states, comb_dst_idx, dst_states, num_dst, kernel, normalization):
         """
         Parameters
         ----------
@@ -390,36 +536,27 @@ class Conv_aggr(Aggregation):
             Number of destination entity nodes
         kernel:    tf object
             Kernel object to transform the source's hs shape
+        normalization:    tuple
+            Normalization coefficients returned by get_normalization
         """
 
         # MATHEMATICAL FORMULATION:
-        # CONVOLUTION: h_i^t = SIGMA(SUM_N(i) (1 / (sqrt(deg(i)) * sqrt(deg(j))) * w * x_j^(t-1))
-        # = h_i^t = SIGMA( 1 / sqrt(deg(i)) * SUM_N(i) (1 / (sqrt(deg(j))) * w * x_j^(t-1))
-        # implemented: h_i^t = SIGMA(1 / sqrt(deg(i)) * SUM_N(i) w * x_j^(t-1))
-
-        # comb_src_states = N x F    kernel = F x F
-        weighted_input = tf.linalg.matmul(comb_src_states, kernel)
+        # CONVOLUTION: h_i^t = SIGMA(SUM_N(i) (1 / (sqrt(deg(i)) * sqrt(deg(j))) * w * x_j^(t-1) + 1 / deg(i) * h_i^(t-1))
+        # destination normalization: h_i^t = SIGMA(1 / sqrt(deg(i)) * SUM_N(i) w * x_j^(t-1) + 1 / deg(i) * h_i^(t-1))
+        edge_coef, self_coef, adjacency = normalization
 
-        # normalize each input dividing by sqrt(deg(j)) (only applies if they are from the same entity as the destination node)
-        # ??
+        # each destination sums all its (normalized) neighbours
+        if self.implementation == 'sparse':
+            neighbours_sum = tf.sparse.sparse_dense_matmul(adjacency, comb_src_states)
+        else:
+            neighbours_sum = tf.math.unsorted_segment_sum(comb_src_states * edge_coef, comb_dst_idx, num_dst)
 
-        # each destination sums all its neighbours
-        neighbours_sum = tf.math.unsorted_segment_sum(weighted_input, comb_dst_idx, num_dst)
-
-        # obtain the degrees of each dst_node considering only the entities involved
-        dst_deg = tf.math.unsorted_segment_sum(tf.ones_like(comb_dst_idx), comb_dst_idx, num_dst)
-        dst_deg = tf.cast(dst_deg, dtype=tf.float32)
-        dst_deg = tf.math.sqrt(dst_deg)
-        dst_deg = tf.reshape(dst_deg, (-1, 1))
-
-        # normalize the dst_states themselves (divide by their degree)
-        dst_states_aux = tf.math.divide_no_nan(dst_states, dst_deg)
+        # the kernel is linear, so it is applied after the aggregation (one row per destination instead of per edge)
+        # comb_src_states = N x F    kernel = F x F
+        neighbours_sum = tf.linalg.matmul(neighbours_sum, kernel)
 
         # sum the destination state itself
-        total_sum = tf.math.add(neighbours_sum, dst_states_aux)
-
-        # normalize all the values dividing by sqrt(dst_deg)
-        normalized_val = tf.math.divide_no_nan(total_sum, dst_deg)
+        normalized_val = tf.math.add(neighbours_sum, dst_states * self_coef)
 
         # normalize by mean and variance  (CHECK) This is the node normalization
         mean = tf.math.reduce_mean(normalized_val)
@@ -469,15 +606,11 @@ class Interleave_aggr(Aggregation):
             Indices to reorder for the interleave
         """
 
-        # destinations x max_of_sources_to_dest_concat x dim_source ->  (max_of_sources_to_dest_concat x destinations x dim_source)
-        src_input = tf.transpose(src_input, perm=[1, 0, 2])
-        indices = tf.reshape(indices, [-1, 1])
-
-        src_input = tf.scatter_nd(indices, src_input,
-                                  tf.shape(src_input, out_type=tf.int64))
-
-        # (max_of_sources_to_dest_concat x destinations x dim_source) -> destinations x max_of_sources_to_dest_concat x dim_source
-        src_input = tf.transpose(src_input, perm=[1, 0, 2])
+        # the message k of the concatenation goes to the position indices[k], so the interleaved input is a single
+        # gather (along the axis of the messages) with the inverse permutation
+        # destinations x max_of_sources_to_dest_concat x dim_source
+        indices = tf.reshape(indices, [-1])
+        src_input = tf.gather(src_input, tf.math.invert_permutation(indices), axis=1)
         return src_input
 
 
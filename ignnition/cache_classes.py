@@ -0,0 +1,251 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+
+def hash_features(features):
+    """
+    Returns the canonical hash of a dictionary of (processed) tensors, which only depends on the names, types, shapes
+    and values of the tensors (and not on the order of the keys).
+
+    Parameters
+    ----------
+    features:    dict
+        Dictionary of arrays (or values convertible to arrays)
+    """
+
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted(features):
+        value = np.ascontiguousarray(features[name])
+        h.update(name.encode())
+        h.update(str(value.dtype).encode())
+        h.update(str(value.shape).encode())
+        if value.dtype == object:
+            h.update(repr(value.tolist()).encode())
+        else:
+            h.update(value.tobytes())
+    return h.hexdigest()
+
+
+def hash_sample(sample):
+    """
+    Returns the hash of a raw sample (networkx node-link dictionary), which only depends on its content.
+
+    Parameters
+    ----------
+    sample:    dict
+        Sample (networkx node-link dictionary)
+    """
+
+    return hashlib.blake2b(json.dumps(sample, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+class Prediction_cache:
+    """
+    Class that stores the predictions of the most recently used graphs (LRU), keyed by the canonical hash of their
+    processed tensors, so that the repeated (or equivalent) graphs skip the forward pass. The raw samples are also
+    mapped to the hash of their tensors, so that the repeated samples skip the preprocessing as well.
+    The cache is bounded both in number of entries and in memory (of the stored predictions), and it is cleared when
+    the weights of the model change (see set_model).
+
+    Attributes
+    ----------
+    max_entries:    int
+        Maximum number of stored predictions
+    max_memory:    int
+        Maximum memory (in bytes) of the stored predictions (None for no limit)
+    path:    str
+        File where the cache is persisted (None to keep it only in memory)
+    model_key:    str
+        Hash of the weights of the model that computed the stored predictions
+    entries:    OrderedDict
+        Stored predictions, from the least to the most recently used
+    sample_keys:    OrderedDict
+        Hash of the tensors of each raw sample (bounded as the entries)
+    memory:    int
+        Memory (in bytes) of the stored predictions
+    hits:    int
+        Number of predictions served from the cache
+    misses:    int
+        Number of predictions not found in the cache
+    evictions:    int
+        Number of predictions removed to respect the bounds of the cache
+
+    Methods:
+    ----------
+    set_model(self, model_key)
+        Clears the cache if the predictions were computed with other weights
+    get(self, key)
+        Returns the stored prediction of the key (None if it is not stored)
+    put(self, key, prediction)
+        Stores a prediction, evicting the least recently used ones if needed
+    get_sample_key(self, sample_hash)
+        Returns the hash of the tensors of a raw sample (None if it is not known)
+    put_sample_key(self, sample_hash, key)
+        Stores the hash of the tensors of a raw sample
+    get_stats(self)
+        Returns the counters and the size of the cache
+    save(self)
+        Persists the cache in its path
+    __load(self)
+        Loads the cache persisted in its path
+    """
+
+    def __init__(self, max_entries=1024, max_memory=None, path=None):
+        """
+        Parameters
+        ----------
+        max_entries:    int
+            Maximum number of stored predictions
+        max_memory:    int
+            Maximum memory (in bytes) of the stored predictions (None for no limit)
+        path:    str
+            File where the cache is persisted (loaded if it exists)
+        """
+
+        self.max_entries = int(max_entries)
+        self.max_memory = None if max_memory is None else int(max_memory)
+        self.path = path
+        self.model_key = None
+        self.entries = collections.OrderedDict()
+        self.sample_keys = collections.OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None and os.path.exists(path):
+            self.__load()
+
+    def set_model(self, model_key):
+        """
+        Parameters
+        ----------
+        model_key:    str
+            Hash of the current weights of the model
+        """
+
+        if model_key != self.model_key:
+            self.entries.clear()
+            self.sample_keys.clear()
+            self.memory = 0
+            self.model_key = model_key
+
+    def get(self, key):
+        """
+        Parameters
+        ----------
+        key:    str
+            Hash of the processed tensors of the graph
+        """
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, prediction):
+        """
+        Parameters
+        ----------
+        key:    str
+            Hash of the processed tensors of the graph
+        prediction:    array
+            Prediction of the graph
+        """
+
+        prediction = np.asarray(prediction)
+        if self.max_memory is not None and prediction.nbytes > self.max_memory:
+            return
+        if key in self.entries:
+            self.memory -= self.entries.pop(key).nbytes
+        self.entries[key] = prediction
+        self.memory += prediction.nbytes
+
+        while len(self.entries) > self.max_entries or (self.max_memory is not None and self.memory > self.max_memory):
+            _, evicted = self.entries.popitem(last=False)
+            self.memory -= evicted.nbytes
+            self.evictions += 1
+
+    def get_sample_key(self, sample_hash):
+        """
+        Parameters
+        ----------
+        sample_hash:    str
+            Hash of the raw sample
+        """
+
+        key = self.sample_keys.get(sample_hash, None)
+        if key is not None:
+            self.sample_keys.move_to_end(sample_hash)
+        return key
+
+    def put_sample_key(self, sample_hash, key):
+        """
+        Parameters
+        ----------
+        sample_hash:    str
+            Hash of the raw sample
+        key:    str
+            Hash of the processed tensors of the sample
+        """
+
+        self.sample_keys[sample_hash] = key
+        self.sample_keys.move_to_end(sample_hash)
+        while len(self.sample_keys) > self.max_entries:
+            self.sample_keys.popitem(last=False)
+
+    def get_stats(self):
+        return {'entries': len(self.entries),
+                'memory': self.memory,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        # the file is replaced atomically, so that an interrupted save does not corrupt the persisted cache
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'model_key': self.model_key,
+                         'entries': list(self.entries.items()),
+                         'sample_keys': list(self.sample_keys.items())}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def __load(self):
+        with open(self.path, 'rb') as f:
+            content = pickle.load(f)
+        self.model_key = content['model_key']
+        for key, prediction in content['entries']:
+            self.put(key, prediction)
+        for sample_hash, key in content['sample_keys']:
+            self.put_sample_key(sample_hash, key)
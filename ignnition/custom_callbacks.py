@@ -2,40 +2,60 @@ import json
 import tensorflow as tf
 import sys
 import os
-from collections import OrderedDict
+import glob
+import time
+import threading
+from ignnition.utils import *
 
 
-class K_best(tf.keras.callbacks.Callback):
+class Async_checkpoint(tf.keras.callbacks.Callback):
     """
-    A subclass of the callback preset class which implements the functionality to keep only the best k checkpoints of the execution (instead of the best one implemented in Tf).
+    A subclass of the callback preset class which saves the weights of the model at the end of each epoch without blocking the training. The weights are first copied to variables in host memory, and these are then written with tf.train.Checkpoint from a background thread.
+    The weights of the last epoch are always written to the weights.latest checkpoint. Besides, the epochs with the monitored value (e.g., the validation loss) are written to their own checkpoints, of which only the best k are kept.
 
     Attributes
     ----------
     output_path:    str
-        Path where the checkpoints are saved
-    file_loss: dict
-        Dictionary where we keep the loss of each of the checkpoints saved
+        Path of the directory where the checkpoints are saved
     k: int
-        Number of checkpoints to keep
+        Number of checkpoints to keep (all of them if None)
+    monitor:    str
+        Name of the value (in the logs of the epoch) used to rank the checkpoints
+    checkpoints:    [array]
+        Pairs (value, path) of the checkpoints currently saved
+    host_variables:    [array]
+        Copy of the weights of the model in host memory, written by the background thread
+    thread:    threading.Thread
+        Background thread writing the last snapshot (if any)
 
     Methods:
     ----------
-    on_epoch_end(self, src_input, indices)
-       At the end of each epoch, we check which of the checkpoints we need to delete (if any)
+    on_epoch_end(self, epoch, logs={})
+       Takes a snapshot of the weights and writes it in the background (also ranked if the monitored value is available)
+    on_train_end(self, logs={})
+        Waits until the last checkpoint has been written
     """
 
-    def __init__(self, output_path, k=None):
+    def __init__(self, output_path, k=None, monitor='val_loss'):
         """
         Parameters
         ----------
         output_path:    str
-            Path where the checkpoints are saved
+            Path of the directory where the checkpoints are saved
         k: int
-            Number of checkpoints to keep
+            Number of checkpoints to keep (all of them if None)
+        monitor:    str
+            Name of the value (in the logs of the epoch) used to rank the checkpoints
         """
+
+        super(Async_checkpoint, self).__init__()
         self.output_path = output_path
-        self.files_loss = {}
-        self.k = k
+        self.k = int(k) if k is not None else None
+        self.monitor = monitor
+        self.checkpoints = []
+        self.host_variables = None
+        self.checkpoint = None
+        self.thread = None
 
     def on_epoch_end(self, epoch, logs={}):
         """
@@ -47,20 +67,177 @@ class K_best(tf.keras.callbacks.Callback):
             Dictionary with the information of the current epoch
         """
 
+        # the epochs without the monitored value (e.g., without validation) are only written as the latest snapshot
+        value = logs.get(self.monitor, None)
+
+        # the snapshot is only taken once the previous one has been written, which bounds the host memory used
+        self.__wait()
+        if self.host_variables is None:
+            with tf.device('/cpu:0'):
+                self.host_variables = [tf.Variable(v, trainable=False) for v in self.model.weights]
+            self.checkpoint = tf.train.Checkpoint(variables=self.host_variables)
+            # the save counter is also written, since it is created when restoring (so that all the objects match)
+            _ = self.checkpoint.save_counter
+        else:
+            for host_variable, v in zip(self.host_variables, self.model.weights):
+                host_variable.assign(v)
+
+        path = None
+        if value is not None:
+            path = os.path.join(self.output_path, 'weights.' + '{:02d}'.format(epoch + 1) + '-' +
+                                '{:.2f}'.format(value))
+            value = float(value)
+        self.thread = threading.Thread(target=self.__write, args=(path, value))
+        self.thread.start()
+
+    def on_train_end(self, logs={}):
+        self.__wait()
+
+    def __wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __write(self, path, value):
+        """
+        Parameters
+        ----------
+        path:    str
+            Prefix of the files of the ranked checkpoint (None if the monitored value is not available)
+        value:    float
+            Monitored value of this checkpoint
+        """
+
+        latest_path = os.path.join(self.output_path, 'weights.latest')
+        try:
+            latest_path = self.checkpoint.write(latest_path)
+            if path is not None:
+                path = self.checkpoint.write(path)
+        except Exception as inf:
+            print_info('\nThe checkpoint ' + str(path or latest_path) + ' could not be written: ' + str(inf))
+            return
+
+        # without any ranked checkpoint, the latest one is the one returned by tf.train.latest_checkpoint
+        if path is None:
+            if not self.checkpoints:
+                tf.compat.v1.train.update_checkpoint_state(self.output_path, latest_path)
+            return
+
+        # keep only the best k checkpoints (lowest monitored value)
+        self.checkpoints.append((value, path))
+        self.checkpoints.sort(key=lambda c: c[0])
         if self.k is not None:
-            loss = logs["loss"]
-            name = "weights." + str("{:02d}".format(self.epoch)) + '-' + str("{:.2f}".format(loss)) + '.hdf5'
-            self.files_loss[name] = loss
-
-            if len(self.files_loss) >= self.k:
-                # sort by value in decreasing order
-                d_descending = OrderedDict(sorted(self.files_loss.items(), key=lambda kv: kv[1], reverse=True))
-                n = len(d_descending)
-
-                # delete the len(d_descending - k) first files
-                num_deletions = n - self.k
-                file_delete = list(d_descending.items())[0:num_deletions]
-                for name, _ in file_delete:
-                    path = self.output_path + '/ckpt/' + name
-                    os.remove(path)
-                    del self.files_loss[name]
+            for _, old_path in self.checkpoints[self.k:]:
+                for file in glob.glob(old_path + '.*'):
+                    os.remove(file)
+            self.checkpoints = self.checkpoints[:self.k]
+
+        # the best checkpoint (last one of the list) is the one returned by tf.train.latest_checkpoint
+        tf.compat.v1.train.update_checkpoint_state(self.output_path, self.checkpoints[0][1],
+                                                   all_model_checkpoint_paths=[c[1] for c in reversed(self.checkpoints)])
+
+
+def restore_checkpoint(model, checkpoint_path):
+    """
+    Restores the weights saved by Async_checkpoint into a model (whose variables must have already been created)
+
+    Parameters
+    ----------
+    model:    tf.keras.Model
+        Model where the weights are restored
+    checkpoint_path:    str
+        Prefix of the checkpoint files, or directory of the checkpoints (then the best checkpoint is used)
+    """
+
+    if os.path.isdir(checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    # the weights are matched by their position, so that a checkpoint of a different model must fail
+    tf.train.Checkpoint(variables=list(model.weights)).restore(checkpoint_path).assert_existing_objects_matched()
+
+
+class Py_function_overhead(tf.keras.callbacks.Callback):
+    """
+    A subclass of the callback preset class which measures the time spent in the custom functions (loss or metrics) that could not be traced, and thus run through tf.py_function.
+    At the end of the first epoch it warns the user with the measured overhead per training step.
+
+    Attributes
+    ----------
+    timings:    dict
+        Dictionary mapping the name of each wrapped function to its accumulated time and number of calls
+    num_steps:    int
+        Number of training steps executed in the current epoch
+    validating:    bool
+        Indicates if the validation is running, whose calls are not measured (the overhead is per training step)
+
+    Methods:
+    ----------
+    wrap(self, name, func)
+        Returns a version of func that accumulates its execution time (only in the training steps)
+    on_train_batch_end(self, batch, logs={})
+        Counts the number of training steps
+    on_test_begin(self, logs={})
+        Stops measuring the calls during the validation
+    on_test_end(self, logs={})
+        Resumes measuring the calls after the validation
+    on_epoch_end(self, epoch, logs={})
+        At the end of the first epoch, it reports the measured overhead
+    """
+
+    def __init__(self):
+        super(Py_function_overhead, self).__init__()
+        self.timings = {}
+        self.num_steps = 0
+        self.reported = False
+        self.validating = False
+
+    def wrap(self, name, func):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the custom function
+        func:    function
+            Custom python function to be executed through tf.py_function
+        """
+
+        self.timings[name] = [0.0, 0]
+
+        def timed_func(*args):
+            if self.validating:
+                return func(*args)
+            start = time.perf_counter()
+            result = func(*args)
+            self.timings[name][0] += time.perf_counter() - start
+            self.timings[name][1] += 1
+            return result
+
+        return timed_func
+
+    def on_train_batch_end(self, batch, logs={}):
+        self.num_steps += 1
+
+    def on_test_begin(self, logs={}):
+        self.validating = True
+
+    def on_test_end(self, logs={}):
+        self.validating = False
+
+    def on_epoch_end(self, epoch, logs={}):
+        """
+        Parameters
+        ----------
+        epoch:    int
+            Epoch number
+        logs:    dict
+            Dictionary with the information of the current epoch
+        """
+
+        if not self.reported and self.num_steps > 0:
+            self.reported = True
+            for name, (total_time, calls) in self.timings.items():
+                if calls > 0:
+                    print_info('\nThe custom function "' + name + '" is not traceable and runs through tf.py_function, '
+                               'outside of the compiled graph. Measured overhead: ' +
+                               '{:.3f}'.format(1000 * total_time / self.num_steps) + ' ms per training step (' +
+                               str(calls) + ' calls). Consider writing it with tensorflow operations and '
+                                            'decorating it with @ignnition.traceable.')
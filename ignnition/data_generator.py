@@ -18,7 +18,9 @@
 
 # -*- coding: utf-8 -*-
 
+import collections
 import glob
+import hashlib
 import json
 import sys
 import tarfile
@@ -32,6 +34,8 @@ from ignnition.utils import *
 
 import networkx as nx
 from networkx.readwrite import json_graph
+from itertools import chain
+from ignnition.partitioning import HALO_ATTRIBUTE, GLOBAL_ID_ATTRIBUTE
 
 
 class Generator:
@@ -42,24 +46,90 @@ class Generator:
     ----------
     end_symbol:    str
         End symbol to be used when reading the json file as a stream of data.
+    interleave_cache:    OrderedDict
+        Indices of the interleave aggregations, for the definitions and sizes most recently seen (at most structure_cache_size).
+    sampling:    dict
+        Options of the neighbor sampling of the training subgraphs (None to serve the full graphs). See __sample_subgraphs.
+    sampling_rng:    np.random.Generator
+        Random number generator of the neighbor sampling
+    mask_halo_nodes:    bool
+        Whether only the interior nodes of the partitions are compared with the labels (see ignnition.partitioning)
+    historical_embeddings:    bool
+        Whether the global ids and the halo hops of the nodes of each entity are served (for the historical embeddings)
+    structure_cache:    OrderedDict
+        Numbers of nodes and adjacencies (as read-only arrays) of the topologies most recently seen, keyed by the hash of their nodes and links (None if the topology has edge inputs, which are only read from the networkx graph).
+    structure_cache_size:    int
+        Maximum number of topologies in the structure cache, and of sizes in the interleave cache (0 to disable them)
+    index_dtype:    np.dtype
+        Type of the indices served (adjacencies, sequences, numbers of nodes and additional inputs): int64, or int32 to halve their memory
 
     Methods:
     ----------
+    __copy__(self)
+        Returns a copy of the generator with the same options, but with its own caches (one for each input pipeline).
+
     stream_read_json(self, f)
        Creates a generator of samples from the given dataset or sample array. All these are read as a stream of data to avoid full alocation on memory.
 
     __process_sample(self, sample, file=None)
         Given an input sample, it processes it and pre-computes several aspects to be later served to the GNN module.
 
+    __get_structure_key(self, sample)
+        Returns the hash of the nodes (with their entities) and links of a sample, which keys the structure cache.
+
+    __cache_structure(self, key, data, positions, usable)
+        Stores the numbers of nodes and the adjacencies of a processed sample in the structure cache.
+
+    __process_cached_sample(self, sample, structure, file=None)
+        Processes a sample whose topology is in the structure cache, extracting only its features and labels.
+
     generate_from_array
         Creates and returns the generator from an input array of samples of the user.
 
     generate_from_dataset
         Creates and returns the generator from an input dataset of samples of the user.
+
+    process_samples
+        Processes an array of samples (networkx node-link dictionaries) at once, without serializing them to JSON.
+
+    merge_samples(self, samples, labels=None)
+        Merges several processed samples into one single graph (disjoint union), so that they can be processed as a batch.
+
+    __cast_indices(self, processed_sample, training=None)
+        Casts the indices of a processed sample (or batch) to the index type, checking that they fit in it.
+
+    __mask_halo_nodes(self, G, data, output)
+        Masks the labels of the halo nodes of a partition, so that only its interior nodes are compared with the labels.
+
+    __sample_subgraphs(self, G, data, output)
+        Splits the labelled nodes of a processed sample into batches of seed nodes, and samples the subgraph (with a bounded fanout of neighbors) needed to compute the output of each batch.
+
+    __build_subgraph(self, data, output, adjacencies, owners, needed, kept, label_entity, seeds)
+        Builds the processed sample of a sampled subgraph, with the remapped indices and the mask of the labelled seeds.
     """
 
     def __init__(self):
         self.end_symbol = bytes(']', 'utf-8')
+        self.interleave_cache = collections.OrderedDict()
+        self.sampling = None
+        self.sampling_rng = None
+        self.mask_halo_nodes = False
+        self.historical_embeddings = False
+        self.structure_cache = collections.OrderedDict()
+        self.structure_cache_size = 16
+        self.index_dtype = np.int64
+
+    def __copy__(self):
+        """
+        Returns a copy of the generator with the same options, but with its own (empty) caches, so that several copies
+        can serve concurrent pipelines (e.g., the training and validation pipelines, which are both prefetched)
+        """
+
+        generator = Generator.__new__(Generator)
+        generator.__dict__.update(self.__dict__)
+        generator.interleave_cache = collections.OrderedDict()
+        generator.structure_cache = collections.OrderedDict()
+        return generator
 
     def stream_read_json(self, f):
         """
@@ -97,11 +167,24 @@ class Generator:
             Path to these file (which is useful for error-checking purposes)
         """
 
+        # the samples with the topology of a previous one (e.g., those of the same simulation) reuse its adjacencies, and
+        # only their features and labels are extracted. The sampled subgraphs and the masks of the halo nodes are
+        # computed on the networkx graph, so they always take the full path
+        structure_key = None
+        if self.structure_cache_size > 0 and not (self.training and (self.sampling is not None or self.mask_halo_nodes)):
+            structure_key = self.__get_structure_key(sample)
+            if self.structure_cache.get(structure_key, None) is not None:
+                self.structure_cache.move_to_end(structure_key)
+                processed_sample = self.__process_cached_sample(sample, self.structure_cache[structure_key], file)
+                if processed_sample is not None:
+                    return processed_sample
+
         # load the model
         G = json_graph.node_link_graph(sample)
 
         entity_counter = {}
         mapping = {}
+        positions = {}
         data = {}
 
         for name in self.entity_names:
@@ -119,6 +202,7 @@ class Generator:
             new_node_name = entity_name + '_{}'
             num_node = entity_counter[entity_name]
             entity_counter[entity_name] += 1
+            positions.setdefault(entity_name, []).append(len(mapping))
 
             mapping[node_name] = new_node_name.format(num_node)
 
@@ -129,6 +213,16 @@ class Generator:
         # do we need this??
         D_G = nx.relabel_nodes(G, mapping)
 
+        # global ids and halo hops of the nodes of each entity, which key the historical embeddings (by default, the
+        # graph is not a partition and thus all its nodes are interior nodes)
+        if self.historical_embeddings:
+            for name in self.entity_names:
+                nodes = [D_G.nodes[name + '_' + str(i)] for i in range(entity_counter[name])]
+                data[GLOBAL_ID_ATTRIBUTE + '_' + name] = np.array(
+                    [node.get(GLOBAL_ID_ATTRIBUTE, i) for i, node in enumerate(nodes)], dtype=np.int64)
+                data[HALO_ATTRIBUTE + '_' + name] = np.array([node.get(HALO_ATTRIBUTE, 0) for node in nodes],
+                                                             dtype=np.int64)
+
         # load the features (all the features are set to be lists. So we always return a list of lists)
         for f in self.feature_names:
             try:
@@ -155,6 +249,7 @@ class Generator:
                 print_failure(message)
 
         # take other inputs if needed (check that they might be global features)
+        edge_inputs = False
         for a in self.additional_input:
             node_attr = np.array(list(nx.get_node_attributes(D_G, a).values()))
             # it should always be a 2d array
@@ -170,6 +265,7 @@ class Generator:
                 data[a] = node_attr
             elif edge_attr.size != 0:
                 data[a] = edge_attr
+                edge_inputs = True
             elif a in D_G.graph:
                 data[a] = [D_G.graph[a]]
             else:
@@ -213,39 +309,536 @@ class Generator:
 
             processed_neighbours[dst_node] += 1  # this is useful to check which sequence number to use
 
+        if structure_key is not None:
+            self.__cache_structure(structure_key, data, positions, not edge_inputs)
+
         # this collects the sequence for the interleave aggregation (if any)
         for i in self.interleave_names:
             name, dst_entity = i
-            interleave_definition = list(D_G.graph[name].values())  # this must be a graph variable
+            interleave_definition = tuple(D_G.graph[name].values())  # this must be a graph variable
+
+            # superior limit of the size of any destination, for each of the involved entities
+            sizes = tuple((src_entity, int(np.max(data['seq_' + src_entity + '_to_' + dst_entity])) + 1)
+                          for src_entity in dict.fromkeys(interleave_definition))
+
+            data.update(self.__get_interleave_indices(interleave_definition, sizes, dst_entity))
+
+        if self.training:
+            if self.sampling is not None:
+                return self.__sample_subgraphs(D_G, data, final_output)
+            if self.mask_halo_nodes:
+                return self.__mask_halo_nodes(D_G, data, final_output)
+            return data, final_output
+        else:
+            return data
+
+    def __get_structure_key(self, sample):
+        """
+        Parameters
+        ----------
+        sample:    dict
+            Input sample which is a serialized version (in JSON) of a networkx graph.
+        """
+
+        structure = [self.entity_names, self.additional_input, sample.get('directed', False),
+                     sample.get('multigraph', True),
+                     [[node['id'], node.get('entity')] for node in sample['nodes']],
+                     [[link['source'], link['target'], link.get('key')] for link in sample['links']]]
+        return hashlib.blake2b(json.dumps(structure, default=str).encode(), digest_size=16).hexdigest()
+
+    def __cache_structure(self, key, data, positions, usable):
+        """
+        Parameters
+        ----------
+        key:    str
+            Hash of the nodes and links of the sample (see __get_structure_key)
+        data:    dict
+            Processed sample (with its numbers of nodes and adjacencies)
+        positions:    dict
+            Positions (in the list of nodes of the sample) of the nodes of each entity
+        usable:    bool
+            Whether the samples with this topology can be processed from the cache (False if they have edge inputs)
+        """
+
+        structure = None
+        if usable:
+            structure = {'num': {name: data['num_' + name] for name in self.entity_names},
+                         'positions': {name: positions.get(name, []) for name in self.entity_names},
+                         'adjacencies': {}}
+            for k, v in data.items():
+                if k.startswith('src_') or k.startswith('dst_') or k.startswith('seq_'):
+                    # the arrays are shared by all the samples with this topology, so they must not be modified
+                    array = np.array(v, dtype=np.int64)
+                    array.flags.writeable = False
+                    structure['adjacencies'][k] = array
+                    data[k] = array
+
+        self.structure_cache[key] = structure
+        while len(self.structure_cache) > self.structure_cache_size:
+            self.structure_cache.popitem(last=False)
+
+    def __process_cached_sample(self, sample, structure, file=None):
+        """
+        Processes a sample whose topology is in the structure cache, extracting only its features and labels from the
+        list of nodes (in the same order as the networkx graph). It returns None if some input is not defined in the
+        nodes or the graph, so that the sample takes the full path.
+
+        Parameters
+        ----------
+        sample:    dict
+            Input sample which is a serialized version (in JSON) of a networkx graph.
+        structure:    dict
+            Numbers of nodes, positions of the nodes of each entity and adjacencies of the topology
+        file:    str
+            Path to these file (which is useful for error-checking purposes)
+        """
+
+        nodes = sample['nodes']
+        graph = sample.get('graph', {})
+        data = {}
+
+        for name in self.entity_names:
+            data['num_' + name] = structure['num'][name]
+
+        if self.historical_embeddings:
+            for name in self.entity_names:
+                entity_nodes = [nodes[p] for p in structure['positions'][name]]
+                data[GLOBAL_ID_ATTRIBUTE + '_' + name] = np.array(
+                    [node.get(GLOBAL_ID_ATTRIBUTE, i) for i, node in enumerate(entity_nodes)], dtype=np.int64)
+                data[HALO_ATTRIBUTE + '_' + name] = np.array([node.get(HALO_ATTRIBUTE, 0) for node in entity_nodes],
+                                                             dtype=np.int64)
 
-            involved_entities = {}
-            total_sequence = []
-            total_size, n_total, counter = 0, 0, 0
+        for f in self.feature_names:
+            try:
+                feature = np.array([node[f] for node in nodes if f in node])
+            except:
+                feature = np.zeros(0)
+            if len(np.shape(feature)) == 1:
+                feature = np.expand_dims(feature, axis=-1)
+            if feature.size == 0:
+                message = "The feature " + f + " was used in the model_description.yaml file " \
+                                               "but was not defined in the dataset."
+                if file is not None:
+                    message = "Error in the dataset file located in '" + file + ".\n" + message
+                print_failure(message)
+            data[f] = feature
 
-            for src_entity in interleave_definition:
-                total_size += 1
-                if src_entity not in involved_entities:
-                    involved_entities[src_entity] = counter  # each entity a different value (identifier)
+        for a in self.additional_input:
+            node_attr = np.array([node[a] for node in nodes if a in node])
+            if len(np.shape(node_attr)) == 1:
+                node_attr = np.expand_dims(node_attr, axis=-1)
 
-                    seq = data['seq_' + src_entity + '_to_' + dst_entity]
-                    n_total += max(seq) + 1  # superior limit of the size of any destination
-                    counter += 1
+            if node_attr.size != 0:
+                data[a] = node_attr
+            elif a in graph:
+                data[a] = [graph[a]]
+            else:
+                return None
 
-                # obtain all the original definition in a numeric format
-                total_sequence.append(involved_entities[src_entity])
+        if self.training:
+            final_output = [node[self.output_name] for node in nodes if self.output_name in node]
 
-            # we exceed the maximum length for sake to make it multiple. Then we will cut it
-            repetitions = math.ceil(float(n_total) / total_size)
-            result = np.array((total_sequence * repetitions)[:n_total])
+        data.update(structure['adjacencies'])
 
-            for entity in involved_entities:
-                id = involved_entities[entity]
-                data['indices_' + entity + '_to_' + dst_entity] = np.where(result == id)[0].tolist()
+        for name, dst_entity in self.interleave_names:
+            interleave_definition = tuple(graph[name].values())
+            sizes = tuple((src_entity, int(np.max(data['seq_' + src_entity + '_to_' + dst_entity])) + 1)
+                          for src_entity in dict.fromkeys(interleave_definition))
+            data.update(self.__get_interleave_indices(interleave_definition, sizes, dst_entity))
 
         if self.training:
             return data, final_output
+        return data
+
+    def __set_sampling(self, sampling):
+        """
+        Parameters
+        ----------
+        sampling:    dict
+            Options of the neighbor sampling (None to serve the full graphs)
+        """
+
+        self.sampling = sampling
+        # the random number generator is only created once, so that every epoch samples different subgraphs
+        if sampling is not None and self.sampling_rng is None:
+            self.sampling_rng = np.random.default_rng(sampling.get('seed', None))
+
+    def __get_interior_nodes(self, G, entity, num_nodes):
+        """
+        Returns the mask of the interior nodes of the entity (all of them, unless the sample is a partition with halo
+        nodes).
+
+        Parameters
+        ----------
+        G:    networkx.DiGraph
+            Graph of the sample (with the nodes already relabelled as entity_index)
+        entity:    str
+            Name of the entity
+        num_nodes:    int
+            Number of nodes of the entity
+        """
+
+        return np.array([G.nodes[entity + '_' + str(i)].get(HALO_ATTRIBUTE, 0) == 0 for i in range(num_nodes)],
+                        dtype=bool)
+
+    def __mask_halo_nodes(self, G, data, output):
+        """
+        Masks the halo nodes of a partition, whose predictions are not compared with the labels (since part of their
+        neighborhood belongs to other partitions).
+
+        Parameters
+        ----------
+        G:    networkx.DiGraph
+            Graph of the sample (with the nodes already relabelled as entity_index)
+        data:    dict
+            Processed sample
+        output:    [array]
+            Labels of the sample (one for each node of the labelled entity)
+        """
+
+        labelled_nodes = list(nx.get_node_attributes(G, self.output_name))
+        label_entity = G.nodes[labelled_nodes[0]]['entity'] if labelled_nodes else None
+        if label_entity is None or len(output) != int(data['num_' + label_entity]):
+            print_failure('The masking of the halo nodes requires the output label ' + self.output_name +
+                          ' to be defined in all the nodes of an entity.')
+
+        label_mask = self.__get_interior_nodes(G, label_entity, len(output))
+        data['label_mask'] = label_mask
+        return data, np.asarray(output)[label_mask]
+
+    def __sample_subgraphs(self, G, data, output):
+        """
+        Neighbor sampling (GraphSAGE-like): the labelled nodes are split randomly into batches of seed_nodes seeds. For
+        each batch, the message passing is traversed backwards (from the last stage of the last iteration), and each node
+        needed so far samples (only once) up to the fanout of the iteration of its incoming edges of each edge type. The
+        subgraph keeps these edges and their nodes (with remapped indices), and its label_mask marks the seeds, which are
+        the only nodes whose predictions are compared with the labels.
+
+        Parameters
+        ----------
+        G:    networkx.DiGraph
+            Graph of the sample (with the nodes already relabelled as entity_index)
+        data:    dict
+            Processed sample
+        output:    [array]
+            Labels of the sample (one for each node of the labelled entity)
+        """
+
+        labelled_nodes = list(nx.get_node_attributes(G, self.output_name))
+        if len(labelled_nodes) == 0:
+            print_failure('The neighbor sampling requires the output label ' + self.output_name +
+                          ' to be defined in the nodes of the graph.')
+        label_entity = G.nodes[labelled_nodes[0]]['entity']
+        num_nodes = {name: int(data['num_' + name]) for name in self.entity_names}
+        if len(output) != num_nodes[label_entity]:
+            print_failure('The neighbor sampling requires the output label ' + self.output_name +
+                          ' to be defined in all the nodes of the entity ' + label_entity + '.')
+
+        # adjacency of each edge type (e.g., link_to_path), with its edges sorted by destination
+        # the samples are loaded as multigraphs by default, whose edge attributes are keyed by (u, v, key)
+        edges = list(G.edges(keys=True)) if G.is_multigraph() else list(G.edges())
+        edge_types = np.array([G.nodes[e[0]]['entity'] + '_to_' + G.nodes[e[1]]['entity'] for e in edges])
+        adjacencies = {}
+        for key in data:
+            if key.startswith('src_'):
+                name = key[4:]
+                src, dst = np.asarray(data['src_' + name]), np.asarray(data['dst_' + name])
+                src_entity, dst_entity = name.split('_to_')
+                order = np.argsort(dst, kind='stable')
+                adjacencies[name] = {'src': src, 'dst': dst, 'seq': np.asarray(data['seq_' + name]),
+                                     'src_entity': src_entity, 'dst_entity': dst_entity, 'order': order,
+                                     'ptr': np.concatenate([[0], np.cumsum(np.bincount(dst, minlength=num_nodes[dst_entity]))]),
+                                     'positions': np.flatnonzero(edge_types == name)}
+
+        # owner of each of the other inputs: an entity (node attribute), the edges (edge attribute) or the graph
+        owners = {}
+        for name in chain(self.feature_names, self.additional_input):
+            node_attr = nx.get_node_attributes(G, name)
+            if len(node_attr) > 0:
+                owners[name] = G.nodes[next(iter(node_attr))]['entity']
+            else:
+                edge_attr = nx.get_edge_attributes(G, name)
+                if len(edge_attr) > 0:
+                    owners[name] = np.array([i for i, e in enumerate(edges) if e in edge_attr], dtype=np.int64)
+
+        # the seeds are only taken from the interior nodes (if the sample is a partition with halo nodes)
+        seeds_per_batch = self.sampling['seed_nodes']
+        interior = np.flatnonzero(self.__get_interior_nodes(G, label_entity, num_nodes[label_entity]))
+        permutation = self.sampling_rng.permutation(interior)
+        subgraphs = []
+        for start in range(0, len(permutation), seeds_per_batch):
+            seeds = permutation[start:start + seeds_per_batch]
+            needed = {name: np.zeros(n, dtype=bool) for name, n in num_nodes.items()}
+            needed[label_entity][seeds] = True
+            sampled = {name: np.zeros(num_nodes[adj['dst_entity']], dtype=bool) for name, adj in adjacencies.items()}
+            kept = {name: [] for name in adjacencies}
+
+            for iteration in reversed(range(self.sampling['iterations'])):
+                fanout = self.sampling['fanouts'][iteration]
+                for stage in reversed(self.sampling['stages']):
+                    for dst_entity, src_entities in stage:
+                        for src_entity in src_entities:
+                            name = src_entity + '_to_' + dst_entity
+                            if name not in adjacencies:
+                                continue
+                            adj = adjacencies[name]
+
+                            # destinations that have not sampled their incoming edges of this type yet
+                            dsts = np.flatnonzero(needed[dst_entity] & ~sampled[name])
+                            sampled[name][dsts] = True
+                            degrees = adj['ptr'][dsts + 1] - adj['ptr'][dsts]
+                            if degrees.sum() == 0:
+                                continue
+
+                            # candidate edges grouped by destination, each with a random rank within its group
+                            group = np.repeat(np.arange(len(dsts)), degrees)
+                            group_start = np.repeat(np.cumsum(degrees) - degrees, degrees)
+                            candidates = adj['order'][adj['ptr'][dsts][group] + np.arange(len(group)) - group_start]
+                            order = np.lexsort((self.sampling_rng.random(len(candidates)), group))
+                            selected = candidates[order][np.arange(len(order)) - group_start < fanout]
+
+                            kept[name].append(selected)
+                            needed[src_entity][adj['src'][selected]] = True
+
+            subgraphs.append(self.__build_subgraph(data, output, adjacencies, owners, needed, kept, label_entity, seeds))
+
+        return subgraphs
+
+    def __build_subgraph(self, data, output, adjacencies, owners, needed, kept, label_entity, seeds):
+        """
+        Parameters
+        ----------
+        data:    dict
+            Processed sample
+        output:    [array]
+            Labels of the sample
+        adjacencies:    dict
+            Adjacency of each edge type (sources, destinations, sequences and positions in the list of edges)
+        owners:    dict
+            Entity (or positions of the edges) of each of the node (or edge) inputs
+        needed:    dict
+            Mask of the nodes of each entity that belong to the subgraph
+        kept:    dict
+            Arrays with the edges of each edge type that belong to the subgraph
+        label_entity:    str
+            Name of the entity with the labels
+        seeds:    array
+            Indices of the seed nodes of the labelled entity
+        """
+
+        nodes = {name: np.flatnonzero(mask) for name, mask in needed.items()}
+        remap = {}
+        subgraph = {}
+        for name, node_ids in nodes.items():
+            remap[name] = np.full(len(needed[name]), -1, dtype=np.int64)
+            remap[name][node_ids] = np.arange(len(node_ids))
+            subgraph['num_' + name] = len(node_ids)
+            for key in [GLOBAL_ID_ATTRIBUTE + '_' + name, HALO_ATTRIBUTE + '_' + name]:
+                if key in data:
+                    subgraph[key] = np.asarray(data[key])[node_ids]
+
+        # edges of each type in their original order, and the new sequence numbers (the rank of each edge among the
+        # edges kept with the same destination, following the original order of all the types)
+        edge_positions = []
+        sequences = {}
+        for name, adj in adjacencies.items():
+            e = np.unique(np.concatenate(kept[name])) if kept[name] else np.zeros(0, dtype=np.int64)
+            subgraph['src_' + name] = remap[adj['src_entity']][adj['src'][e]]
+            subgraph['dst_' + name] = remap[adj['dst_entity']][adj['dst'][e]]
+            sequences.setdefault(adj['dst_entity'], []).append((name, subgraph['dst_' + name], adj['seq'][e]))
+            edge_positions.append(adj['positions'][e])
+
+        for dst_entity, parts in sequences.items():
+            dst = np.concatenate([p[1] for p in parts])
+            seq = np.concatenate([p[2] for p in parts])
+            order = np.lexsort((seq, dst))
+            counts = np.bincount(dst, minlength=subgraph['num_' + dst_entity])
+            ranks = np.empty(len(dst), dtype=np.int64)
+            ranks[order] = np.arange(len(dst)) - np.repeat(np.cumsum(counts) - counts, counts)
+            offset = 0
+            for name, part_dst, _ in parts:
+                subgraph['seq_' + name] = ranks[offset:offset + len(part_dst)]
+                offset += len(part_dst)
+
+        edge_positions = np.sort(np.concatenate(edge_positions)) if edge_positions else np.zeros(0, dtype=np.int64)
+        for name in chain(self.feature_names, self.additional_input):
+            value = data[name]
+            owner = owners.get(name)
+            if isinstance(owner, str):
+                value = np.asarray(value)[nodes[owner]]
+            elif owner is not None:
+                value = np.asarray(value)[np.searchsorted(owner, edge_positions[np.isin(edge_positions, owner)])]
+                if len(value) != len(edge_positions):
+                    print_failure('The edge input ' + name + ' of the sampled subgraph has ' + str(len(value)) +
+                                  ' values, but the subgraph keeps ' + str(len(edge_positions)) + ' edges. The '
+                                  'neighbor sampling requires the edge inputs to be defined in all the edges.')
+            subgraph[name] = value
+
+        # only the predictions of the seeds are compared with their labels
+        label_mask = np.isin(nodes[label_entity], seeds)
+        subgraph['label_mask'] = label_mask
+        labels = np.asarray(output)[nodes[label_entity][label_mask]]
+        return subgraph, labels
+
+    def __get_interleave_indices(self, interleave_definition, sizes, dst_entity):
+        """
+        Parameters
+        ----------
+        interleave_definition:    tuple
+            Names of the source entities, in the order in which their messages are interleaved
+        sizes:    tuple
+            Pairs (source entity, maximum number of messages to a destination) of each of the involved entities
+        dst_entity:    str
+            Name of the destination entity
+        """
+
+        # the indices only depend on the definition and the sizes, which are usually shared by many samples
+        key = (interleave_definition, sizes, dst_entity)
+        if key in self.interleave_cache:
+            self.interleave_cache.move_to_end(key)
         else:
-            return data
+            entity_ids = {src_entity: id for id, (src_entity, _) in enumerate(sizes)}
+            n_total = sum(size for _, size in sizes)
+
+            # repeat the definition (in a numeric format) until the total length, and then cut it
+            sequence = np.resize(np.array([entity_ids[e] for e in interleave_definition]), n_total)
+
+            # a stable argsort groups the positions of each entity, keeping their order
+            positions = np.argsort(sequence, kind='stable')
+            counts = np.bincount(sequence, minlength=len(sizes))
+            indices = np.split(positions, np.cumsum(counts)[:-1])
+
+            entity_indices = {'indices_' + src_entity + '_to_' + dst_entity: indices[id]
+                              for src_entity, id in entity_ids.items()}
+
+            # each distinct size adds arrays of its total length, so only the most recent ones are kept (as in the
+            # structure cache)
+            if self.structure_cache_size <= 0:
+                return entity_indices
+            self.interleave_cache[key] = entity_indices
+            while len(self.interleave_cache) > self.structure_cache_size:
+                self.interleave_cache.popitem(last=False)
+
+        return self.interleave_cache[key]
+
+    def merge_samples(self, samples, labels=None):
+        """
+        Parameters
+        ----------
+        samples:    [array]
+            Array of processed samples (dictionaries) to be merged into one single graph
+        labels:    [array]
+            Array with the label of each of the samples (if any)
+        """
+
+        if len(self.interleave_names) > 0:
+            print_failure('Samples using an interleave aggregation cannot be merged into one batch. '
+                          'Please use a batch size of 1.')
+
+        adjacencies = {'src_' + src + '_to_' + dst: (src, dst) for src in self.entity_names for dst in self.entity_names}
+        offsets = {name: 0 for name in self.entity_names}
+        merged = {}
+
+        for sample in samples:
+            for key, value in sample.items():
+                if key.startswith('num_'):
+                    continue
+
+                value = np.asarray(value)
+                # the indices are offset in int64, and cast back to the index type once merged (see __cast_indices)
+                if np.issubdtype(value.dtype, np.integer):
+                    value = value.astype(np.int64)
+                if key.startswith('src_') and key in adjacencies:
+                    value = value + offsets[adjacencies[key][0]]
+                elif key.startswith('dst_') and 'src_' + key[4:] in adjacencies:
+                    value = value + offsets[adjacencies['src_' + key[4:]][1]]
+
+                merged.setdefault(key, []).append(value)
+
+            # the indices of the next sample start after the nodes of the current one
+            for name in self.entity_names:
+                offsets[name] += sample['num_' + name]
+
+        merged = {key: np.concatenate(values, axis=0) for key, values in merged.items()}
+        for name in self.entity_names:
+            merged['num_' + name] = offsets[name]
+
+        if labels is not None:
+            merged['label_lens'] = np.array([len(l) for l in labels])
+            return self.__cast_indices((merged, list(chain.from_iterable(labels))), training=True)
+        return self.__cast_indices(merged, training=False)
+
+    def __cast_indices(self, processed_sample, training=None):
+        """
+        Parameters
+        ----------
+        processed_sample:    dict
+            Processed sample or batch (with its labels if training)
+        training:    bool
+            Indicates if the labels come with the sample (by default, if the generator is serving a training dataset)
+        """
+
+        if self.index_dtype == np.int64:
+            return processed_sample
+
+        training = self.training if training is None else training
+        data, labels = processed_sample if training else (processed_sample, None)
+        limits = np.iinfo(self.index_dtype)
+        cast = {}
+        for key, value in data.items():
+            # everything but the features and the mask of the labels is an index (or an additional integer input)
+            if key in self.feature_names or key == 'label_mask':
+                cast[key] = value
+                continue
+
+            value = np.asarray(value)
+            if value.dtype == self.index_dtype:
+                cast[key] = value
+                continue
+            if value.size > limits.max or (value.size > 0 and (value.max() > limits.max or value.min() < limits.min)):
+                print_failure('The input ' + key + ' does not fit in the index type ' + np.dtype(self.index_dtype).name +
+                              ' (a graph with more than ' + str(limits.max) + ' elements). Please use index_dtype: '
+                              'int64 in the train_options.yaml file.')
+            cast[key] = value.astype(self.index_dtype)
+
+        return (cast, labels) if training else cast
+
+    def __batch_samples(self, processed_samples, batch_size):
+        """
+        Parameters
+        ----------
+        processed_samples:    generator
+            Generator of processed samples
+        batch_size:    int
+            Number of samples merged into each batch
+        """
+
+        if batch_size == 1:
+            yield from processed_samples
+            return
+
+        batch = []
+        for processed_sample in processed_samples:
+            batch.append(processed_sample)
+            if len(batch) == batch_size:
+                yield self.__merge_batch(batch)
+                batch = []
+
+        if batch:
+            yield self.__merge_batch(batch)
+
+    def __merge_batch(self, batch):
+        """
+        Parameters
+        ----------
+        batch:    [array]
+            Array of processed samples (with their labels if training)
+        """
+
+        if self.training:
+            samples, labels = zip(*batch)
+            return self.merge_samples(samples, labels)
+        return self.merge_samples(batch)
 
     def generate_from_array(self,
                             data_samples,
@@ -255,7 +848,11 @@ class Generator:
                             interleave_names,
                             additional_input,
                             training,
-                            shuffle=False):
+                            shuffle=False,
+                            batch_size=1,
+                            sampling=None,
+                            mask_halo_nodes=False,
+                            historical_embeddings=False):
         """
         Parameters
         ----------
@@ -275,6 +872,14 @@ class Generator:
             Indicates if we are training, and thus a label is required.
         shuffle:    bool
            Shuffle parameter of the dataset
+        batch_size:    int
+            Number of samples merged into each served graph (disjoint union)
+        sampling:    dict
+            Options of the neighbor sampling of the training subgraphs (None to serve the full graphs)
+        mask_halo_nodes:    bool
+            Whether only the interior nodes of the partitions are compared with the labels
+        historical_embeddings:    bool
+            Whether the global ids and the halo hops of the nodes of each entity are served
         """
 
         data_samples = [json.loads(x) for x in data_samples]
@@ -284,11 +889,69 @@ class Generator:
         self.interleave_names = [[i[0], i[1]] for i in interleave_names]
         self.additional_input = [x for x in additional_input]
         self.training = training
+        self.__set_sampling(sampling)
+        self.mask_halo_nodes = mask_halo_nodes
+        self.historical_embeddings = historical_embeddings
+
+        yield from map(self.__cast_indices, self.__batch_samples(self.__process_array(data_samples), batch_size))
+
+    def process_samples(self,
+                        data_samples,
+                        entity_names,
+                        feature_names,
+                        output_name,
+                        interleave_names,
+                        additional_input,
+                        training,
+                        historical_embeddings=False):
+        """
+        Parameters
+        ----------
+        data_samples:    [array]
+           Array of samples (networkx node-link dictionaries) to be processed
+        entity_names: [array]
+            Name of the entities to be found in the dataset
+        feature_names:    [array]
+           Name of the features to be found in the dataset
+        output_name:    str
+           Name of the output data to be found in the dataset
+        interleave_names:    [array]
+           First parameter is the name of the interleave, and the second the destination entity
+        additional_input:    [array]
+           Name of other vectors that need to be retrieved because they appear in other parts of the model definition
+        training:     bool
+            Indicates if we are training, and thus a label is required.
+        historical_embeddings:    bool
+            Whether the global ids and the halo hops of the nodes of each entity are served
+        """
+
+        self.entity_names = [x for x in entity_names]
+        self.feature_names = [x for x in feature_names]
+        self.output_name = output_name
+        self.interleave_names = [[i[0], i[1]] for i in interleave_names]
+        self.additional_input = [x for x in additional_input]
+        self.training = training
+        self.sampling = None
+        self.mask_halo_nodes = False
+        self.historical_embeddings = historical_embeddings
+
+        return [self.__cast_indices(processed_sample) for processed_sample in self.__process_array(data_samples)]
+
+    def __process_array(self, data_samples):
+        """
+        Parameters
+        ----------
+        data_samples:    [array]
+           Array of samples to be processed
+        """
 
         for sample in data_samples:
             try:
                 processed_sample = self.__process_sample(sample)
-                yield processed_sample
+                if self.training and self.sampling is not None:
+                    yield from processed_sample  # one subgraph for each batch of seeds
+                else:
+                    yield processed_sample
 
             except StopIteration:
                 pass
@@ -310,7 +973,13 @@ class Generator:
                               interleave_names,
                               additional_input,
                               training,
-                              shuffle=False):
+                              shuffle=False,
+                              num_shards=1,
+                              shard_index=0,
+                              batch_size=1,
+                              sampling=None,
+                              mask_halo_nodes=False,
+                              historical_embeddings=False):
         """
         Parameters
         ----------
@@ -330,6 +999,18 @@ class Generator:
             Indicates if we are training, and thus a label is required.
         shuffle:    bool
            Shuffle parameter of the dataset
+        num_shards:    int
+            Number of shards in which the files of the dataset are split (or their samples, if there are fewer files than shards)
+        shard_index:    int
+            Index of the shard to be read (only the files of this shard are served)
+        batch_size:    int
+            Number of samples merged into each served graph (disjoint union)
+        sampling:    dict
+            Options of the neighbor sampling of the training subgraphs (None to serve the full graphs)
+        mask_halo_nodes:    bool
+            Whether only the interior nodes of the partitions are compared with the labels
+        historical_embeddings:    bool
+            Whether the global ids and the halo hops of the nodes of each entity are served
         """
 
         self.entity_names = entity_names
@@ -338,16 +1019,43 @@ class Generator:
         self.interleave_names = interleave_names
         self.additional_input = additional_input
         self.training = training
+        self.__set_sampling(sampling)
+        self.mask_halo_nodes = mask_halo_nodes
+        self.historical_embeddings = historical_embeddings
+
+        yield from map(self.__cast_indices,
+                       self.__batch_samples(self.__process_dataset(dir, shuffle, num_shards, shard_index), batch_size))
+
+    def __process_dataset(self, dir, shuffle, num_shards, shard_index):
+        """
+        Parameters
+        ----------
+        dir:    str
+           Path of the input dataset
+        shuffle:    bool
+           Shuffle parameter of the dataset
+        num_shards:    int
+            Number of shards in which the files of the dataset are split
+        shard_index:    int
+            Index of the shard to be read
+        """
 
         files = glob.glob(str(dir) + '/*.json') + glob.glob(str(dir) + '/*.tar.gz') + glob.glob(str(dir) + '/*.gml')
         # no elements found
         if files == []:
             raise Exception('The dataset located in  ' + dir + ' seems to contain no valid elements (json or .tar.gz)')
 
+        # each shard takes a disjoint subset of the files (sorted so that all the shards agree on the split).
+        # If there are fewer files than shards, every shard reads all the files and takes a disjoint subset of their samples
+        files = list(enumerate(sorted(files)))
+        shard_samples = num_shards > 1 and len(files) < num_shards
+        if num_shards > 1 and not shard_samples:
+            files = files[shard_index::num_shards]
+
         if shuffle:
             random.shuffle(files)
 
-        for sample_file in files:
+        for file_idx, sample_file in files:
             try:
                 if 'tar.gz' in sample_file:
                     tar = tarfile.open(sample_file, 'r:gz')  # read the tar files
@@ -362,9 +1070,14 @@ class Generator:
                 file_samples.read(1)
                 data = self.stream_read_json(file_samples)
 
-                while True:
-                    processed_sample = self.__process_sample(next(data), sample_file)
-                    yield processed_sample
+                for sample_idx, sample in enumerate(data, file_idx):
+                    if shard_samples and sample_idx % num_shards != shard_index:
+                        continue
+                    processed_sample = self.__process_sample(sample, sample_file)
+                    if self.training and self.sampling is not None:
+                        yield from processed_sample  # one subgraph for each batch of seeds
+                    else:
+                        yield processed_sample
 
             except StopIteration:
                 pass
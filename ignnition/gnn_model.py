@@ -22,17 +22,36 @@
 import tensorflow as tf
 from keras import backend as K
 from ignnition.mp_classes import *
-from functools import reduce
+from functools import reduce, partial
 from ignnition.utils import *
+from ignnition.profiling_classes import Phase_timer
+from ignnition.accumulation_classes import Gradient_accumulator
+from ignnition.partitioning import HALO_ATTRIBUTE, GLOBAL_ID_ATTRIBUTE
 
 
 class Gnn_model(tf.keras.Model):
     """
     Class that represents the final GNN
+
+    Attributes
+    ----------
+    timer:    Phase_timer
+        Timer of the phases of the forward pass (disabled by default, and only meaningful when executed eagerly)
+    recompute_message_passing:    str
+        Granularity (iteration or stage) of the checkpoints whose intermediate tensors are recomputed in the backward
+        pass instead of being kept in memory (None to keep all of them)
+    gradient_accumulator:    Gradient_accumulator
+        Accumulator of the gradients of several training steps before each update (None to update in every step)
+    historical_embeddings:    Historical_embeddings
+        Store of the hidden states of the nodes of the partitions, from which the states of the halo nodes are read
+        (None to use the states computed in the partition)
+
     Methods
     ----------
     call(self, input, training=False)
         Performs the GNN's action
+    train_step(self, data)
+        Performs a training step, accumulating the gradients if gradient_accumulation_steps is greater than one
     get_global_var_or_input(self, var_name, input)
         Obtains the global variable with var_name if exists, or the corresponding input
     save_global_variable(self, var_name, var_value)
@@ -41,12 +60,42 @@ class Gnn_model(tf.keras.Model):
         Obtains the global variable with the corresponding var_name
     """
 
-    def __init__(self, model_info):
+    def __init__(self, model_info, recompute_message_passing=None, gradient_accumulation_steps=1,
+                 historical_embeddings=None):
+        """
+        Parameters
+        ----------
+        model_info:    Yaml_preprocessing object
+            Object in charge of handling the information in the model_description.yaml file
+        recompute_message_passing:    str
+            Granularity (iteration or stage) of the recomputed checkpoints of the message passing (None to disable it)
+        gradient_accumulation_steps:    int
+            Number of training steps (micro-batches) whose gradients are accumulated before each update
+        historical_embeddings:    Historical_embeddings
+            Store of the hidden states of the nodes of the partitions (None to disable it)
+        """
+
         super(Gnn_model, self).__init__()
+        if recompute_message_passing not in [None, 'iteration', 'stage']:
+            print_failure('The option recompute_message_passing must be either "iteration" or "stage", but "' +
+                          str(recompute_message_passing) + '" was found.')
+        self.recompute_message_passing = recompute_message_passing
+        if int(gradient_accumulation_steps) < 1:
+            print_failure('The option gradient_accumulation_steps must be a positive integer, but "' +
+                          str(gradient_accumulation_steps) + '" was found.')
+        if int(gradient_accumulation_steps) > 1 and tf.distribute.has_strategy():
+            print_failure('The option gradient_accumulation_steps is not supported together with a '
+                          'distribution_strategy.')
+        self.gradient_accumulator = Gradient_accumulator(int(gradient_accumulation_steps)) if int(
+            gradient_accumulation_steps) > 1 else None
+        if historical_embeddings is not None and tf.distribute.has_strategy():
+            print_failure('The historical_embeddings are not supported together with a distribution_strategy.')
+        self.historical_embeddings = historical_embeddings
         self.model_info = model_info
         self.dimensions = self.model_info.get_input_dimensions()
         self.instances_per_stage = self.model_info.get_mp_instances()
         self.calculations = {}
+        self.timer = Phase_timer(enabled=False)
         with tf.name_scope('model_initializations') as _:
             entities = model_info.entities
             for entity in entities:
@@ -118,9 +167,14 @@ class Gnn_model(tf.keras.Model):
                             output_shape = F_dst  # by default we don't change the shape of the final output
 
                             if aggregation.type == 'attention':
+                                if F_src % aggregation.num_heads != 0:
+                                    print_failure(
+                                        'When using an attention with several heads, the dimension of the messages should be divisible by the number of heads. '
+                                        'In this case, however, the dimension is ' + str(F_src) + ' and the number of heads is ' + str(aggregation.num_heads) + '.')
+
                                 self.node_kernel = self.add_weight(shape=(F_src, F_src),
                                                                    initializer=aggregation.weight_initialization)
-                                self.attn_kernel = self.add_weight(shape=(2 * F_dst, 1),
+                                self.attn_kernel = self.add_weight(shape=(2 * F_dst, aggregation.num_heads),
                                                                    initializer=aggregation.weight_initialization)
 
                             elif aggregation.type == 'edge_attention':
@@ -262,8 +316,11 @@ class Gnn_model(tf.keras.Model):
             entities = self.model_info.entities
 
             # Initialize all the hidden states for all the nodes.
-            with tf.name_scope('states_creation') as _:
+            # checkpoint_names: the tensors created here, which are the inputs and outputs of the recomputed checkpoints
+            checkpoint_names = []
+            with tf.name_scope('states_creation') as _, self.timer.phase('states_creation'):
                 for entity in entities:
+                    self.timer.record_sizes('states_creation', **{'nodes_' + entity.name: f_['num_' + entity.name]})
                     with tf.name_scope(str(entity.name) ) as _:
                         counter = 0
                         operations = entity.operations
@@ -276,308 +333,63 @@ class Gnn_model(tf.keras.Model):
                                     output = op.apply_nn(hs_creator, self.calculations, f_)
 
                                     save_global_variable(self.calculations, op.output_name, output)
+                                    checkpoint_names.append(op.output_name)
 
                             elif op.type == 'build_state':
                                 with tf.name_scope('build_state' + str(counter)) as _:
                                     state = op.calculate_hs(self.calculations, f_)
                                     save_global_variable(self.calculations, entity.name, state)
                                     save_global_variable(self.calculations, entity.name + '_initial_state', state)
+                                    checkpoint_names += [entity.name, entity.name + '_initial_state']
                             counter += 1
 
+            # readout_names: the other tensors read by the readout, which are also outputs of the recomputed
+            # checkpoints if the message passing saves them
+            readout_names = []
+            for op in self.model_info.get_readout_operations():
+                for name in getattr(op, 'input', None) or []:
+                    if isinstance(name, str) and name not in checkpoint_names + readout_names:
+                        readout_names.append(name)
+
             # -----------------------------------------------------------------------------------
             # MESSAGE PASSING PHASE
-            with tf.name_scope('message_passing') as _:
+            # normalizations of the convolutions, which only depend on the adjacencies (shared by all the iterations)
+            conv_normalizations = {}
+            with tf.name_scope('message_passing') as _, self.timer.phase('message_passing'):
+                message_passing_stage = self.__message_passing_stage
+                exchange_historical_embeddings = self.__exchange_historical_embeddings
+                use_history = self.historical_embeddings is not None and all(
+                    GLOBAL_ID_ATTRIBUTE + '_' + entity.name in f_ for entity in entities)
+                if use_history:
+                    # the store is looked up when the function runs (not when it is traced), so that it can be replaced
+                    tf.numpy_function(lambda training_: self.historical_embeddings.next_step(training_),
+                                      [tf.cast(training, tf.bool)], tf.int64)
                 for j in range(self.model_info.get_mp_iterations()):
 
                     with tf.name_scope('iteration_' + str(j)) as _:
-                        num_instances_per_stage = len(self.instances_per_stage)
-                        for idx_stage in range(num_instances_per_stage):
-                            stage = self.instances_per_stage[idx_stage]
-                            step_name = stage[0]
-
-                            with tf.name_scope(step_name) as _:
-                                # given one message from a given step
-                                msgs_stage = stage[1]
-                                num_msgs_stage = len(msgs_stage)
-                                for idx_msg in range(num_msgs_stage):
-                                    mp = msgs_stage[idx_msg]
-                                    dst_name = mp.destination_entity
-                                    dst_states = get_global_variable(self.calculations, dst_name)
-                                    num_dst = f_['num_' + dst_name]
-
-                                    # with tf.name_scope('mp_to_' + dst_name + 's') as _:
-                                    with tf.name_scope(mp.source_entities[0].name + 's_to_' + dst_name + 's') as _:
-                                        first_src = True
-                                        with tf.name_scope('message') as _:
-                                            for src in mp.source_entities:
-                                                src_name = src.name
-
-                                                # prepare the information
-                                                src_idx, dst_idx, seq = f_.get(
-                                                    'src_' + src_name + '_to_' + dst_name), f_.get(
-                                                    'dst_' + src_name + '_to_' + dst_name), f_.get(
-                                                    'seq_' + src_name + '_to_' + dst_name)
-
-                                                src_idx = tf.squeeze(src_idx)
-                                                dst_idx = tf.squeeze(dst_idx)
-                                                seq = tf.squeeze(seq)
-
-                                                src_states = get_global_variable(self.calculations, str(src_name))
-
-                                                with tf.name_scope(
-                                                        'create_message_' + src_name + '_to_' + dst_name) as _:
-
-                                                    self.src_messages = tf.gather(src_states, src_idx)
-                                                    self.dst_messages = tf.gather(dst_states, dst_idx)
-                                                    message_creation_models = src.message_formation
-
-                                                    # by default, the source hs are the messages
-                                                    result = self.src_messages
-                                                    counter = 0
-
-                                                    for op in message_creation_models:
-                                                        if op is not None:  # if it is not direct_assignation
-                                                            type_operation = op.type
-
-                                                            if type_operation == 'neural_network':
-                                                                with tf.name_scope('apply_nn_' + str(counter)) as _:
-                                                                    # careful. This name could overlap with another model
-                                                                    var_name = src_name + "_to_" + dst_name + '_message_creation_' + str(
-                                                                        counter)
-                                                                    message_creator = get_global_variable(
-                                                                        self.calculations, var_name)
-                                                                    result = op.apply_nn_msg(message_creator,
-                                                                                             self.calculations, f_,
-                                                                                             self.src_messages,
-                                                                                             self.dst_messages)
-
-                                                            elif type_operation == 'product':
-                                                                with tf.name_scope(
-                                                                        'apply_product_' + str(counter)) as _:
-                                                                    product_input1 = self.treat_message_function_input(
-                                                                        op.input[0], f_)
-
-                                                                    product_input2 = self.treat_message_function_input(
-                                                                        op.input[1], f_)
-                                                                    result = op.calculate(product_input1,
-                                                                                          product_input2)
-
-                                                            if op.output_name is not None:
-                                                                save_global_variable(self.calculations,
-                                                                                     op.output_name, result)
-                                                        final_messages = result
-                                                        counter += 1
-
-                                                    # PREPARE FOR THE AGGREGATION
-                                                    with tf.name_scope(
-                                                            'combine_messages_' + src_name + '_to_' + dst_name) as _:
-                                                        ids = tf.stack([dst_idx, seq], axis=1)
-
-                                                        lens = tf.math.unsorted_segment_sum(tf.ones_like(dst_idx),
-                                                                                            dst_idx, num_dst)
-
-                                                        # only a few aggregations actually needed to keep the order
-                                                        max_len = tf.reduce_max(seq) + 1
-
-                                                        message_dim = int(get_global_variable(self.calculations,
-                                                                                              "final_message_dim_" + str(
-                                                                                                  idx_stage) + '_' + str(
-                                                                                                  idx_msg)))
-
-                                                        shape = tf.stack([num_dst, max_len, message_dim])
-                                                        s = tf.scatter_nd(ids, final_messages,
-                                                                          shape)  # find the input ordering it by sequence
-
-                                                        aggr = mp.aggregations
-                                                        if isinstance(aggr, Concat_aggr):
-                                                            with tf.name_scope("concat_" + src_name) as _:
-                                                                if first_src:
-                                                                    src_input = s
-                                                                    final_len = lens
-                                                                    first_src = False
-                                                                else:
-                                                                    src_input = tf.concat([src_input, s],
-                                                                                          axis=aggr.concat_axis)
-                                                                    if aggr.concat_axis == 1:  # if axis=2, then the number of messages received is the same. Simply create bigger messages
-                                                                        final_len += lens
-
-                                                        elif isinstance(aggr, Interleave_aggr):
-                                                            with tf.name_scope('add_' + src_name) as _:
-                                                                indices_source = f_.get(
-                                                                    "indices_" + src_name + '_to_' + dst_name)
-                                                                if first_src:
-                                                                    first_src = False
-                                                                    src_input = s  # destinations x max_of_sources_to_dest x dim_source
-                                                                    indices = indices_source
-                                                                    final_len = lens
-                                                                else:
-                                                                    # destinations x max_of_sources_to_dest_concat x dim_source
-                                                                    src_input = tf.concat([src_input, s], axis=1)
-                                                                    indices = tf.stack([indices, indices_source],
-                                                                                       axis=0)
-                                                                    final_len = tf.math.add(final_len, lens)
-
-
-                                                        # if we must aggregate them together into a single embedding (sum, attention, edge_attention, ordered)
-                                                        # the pipeline will either use the operations below or from above.
-                                                        else:
-                                                            # obtain the overall input of each of the destinations
-                                                            if first_src:
-                                                                first_src = False
-                                                                src_input = s  # destinations x sources_to_dest x dim_source
-                                                                comb_src_states, comb_dst_idx, comb_seq = final_messages, dst_idx, seq  # we need this for the attention and convolutional mechanism
-                                                                final_len = lens
-
-                                                            else:
-                                                                # destinations x max_of_sources_to_dest_concat x dim_source
-                                                                src_input = tf.concat([src_input, s], axis=1)
-                                                                comb_src_states = tf.concat(
-                                                                    [comb_src_states, final_messages],
-                                                                    axis=0)
-                                                                comb_dst_idx = tf.concat([comb_dst_idx, dst_idx],
-                                                                                         axis=0)
-
-                                                                aux_lens = tf.gather(final_len,
-                                                                                     dst_idx)  # lens of each src-dst value
-                                                                aux_seq = seq + aux_lens  # sum to the sequences the current length for each dest
-                                                                comb_seq = tf.concat([comb_seq, aux_seq], axis=0)
-
-                                                                final_len = tf.math.add(final_len, lens)
-
-                                        # --------------
-                                        # perform the actual aggregation
-                                        aggrs = mp.aggregations
-
-                                        # if ordered, we dont need to do anything. Already in the right shape
-                                        # It only makes sense to do a pipeline with sum/attention/edge... operations??
-                                        with tf.name_scope('aggregation') as _:
-                                            for aggr in aggrs:
-                                                with tf.name_scope(aggr.type) as _:
-                                                    if aggr.type == 'sum':
-                                                        src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
-                                                                                         num_dst)
-
-                                                    elif aggr.type == 'mean':
-                                                        src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
-                                                                                     num_dst)
-
-                                                    elif aggr.type == 'min':
-                                                        src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
-                                                                                     num_dst)
-
-                                                    elif aggr.type == 'max':
-                                                        src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
-                                                                                     num_dst)
-
-                                                    elif aggr.type == 'std':
-                                                        src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
-                                                                                     num_dst)
-
-                                                    elif aggr.type == 'attention':
-                                                        src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
-                                                                                     dst_states,
-                                                                                     comb_seq, num_dst,
-                                                                                     self.node_kernel,
-                                                                                     self.attn_kernel)
-
-                                                    elif aggr.type == 'edge_attention':
-                                                        var_name = 'edge_attention_' + src_name + '_to_' + dst_name
-                                                        edge_att_model = get_global_variable(self.calculations,
-                                                                                             var_name)
-                                                        comb_dst_states = tf.gather(dst_states,
-                                                                                    comb_dst_idx)  # the destination state of each adjacency
-                                                        model_input = tf.concat([comb_src_states, comb_dst_states],
-                                                                                axis=1)
-
-                                                        # define the shape of the input
-                                                        dimension = self.dimensions[src_name] + self.dimensions[dst_name]
-                                                        model_input = tf.ensure_shape(model_input, [None, dimension] )
-
-                                                        weights = edge_att_model(model_input)
-                                                        src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
-                                                                                         num_dst,
-                                                                                         weights)
-
-                                                    # convolutional aggregation (the messages sent by the destination must have the same shape as the destinations)
-                                                    elif aggr.type == 'convolution':
-                                                        src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
-                                                                                         dst_states,
-                                                                                         num_dst, self.conv_kernel)
-
-                                                    elif aggr.type == 'interleave':
-                                                        src_input = aggr.calculate_input(src_input, indices)
-
-                                                    elif aggr.type == 'neural_network':
-                                                        # concatenate in the axis 0 all the input tensors
-                                                        var_name = 'aggr_nn'
-                                                        aggregator_nn = get_global_variable(self.calculations, var_name)
-                                                        src_input = aggr.apply_nn(aggregator_nn, self.calculations, f_)
-
-                                                # save the result of this operation with its output_name
-                                                if aggr.output_name is not None:
-                                                    save_global_variable(self.calculations, aggr.output_name,
-                                                                         src_input)
-
-                                            # this is the final one that passes to the update
-                                            # save the src_input used for the update
-                                            save_global_variable(self.calculations, 'update_lens_' + dst_name,
-                                                                 final_len)
-                                            save_global_variable(self.calculations, 'update_input_' + dst_name,
-                                                                 src_input)
-
-                                # ---------------------------------------
-                                # updates
-                                with tf.name_scope('updates') as _:
-                                    for mp in stage[1]:
-                                        dst_name = mp.destination_entity
-                                        with tf.name_scope('update_' + dst_name + 's') as _:
-                                            update_model = mp.update
-                                            src_input = get_global_variable(self.calculations,
-                                                                            'update_input_' + dst_name)
-                                            old_state = get_global_variable(self.calculations, dst_name)
-
-                                            # by default use the aggregated messages as new state
-                                            # This should only be compatible with sum/attention/convolution (obtain a single tensor)
-                                            if update_model is None:
-                                                new_state = src_input
-
-                                            # recurrent update
-                                            elif isinstance(update_model, RNN_operation):
-                                                model = get_global_variable(self.calculations, dst_name + '_update')
-                                                if not mp.aggregations_global_type:
-                                                    dst_dim = int(self.dimensions[
-                                                                      dst_name])  # should this be the source dimensions??? CHECK
-                                                    new_state = update_model.model.perform_unsorted_update(model,
-                                                                                                           src_input,
-                                                                                                           old_state,
-                                                                                                           dst_dim)
-
-                                                # if the aggregation was ordered or concat
-                                                else:
-                                                    final_len = get_global_variable(self.calculations,
-                                                                                    'update_lens_' + dst_name)
-                                                    new_state = update_model.model.perform_sorted_update(model,
-                                                                                                         src_input,
-                                                                                                         dst_name,
-                                                                                                         old_state,
-                                                                                                         final_len)
-
-                                            # feed-forward update:
-                                            # restriction: It can only be used if the aggreagation was not ordered.
-                                            else:
-                                                var_name = dst_name + "_ff_update"
-                                                update = get_global_variable(self.calculations, var_name)
-
-                                                # now we need to obtain for each adjacency the concatenation of the source and the destination
-                                                update_input = tf.concat([src_input, old_state], axis=1)
-                                                new_state = update(update_input)
-
-                                            # update the old state
-                                            save_global_variable(self.calculations, dst_name, new_state)
+                        stages = [partial(message_passing_stage, f_, idx_stage, conv_normalizations) for idx_stage in
+                                  range(len(self.instances_per_stage))]
+
+                        # after each stage, the states of its halo nodes are replaced by the stored ones, and the
+                        # states of its interior nodes are stored
+                        if use_history:
+                            stages = [partial(exchange_historical_embeddings, stage, f_, j, idx_stage, training) for
+                                      idx_stage, stage in enumerate(stages)]
+
+                        # optionally, the intermediate tensors of each iteration (or stage) are recomputed in the
+                        # backward pass instead of being kept in memory
+                        if self.recompute_message_passing == 'iteration':
+                            self.__recompute_checkpoint(stages, checkpoint_names, readout_names)
+                        else:
+                            for stage in stages:
+                                if self.recompute_message_passing == 'stage':
+                                    self.__recompute_checkpoint([stage], checkpoint_names, readout_names)
+                                else:
+                                    stage()
 
             # -----------------------------------------------------------------------------------
             # READOUT PHASE
-            with tf.name_scope('readout_predictions') as _:
+            with tf.name_scope('readout_predictions') as _, self.timer.phase('readout_predictions'):
                 readout_operations = self.model_info.get_readout_operations()
                 counter = 0
                 n = len(readout_operations)
@@ -587,7 +399,15 @@ class Gnn_model(tf.keras.Model):
                         if operation.type == 'neural_network':
                             var_name = 'readout_model_' + str(counter)
                             readout_nn = get_global_variable(self.calculations, var_name)
-                            result = operation.apply_nn(readout_nn, self.calculations, f_, readout=True)
+                            if operation.factorized:
+                                # the inputs extended over an adjacency are transformed before being gathered
+                                parts = [(get_global_var_or_input(self.calculations, operation.node_inputs[i][0], f_),
+                                          f_[operation.node_inputs[i][1]]) if i in operation.node_inputs else
+                                         get_global_var_or_input(self.calculations, i.split('_initial_state')[0], f_)
+                                         for i in operation.input]
+                                result = operation.apply_nn_factorized(readout_nn, parts)
+                            else:
+                                result = operation.apply_nn(readout_nn, self.calculations, f_, readout=True)
 
                         elif operation.type == "pooling":
                             # obtain the input of the pooling operation
@@ -622,12 +442,443 @@ class Gnn_model(tf.keras.Model):
                         # output of the readout
                         if operation.type != 'extend_adjacencies':
                             if j == n - 1:  # last one
+                                # sampled subgraph: only the predictions of the seeds are compared with the labels
+                                if 'label_mask' in f_:
+                                    result = tf.boolean_mask(result, f_['label_mask'])
                                 return result
                             else:
                                 save_global_variable(self.calculations, operation.output_name, result)
 
                     counter += 1
 
+    def train_step(self, data):
+        """
+        Parameters
+        ----------
+        data:    tuple
+            Features and labels (and optionally sample weights) of the micro-batch
+        """
+
+        if self.gradient_accumulator is None:
+            return super(Gnn_model, self).train_step(data)
+
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+
+        # the optimizer is only updated (and thus its learning-rate schedule only advances) once every
+        # gradient_accumulation_steps micro-batches
+        gradients = tape.gradient(loss, self.trainable_variables)
+        self.gradient_accumulator.accumulate(gradients, self.trainable_variables, self.optimizer)
+
+        self.compiled_metrics.update_state(y, y_pred, sample_weight)
+        return {m.name: m.result() for m in self.metrics}
+
+    @tf.autograph.experimental.do_not_convert
+    def __exchange_historical_embeddings(self, stage, f_, iteration, idx_stage, training):
+        """
+        Parameters
+        ----------
+        stage:    function
+            Function that performs the stage
+        f_:    dict
+            Dictionary with all the tensors with the input information of the model
+        iteration:    int
+            Index of the message-passing iteration
+        idx_stage:    int
+            Index of the stage within the iteration
+        training:    bool
+            Indicates if the states of the interior nodes must be stored
+        """
+
+        stage()
+        with tf.name_scope('historical_embeddings'):
+            entity_names = list(dict.fromkeys(message.destination_entity for message in
+                                              self.instances_per_stage[idx_stage][1]))
+            states = [get_global_variable(self.calculations, name) for name in entity_names]
+            inputs = [tf.cast(training, tf.bool)]
+            for name, state in zip(entity_names, states):
+                inputs += [f_[GLOBAL_ID_ATTRIBUTE + '_' + name], f_[HALO_ATTRIBUTE + '_' + name], state]
+
+            # the stored states are constants (no gradient flows to the partitions where they were computed)
+            slot = iteration * len(self.instances_per_stage) + idx_stage
+            outputs = tf.numpy_function(lambda *args: self.historical_embeddings.exchange(slot, entity_names, *args),
+                                        inputs, [t for state in states for t in (state.dtype, tf.bool)])
+            for k, (name, state) in enumerate(zip(entity_names, states)):
+                history, valid = outputs[2 * k], outputs[2 * k + 1]
+                history.set_shape(state.shape)
+                valid.set_shape([None])
+                save_global_variable(self.calculations, name, tf.where(tf.expand_dims(valid, -1), history, state))
+
+    @tf.autograph.experimental.do_not_convert
+    def __message_passing_stage(self, f_, idx_stage, conv_normalizations):
+        """
+        Performs one stage of a message-passing iteration (the message creation and aggregation of each of its
+        message-passings, and then the updates of the destinations), reading and saving the hidden states in
+        self.calculations
+
+        Parameters
+        ----------
+        f_:    dict
+            Dictionary with all the tensors with the input information of the model
+        idx_stage:    int
+            Index of the stage
+        conv_normalizations:    dict
+            Normalizations of the convolutions already computed in this forward pass, indexed by phase name
+        """
+
+        stage = self.instances_per_stage[idx_stage]
+        step_name = stage[0]
+
+        with tf.name_scope(step_name) as _:
+            # given one message from a given step
+            msgs_stage = stage[1]
+            num_msgs_stage = len(msgs_stage)
+            for idx_msg in range(num_msgs_stage):
+                mp = msgs_stage[idx_msg]
+                dst_name = mp.destination_entity
+                dst_states = get_global_variable(self.calculations, dst_name)
+                num_dst = f_['num_' + dst_name]
+
+                # with tf.name_scope('mp_to_' + dst_name + 's') as _:
+                phase_name = 'message_passing/' + step_name + '/' + mp.source_entities[
+                    0].name + 's_to_' + dst_name + 's'
+                with tf.name_scope(mp.source_entities[0].name + 's_to_' + dst_name + 's') as _:
+                    first_src = True
+                    src_adjacencies = []
+                    with tf.name_scope('message') as _, self.timer.phase(phase_name + '/message'):
+                        for src in mp.source_entities:
+                            src_name = src.name
+
+                            # prepare the information
+                            src_idx, dst_idx, seq = f_.get(
+                                'src_' + src_name + '_to_' + dst_name), f_.get(
+                                'dst_' + src_name + '_to_' + dst_name), f_.get(
+                                'seq_' + src_name + '_to_' + dst_name)
+
+                            src_idx = tf.squeeze(src_idx)
+                            dst_idx = tf.squeeze(dst_idx)
+                            seq = tf.squeeze(seq)
+                            src_adjacencies.append((src_idx, f_['num_' + src_name]))
+
+                            src_states = get_global_variable(self.calculations, str(src_name))
+
+                            with tf.name_scope(
+                                    'create_message_' + src_name + '_to_' + dst_name) as _:
+
+                                # only the gathers needed by the message creation or the aggregation (see Yaml_preprocessing)
+                                self.src_messages = tf.gather(src_states, src_idx) if src.gathers_source else None
+                                self.dst_messages = tf.gather(dst_states, dst_idx) if (
+                                        src.gathers_destination or mp.gathers_edge_destinations) else None
+                                message_creation_models = src.message_formation
+
+                                # by default, the source hs are the messages
+                                result = self.src_messages
+                                counter = 0
+
+                                for op in message_creation_models:
+                                    if op is not None:  # if it is not direct_assignation
+                                        type_operation = op.type
+
+                                        if type_operation == 'neural_network':
+                                            with tf.name_scope('apply_nn_' + str(counter)) as _:
+                                                # careful. This name could overlap with another model
+                                                var_name = src_name + "_to_" + dst_name + '_message_creation_' + str(
+                                                    counter)
+                                                message_creator = get_global_variable(
+                                                    self.calculations, var_name)
+                                                if op.factorized:
+                                                    parts = [(src_states, src_idx) if i == 'source' else
+                                                             (dst_states, dst_idx) if i == 'destination' else
+                                                             get_global_var_or_input(self.calculations, i, f_)
+                                                             for i in op.input]
+                                                    result = op.apply_nn_factorized(message_creator, parts)
+                                                else:
+                                                    result = op.apply_nn_msg(message_creator,
+                                                                             self.calculations, f_,
+                                                                             self.src_messages,
+                                                                             self.dst_messages)
+
+                                        elif type_operation == 'product':
+                                            with tf.name_scope(
+                                                    'apply_product_' + str(counter)) as _:
+                                                product_input1 = self.treat_message_function_input(
+                                                    op.input[0], f_)
+
+                                                product_input2 = self.treat_message_function_input(
+                                                    op.input[1], f_)
+                                                result = op.calculate(product_input1,
+                                                                      product_input2)
+
+                                        if op.output_name is not None:
+                                            save_global_variable(self.calculations,
+                                                                 op.output_name, result)
+                                    final_messages = result
+                                    counter += 1
+
+                                self.timer.record_sizes(phase_name + '/message', edges=tf.size(src_idx),
+                                                        message_bytes=tf.size(final_messages) *
+                                                                      final_messages.dtype.size)
+
+                                # PREPARE FOR THE AGGREGATION
+                                with tf.name_scope(
+                                        'combine_messages_' + src_name + '_to_' + dst_name) as _:
+                                    ids = tf.stack([dst_idx, seq], axis=1)
+
+                                    lens = tf.math.unsorted_segment_sum(tf.ones_like(dst_idx),
+                                                                        dst_idx, num_dst)
+
+                                    # only a few aggregations actually needed to keep the order
+                                    max_len = tf.reduce_max(seq) + 1
+
+                                    message_dim = int(get_global_variable(self.calculations,
+                                                                          "final_message_dim_" + str(
+                                                                              idx_stage) + '_' + str(
+                                                                              idx_msg)))
+
+                                    shape = tf.stack([num_dst, max_len, message_dim])
+                                    s = tf.scatter_nd(ids, final_messages,
+                                                      shape)  # find the input ordering it by sequence
+
+                                    # the first aggregation determines how the messages are combined (none if ordered)
+                                    aggr = mp.aggregations[0] if mp.aggregations else None
+                                    if isinstance(aggr, Concat_aggr):
+                                        with tf.name_scope("concat_" + src_name) as _:
+                                            if first_src:
+                                                src_input = s
+                                                final_len = lens
+                                                first_src = False
+                                            else:
+                                                src_input = tf.concat([src_input, s],
+                                                                      axis=aggr.concat_axis)
+                                                if aggr.concat_axis == 1:  # if axis=2, then the number of messages received is the same. Simply create bigger messages
+                                                    final_len += lens
+
+                                    elif isinstance(aggr, Interleave_aggr):
+                                        with tf.name_scope('add_' + src_name) as _:
+                                            indices_source = f_.get(
+                                                "indices_" + src_name + '_to_' + dst_name)
+                                            if first_src:
+                                                first_src = False
+                                                src_input = s  # destinations x max_of_sources_to_dest x dim_source
+                                                indices = indices_source
+                                                final_len = lens
+                                            else:
+                                                # destinations x max_of_sources_to_dest_concat x dim_source
+                                                src_input = tf.concat([src_input, s], axis=1)
+                                                indices = tf.concat([indices, indices_source],
+                                                                    axis=0)
+                                                final_len = tf.math.add(final_len, lens)
+
+
+                                    # if we must aggregate them together into a single embedding (sum, attention, edge_attention, ordered)
+                                    # the pipeline will either use the operations below or from above.
+                                    else:
+                                        # obtain the overall input of each of the destinations
+                                        if first_src:
+                                            first_src = False
+                                            src_input = s  # destinations x sources_to_dest x dim_source
+                                            comb_src_states, comb_dst_idx, comb_seq = final_messages, dst_idx, seq  # we need this for the attention and convolutional mechanism
+                                            comb_dst_states = self.dst_messages
+                                            final_len = lens
+
+                                        else:
+                                            # destinations x max_of_sources_to_dest_concat x dim_source
+                                            src_input = tf.concat([src_input, s], axis=1)
+                                            comb_src_states = tf.concat(
+                                                [comb_src_states, final_messages],
+                                                axis=0)
+                                            comb_dst_idx = tf.concat([comb_dst_idx, dst_idx],
+                                                                     axis=0)
+                                            if mp.gathers_edge_destinations:
+                                                comb_dst_states = tf.concat(
+                                                    [comb_dst_states, self.dst_messages], axis=0)
+
+                                            aux_lens = tf.gather(final_len,
+                                                                 dst_idx)  # lens of each src-dst value
+                                            aux_seq = seq + aux_lens  # sum to the sequences the current length for each dest
+                                            comb_seq = tf.concat([comb_seq, aux_seq], axis=0)
+
+                                            final_len = tf.math.add(final_len, lens)
+
+                    # --------------
+                    # perform the actual aggregation
+                    aggrs = mp.aggregations
+
+                    # if ordered, we dont need to do anything. Already in the right shape
+                    # It only makes sense to do a pipeline with sum/attention/edge... operations??
+                    with tf.name_scope('aggregation') as _, self.timer.phase(phase_name + '/aggregation'):
+                        for aggr in aggrs:
+                            with tf.name_scope(aggr.type) as _:
+                                if aggr.type == 'sum':
+                                    src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
+                                                                     num_dst)
+
+                                elif aggr.type == 'mean':
+                                    src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
+                                                                 num_dst)
+
+                                elif aggr.type == 'min':
+                                    src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
+                                                                 num_dst)
+
+                                elif aggr.type == 'max':
+                                    src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
+                                                                 num_dst)
+
+                                elif aggr.type == 'std':
+                                    src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
+                                                                 num_dst)
+
+                                elif aggr.type == 'attention':
+                                    src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
+                                                                 dst_states,
+                                                                 comb_seq, num_dst,
+                                                                 self.node_kernel,
+                                                                 self.attn_kernel)
+
+                                elif aggr.type == 'edge_attention':
+                                    var_name = 'edge_attention_' + src_name + '_to_' + dst_name
+                                    edge_att_model = get_global_variable(self.calculations,
+                                                                         var_name)
+                                    if aggr.aggr_model.factorized:
+                                        # the destination hs are transformed before being gathered for every edge
+                                        weights = aggr.aggr_model.apply_nn_factorized(
+                                            edge_att_model, [comb_src_states, (dst_states, comb_dst_idx)])
+                                    else:
+                                        # comb_dst_states: the destination state of each adjacency (already gathered by the message creation)
+                                        model_input = tf.concat([comb_src_states, comb_dst_states],
+                                                                axis=1)
+
+                                        # define the shape of the input
+                                        dimension = self.dimensions[src_name] + self.dimensions[dst_name]
+                                        model_input = tf.ensure_shape(model_input, [None, dimension] )
+
+                                        weights = edge_att_model(model_input)
+                                    src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
+                                                                     num_dst,
+                                                                     weights)
+
+                                # convolutional aggregation (the messages sent by the destination must have the same shape as the destinations)
+                                elif aggr.type == 'convolution':
+                                    if phase_name not in conv_normalizations:
+                                        conv_normalizations[phase_name] = aggr.get_normalization(
+                                            src_adjacencies, comb_dst_idx, num_dst)
+                                    src_input = aggr.calculate_input(comb_src_states, comb_dst_idx,
+                                                                     dst_states,
+                                                                     num_dst, self.conv_kernel,
+                                                                     conv_normalizations[phase_name])
+
+                                elif aggr.type == 'interleave':
+                                    src_input = aggr.calculate_input(src_input, indices)
+
+                                elif aggr.type == 'neural_network':
+                                    # concatenate in the axis 0 all the input tensors
+                                    var_name = 'aggr_nn'
+                                    aggregator_nn = get_global_variable(self.calculations, var_name)
+                                    src_input = aggr.apply_nn(aggregator_nn, self.calculations, f_)
+
+                            # save the result of this operation with its output_name
+                            if aggr.output_name is not None:
+                                save_global_variable(self.calculations, aggr.output_name,
+                                                     src_input)
+
+                        # this is the final one that passes to the update
+                        # save the src_input used for the update
+                        save_global_variable(self.calculations, 'update_lens_' + dst_name,
+                                             final_len)
+                        save_global_variable(self.calculations, 'update_input_' + dst_name,
+                                             src_input)
+
+            # ---------------------------------------
+            # updates
+            with tf.name_scope('updates') as _:
+                for mp in stage[1]:
+                    dst_name = mp.destination_entity
+                    with tf.name_scope('update_' + dst_name + 's') as _, self.timer.phase(
+                            'message_passing/' + step_name + '/update_' + dst_name + 's'):
+                        update_model = mp.update
+                        src_input = get_global_variable(self.calculations,
+                                                        'update_input_' + dst_name)
+                        old_state = get_global_variable(self.calculations, dst_name)
+
+                        # by default use the aggregated messages as new state
+                        # This should only be compatible with sum/attention/convolution (obtain a single tensor)
+                        if update_model is None:
+                            new_state = src_input
+
+                        # recurrent update
+                        elif isinstance(update_model, RNN_operation):
+                            model = get_global_variable(self.calculations, dst_name + '_update')
+                            if not mp.aggregations_global_type:
+                                dst_dim = int(self.dimensions[
+                                                  dst_name])  # should this be the source dimensions??? CHECK
+                                new_state = update_model.model.perform_unsorted_update(model,
+                                                                                       src_input,
+                                                                                       old_state,
+                                                                                       dst_dim)
+
+                            # if the aggregation was ordered or concat
+                            else:
+                                final_len = get_global_variable(self.calculations,
+                                                                'update_lens_' + dst_name)
+                                new_state = update_model.model.perform_sorted_update(model,
+                                                                                     src_input,
+                                                                                     dst_name,
+                                                                                     old_state,
+                                                                                     final_len)
+
+                        # feed-forward update:
+                        # restriction: It can only be used if the aggreagation was not ordered.
+                        else:
+                            var_name = dst_name + "_ff_update"
+                            update = get_global_variable(self.calculations, var_name)
+
+                            # now we need to obtain for each adjacency the concatenation of the source and the destination
+                            update_input = tf.concat([src_input, old_state], axis=1)
+                            new_state = update(update_input)
+
+                        # update the old state
+                        save_global_variable(self.calculations, dst_name, new_state)
+
+    def __recompute_checkpoint(self, stages, checkpoint_names, output_names):
+        """
+        Performs the stages as a single checkpoint of tf.recompute_grad, so that their intermediate tensors (gathered
+        states, messages, aggregations and activations) are not kept for the backward pass, but recomputed from the
+        hidden states at the start of the checkpoint.
+
+        Parameters
+        ----------
+        stages:    list
+            Functions that perform each of the stages (in order)
+        checkpoint_names:    list
+            Names of the tensors of self.calculations that are the inputs and outputs of the checkpoint
+        output_names:    list
+            Names of other tensors that are used after the message passing (i.e., by the readout). Those that the
+            stages save are also outputs of the checkpoint, so that their gradient flows back through it. Any other
+            tensor saved by the stages is only meant to be used within the checkpoint
+        """
+
+        # names of output_names saved by the stages (found in the forward pass, and kept for the recomputation)
+        saved_names = []
+
+        def checkpoint(*states):
+            for name, state in zip(checkpoint_names, states):
+                save_global_variable(self.calculations, name, state)
+            previous = {name: self.calculations.get(name) for name in output_names}
+            for stage in stages:
+                stage()
+            if not saved_names:
+                saved_names.extend([name for name in output_names if self.calculations.get(name) is not
+                                    previous[name]])
+            return [get_global_variable(self.calculations, name) for name in checkpoint_names + saved_names]
+
+        states = [get_global_variable(self.calculations, name) for name in checkpoint_names]
+        new_states = tf.recompute_grad(checkpoint)(*states)
+        for name, state in zip(checkpoint_names + saved_names, new_states):
+            save_global_variable(self.calculations, name, state)
+
     def treat_message_function_input(self, var_name, f_):
         if var_name == 'source':
             new_input = self.src_messages
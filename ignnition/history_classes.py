@@ -0,0 +1,188 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+
+from ignnition.utils import print_failure
+
+
+class Historical_embeddings:
+    """
+    Class that stores (in memory-mapped files) the hidden state of every node of a graph after each stage of the
+    message passing, keyed by the global id of the node (see ignnition.partitioning). When training on the partitions
+    of a graph, the states of the halo nodes (which lack part of their neighborhood) are read from the store instead
+    of using the ones recomputed in the partition, and the states of the interior nodes are written back, so that the
+    partitions see their out-of-partition context as of the last time it was computed (GNNAutoScale).
+    Each stored state keeps the training step in which it was written, so that the states older than max_staleness
+    steps are not used, and the staleness of the states read is tracked.
+
+    Attributes
+    ----------
+    path:    str
+        Directory of the memory-mapped files (one file of states and one of steps for each entity)
+    num_slots:    int
+        Number of states stored for each node (one for each stage of each message-passing iteration)
+    max_staleness:    int
+        Maximum number of training steps since a state was written for it to be used (None for no limit)
+    step:    int
+        Number of training steps (forward passes with training=True) seen so far
+    write_inference:    bool
+        Whether the interior states are also written in the forward passes without training (e.g., to cache the states
+        of a base prediction)
+    states:    dict
+        Memory-mapped array of states (nodes x slots x dimension) of each entity
+    steps:    dict
+        Memory-mapped array with the training step in which each state was written (-1 if never) of each entity
+    staleness:    dict
+        Statistics of the halo states of each entity read in the last exchange
+
+    Methods:
+    ----------
+    next_step(self, training)
+        Starts a new forward pass, which is a new training step if training
+    exchange(self, slot, entity_names, training, *inputs)
+        Returns the stored states of the halo nodes (and the mask of the valid ones), and writes the interior states
+    get_staleness(self)
+        Returns the statistics of the halo states read in the last exchange
+    __ensure_capacity(self, entity, num_nodes, dimension)
+        Enlarges the memory-mapped arrays of an entity so that they can store the given number of nodes
+    """
+
+    def __init__(self, path, num_slots, max_staleness=None, write_inference=False):
+        """
+        Parameters
+        ----------
+        path:    str
+            Directory of the memory-mapped files (the files of a previous execution are overwritten)
+        num_slots:    int
+            Number of states stored for each node (e.g., the number of iterations times the number of stages)
+        max_staleness:    int
+            Maximum number of training steps since a state was written for it to be used (None for no limit)
+        write_inference:    bool
+            Whether the interior states are also written in the forward passes without training
+        """
+
+        self.path = path
+        self.num_slots = int(num_slots)
+        self.max_staleness = None if max_staleness is None else int(max_staleness)
+        self.step = 0
+        self.write_inference = write_inference
+        self.states = {}
+        self.steps = {}
+        self.staleness = {}
+        os.makedirs(path, exist_ok=True)
+
+    def next_step(self, training):
+        """
+        Parameters
+        ----------
+        training:    bool
+            Indicates if the forward pass is a training step (whose interior states are stored)
+        """
+
+        if training:
+            self.step += 1
+        return np.int64(self.step)
+
+    def exchange(self, slot, entity_names, training, *inputs):
+        """
+        Parameters
+        ----------
+        slot:    int
+            Index of the stored state (stage of a message-passing iteration) that is exchanged
+        entity_names:    [str]
+            Names of the entities, in the order of the inputs
+        training:    bool
+            Indicates if the forward pass is a training step (whose interior states are written)
+        inputs:    [array]
+            Global ids, halo hops and states of the nodes of each entity (three arrays per entity)
+        """
+
+        outputs = []
+        for k, entity in enumerate(entity_names):
+            global_ids, halo_hops, state = inputs[3 * k: 3 * k + 3]
+            if len(global_ids) == 0:
+                outputs += [np.zeros_like(state), np.zeros(0, dtype=bool)]
+                continue
+            self.__ensure_capacity(entity, int(global_ids.max()) + 1, state.shape[-1])
+
+            # the states of the halo nodes that were written (recently enough) as interior nodes of another partition
+            halo = halo_hops > 0
+            written = self.steps[entity][global_ids, slot]
+            valid = halo & (written >= 0)
+            if self.max_staleness is not None:
+                valid &= self.step - written <= self.max_staleness
+            history = np.where(valid[:, None], self.states[entity][global_ids, slot], 0).astype(state.dtype)
+
+            self.staleness[entity] = {'halo_nodes': int(halo.sum()),
+                                      'from_history': int(valid.sum()),
+                                      'mean_staleness': float(np.mean(self.step - written[valid])) if valid.any()
+                                      else 0.0}
+
+            if training or self.write_inference:
+                interior = ~halo
+                self.states[entity][global_ids[interior], slot] = state[interior]
+                self.steps[entity][global_ids[interior], slot] = self.step
+
+            outputs += [history, valid]
+
+        return outputs
+
+    def get_staleness(self):
+        return dict(self.staleness)
+
+    def __ensure_capacity(self, entity, num_nodes, dimension):
+        """
+        Parameters
+        ----------
+        entity:    str
+            Name of the entity
+        num_nodes:    int
+            Number of nodes (maximum global id plus one) to be stored
+        dimension:    int
+            Dimension of the hidden states of the entity
+        """
+
+        capacity = self.states[entity].shape[0] if entity in self.states else 0
+        if num_nodes <= capacity:
+            return
+        if capacity > 0 and self.states[entity].shape[2] != dimension:
+            print_failure('The hidden states of the entity ' + entity + ' stored in the historical embeddings have '
+                          'dimension ' + str(self.states[entity].shape[2]) + ', but ' + str(dimension) +
+                          ' was found.')
+
+        # the arrays grow geometrically. Since the nodes are the first dimension, the stored rows keep their position
+        new_capacity = max(num_nodes, 2 * capacity)
+        for arrays, name, dtype, shape, fill in [
+                (self.states, entity + '_states.dat', np.float32, (self.num_slots, dimension), 0),
+                (self.steps, entity + '_steps.dat', np.int64, (self.num_slots,), -1)]:
+            file_name = os.path.join(self.path, name)
+            if capacity == 0:
+                array = np.memmap(file_name, dtype=dtype, mode='w+', shape=(new_capacity,) + shape)
+            else:
+                arrays[entity].flush()
+                del arrays[entity]
+                with open(file_name, 'r+b') as f:
+                    f.truncate(int(np.prod((new_capacity,) + shape)) * np.dtype(dtype).itemsize)
+                array = np.memmap(file_name, dtype=dtype, mode='r+', shape=(new_capacity,) + shape)
+            array[capacity:] = fill
+            arrays[entity] = array
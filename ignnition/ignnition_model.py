@@ -19,11 +19,14 @@
 # -*- coding: utf-8 -*-
 
 import tensorflow as tf
+import copy
 import datetime
 import warnings
+import tempfile
 import glob
 import tarfile
 import json
+import time
 from tensorflow.keras.losses import *
 from tensorflow.keras.optimizers import *
 from tensorflow.keras.optimizers.schedules import *
@@ -31,11 +34,21 @@ import os
 from ignnition.gnn_model import Gnn_model
 from ignnition.yaml_preprocessing import Yaml_preprocessing
 from ignnition.data_generator import Generator
+from ignnition.normalization_classes import *
+from ignnition.metric_classes import Streaming_metric
+from ignnition.profiling_classes import Phase_timer
+from ignnition.history_classes import Historical_embeddings
+from ignnition.cache_classes import Prediction_cache, hash_features, hash_sample
+from ignnition.partitioning import HALO_ATTRIBUTE, GLOBAL_ID_ATTRIBUTE, build_partition, get_changed_nodes, \
+    get_affected_nodes
+from ignnition.aggregation_classes import Conv_aggr
 from ignnition.utils import *
 from ignnition.custom_callbacks import *
 import sys
 import yaml
 import collections
+import multiprocessing
+import concurrent.futures
 import networkx as nx
 from networkx.readwrite import json_graph
 from itertools import chain
@@ -57,23 +70,47 @@ class Ignnition_model:
         Object which is in charge of handling all the information of the model_description file.
     generator: Generator obj
         Object in charge of feeding the data to the model.
+    train_function:    tf.function
+        Compiled train step reused by train_step (created on its first call)
+    predict_functions:    dict
+        Compiled forward passes of one sample (with and without the ids of the nodes), reused by the incremental inference
+    incremental_base:    dict
+        Base sample of the incremental inference, with its predictions and the time of its full forward pass
+    incremental_store:    Historical_embeddings
+        Cache of the hidden states of the base sample of the incremental inference
+    index_dtype:    tf.DType
+        Type of the indices of the graphs (defined by index_dtype in the train_options.yaml file): int64 by default, or int32 to halve their memory
+    prediction_cache:    Prediction_cache
+        LRU cache of the predictions of the graphs (defined by prediction_cache in the train_options.yaml file), or None if disabled
+    weights_version:    int
+        Counter of the changes of the weights outside of the optimizer (restored checkpoints) and of the calls to train_step
+    prediction_cache_version:    tuple
+        Version of the weights (number of weights, iterations of the optimizer and weights_version) to which the prediction cache is bound
+    strategy:    tf.distribute.Strategy
+        Distribution strategy under which the model is created and trained (defined by distribution_strategy in the train_options.yaml file)
 
     Methods:
     ----------
+    __create_strategy(self)
+        Creates the distribution strategy (default, mirrored or multi-worker mirrored, whose cluster is defined by the TF_CONFIG environment variable).
+
     __process_path(self, path)
         This method takes as input a path and, considering the location of the model directory, converts all the relative path to absolute paths starting from such model_directory
 
     __loss_function(self, labels, predictions)
-       Function that calls executes the loss function object from the keras libarary if specified. O/w it looks for a custom loss function specified in the module file.
+       Function that calls executes the loss function object from the keras libarary if specified. O/w it looks for a custom loss function specified in the module file (executed in graph mode if it is traceable).
 
     __get_keras_metrics(self)
         Creates all the keras metrics corresponding to tf.keras objects, or it creates objects based on custom function specified in the module path.
 
+    __get_py_function_metric(self, name, metric_function)
+        Wraps a custom metric which is not traceable with tf.py_function (fallback), measuring its overhead.
+
     __get_compiled_model(self, model_info)
         Compiles the tf model with all the corresponding options
 
     __get_model_callbacks(self, output_path, mini_epoch_size, num_epochs, metric_names)
-        Creates all the callbacks (these being the k-best (if specified), model checkpoints, and tensorboard)
+        Creates all the callbacks (these being the asynchronous model checkpoints keeping the k-best (if specified), and tensorboard as defined in the tensorboard section of the train_options.yaml file)
 
     __batch_normalization(self, x, feature_list, y=None)
         Performs batch normalization on the data (e.g., normalizes all the batch by its max, min..)
@@ -81,7 +118,40 @@ class Ignnition_model:
     __global_normalization(self, x, feature_list, output_name, y=None)
         Performs a global normalization operation which must be specified in the module path (all the samples are normalized according to the same criteria).
 
-    __input_fn_generator(self, filenames=None, shuffle=False, training=True,data_samples=None, iterator=False)
+    __declarative_normalization(self, x, feature_list, output_name, y=None)
+        Performs the global normalization defined in the normalization section of the train_options.yaml file (computed with pure tensorflow operations).
+
+    __denormalize_output(self, pred, output_name)
+        Transforms the predictions (or labels) back to the original scale of the output label.
+
+    __normalize(self, x, feature_list, output_name, y)
+        Applies to one sample the same normalization as the input pipeline.
+
+    __get_statistics_names(self)
+        Returns the names of the features and of the output label whose statistics are computed.
+
+    __load_statistics(self)
+        Returns the statistics of the training set saved by compute_statistics, failing if they are missing or were computed for another dataset or features.
+
+    __get_normalizations(self)
+        Returns the normalizations defined in the normalization section of the train_options.yaml file (created on their first use), or None if disabled.
+
+    __get_historical_embeddings(self, model_info)
+        Returns the store of the historical embeddings of the partitions (defined by historical_embeddings in the train_options.yaml file), or None if disabled.
+
+    __get_sampling_options(self)
+        Returns the options of the neighbor sampling of the training subgraphs (defined by sampling in the train_options.yaml file), or None if disabled.
+
+    __get_index_dtype(self)
+        Returns the type of the indices of the graphs (defined by index_dtype in the train_options.yaml file).
+
+    __get_input_signature(self, training=True, batch_size=1, node_ids=False, label_mask=False)
+        Returns the types and shapes of the input tensors of the model (as served by the generator).
+
+    __get_mp_stages(self)
+        Returns the message passings of each stage, as pairs (destination entity, [source entities]).
+
+    __input_fn_generator(self, filenames=None, shuffle=False, training=True,data_samples=None, iterator=False, sampling=False)
         Method that creates the dataset which is served by the generator that we created before.
 
     __create_model(self)
@@ -96,20 +166,74 @@ class Ignnition_model:
     find_dataset_dimensions(self, path=None, samples=None)
         Looks for the first training samples and processes it to extract the dimensions of all the input tensors (necessary to create the GNN model)s
 
+    __distribute_input(self, filenames, shuffle, data_samples, sampling=False)
+        Creates the distributed dataset, where each worker serves its own shard of the data.
+
+    build_gnn(self, samples=None, path=None, verbose=True)
+        Public method callable by the user that creates the GNN model (if not created yet), e.g., to train it with a custom loop or benchmark.
+
+    get_dataset(self, path=None, samples=None, training=True, shuffle=False, repeat=True, iterator=False, distribute=False)
+        Public method callable by the user that returns the input pipeline of a dataset (or array of samples), as served to the model.
+
     train_and_validate(self, training_samples=None, eval_samples=None)
         Public operation that is called by the user to initiate a training and validation operation of the current GNN model.
 
     predict(self, prediction_samples=None, verbose=True)
         Public operation that is callable by the user to initiate a predict operatio of a given array of data/dataset using the current GNN model.
 
+    set_base_sample(self, sample, verbose=False)
+        Public method callable by the user that predicts a base sample, caching the hidden states of its nodes after every stage of the message passing.
+
+    predict_incremental(self, sample, max_affected_fraction=0.5)
+        Public method callable by the user that predicts a modified version of the base sample, recomputing only the nodes affected by the modifications.
+
+    __get_incremental_limitation(self)
+        Returns the reason why the predictions of the model cannot be computed incrementally (or None if they can).
+
+    __predict_sample(self, sample, store=None)
+        Returns the predictions of one sample with a compiled forward pass.
+
+    __process_prediction_sample(self, sample, node_ids=False)
+        Returns the processed tensors (before the normalization) of one sample to be predicted.
+
+    __predict_features(self, features, store=None)
+        Returns the predictions of the processed tensors of one sample.
+
+    __cached_predict(self, prediction_path, prediction_samples)
+        Returns the predictions of the samples, reusing the ones stored in the prediction cache.
+
+    __bind_prediction_cache(self)
+        Binds the prediction cache to the current weights of the model (hashing them only if their version changed).
+
+    __create_prediction_cache(self)
+        Creates the prediction cache (defined by prediction_cache in the train_options.yaml file), or None if disabled.
+
+    __get_predict_function(self, node_ids)
+        Creates (only once for each input signature) the compiled forward pass of one sample.
+
     computational_graph(self)
         Public method callable by the user to create a computation graph of the desired model which can be then used for debugging purposes.
 
-    evaluate(self, evaluation_samples = None, verbose=True)
+    evaluate(self, evaluation_samples = None, verbose=True, compiled=False, batch_size=1, return_samples=False, quantiles=None)
         Public method callable by the user that executes an evaluation functionality given some metrics.
 
+    __compiled_evaluation(self, data_path, evaluation_samples, metric_func, batch_size, return_samples, quantiles)
+        Evaluates the model as a compiled loop over (batched) graphs, accumulating the metric with streaming state.
+
     batch_training(self, input_samples)
         Public method callable by the user, useful in RL context, to execute a training of a single batch of data. No verbosite is set.
+
+    train_step(self, samples)
+        Public method callable by the user, useful in RL context, that applies one gradient update on the batch (disjoint union) of the given samples with a compiled train function, and returns the loss.
+
+    __get_train_function(self)
+        Creates (only once) the compiled train function used by train_step.
+
+    profile(self, samples=None, path=None, num_steps=20, output_path=None)
+        Public method callable by the user that measures the time of each phase of the input pipeline and of the forward pass (per message-passing stage and edge type), with the sizes of the tensors, and reports whether the training is input-bound or compute-bound.
+
+    compute_statistics(self, path=None, samples=None, num_workers=None, quantiles=None, save=True)
+        Public method callable by the user that computes the statistics (mean, std, min, max, quantiles) of every feature and of the output label in one single pass over the training set, and saves them in a cache file reused by the normalization (they must be computed before using a normalization section that leaves some parameters undefined).
     """
 
     def __init__(self, model_dir):
@@ -134,14 +258,55 @@ class Ignnition_model:
         tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
         warnings.filterwarnings("ignore")
 
+        # the strategy must be created before any other tensorflow operation (required by the multi-worker strategy)
+        self.strategy = self.__create_strategy()
+
         # add the file with any additional function, if any
         if 'additional_functions_file' in self.CONFIG:
             additional_path = self.__process_path(self.CONFIG['additional_functions_file'])
-            sys.path.insert(1, additional_path)
+            sys.path.insert(1, os.path.dirname(additional_path))
             self.module = __import__(additional_path.split('/')[-1][0:-3])
 
         self.model_info = self.__create_model()
         self.generator = Generator()
+        self.generator.structure_cache_size = int(self.CONFIG.get('structure_cache_size', 16))
+        self.index_dtype = self.__get_index_dtype()
+        self.generator.index_dtype = self.index_dtype.as_numpy_dtype
+        if self.CONFIG.get('sampling', None) is not None:
+            # created only once (and shared by the generators of all the pipelines), so that every epoch samples
+            # different subgraphs
+            self.generator.sampling_rng = np.random.default_rng(self.CONFIG['sampling'].get('seed', None))
+        self.py_function_overhead = Py_function_overhead()
+        self.train_function = None
+        self.predict_functions = {}
+        self.incremental_base = None
+        self.incremental_store = None
+        self.prediction_cache = self.__create_prediction_cache()
+        self.weights_version = 0
+        self.prediction_cache_version = None
+
+        # declarative normalization (if any), computed inside the input pipeline with pure tf operations. It is
+        # created on its first use (see __get_normalizations), so that its statistics can be computed beforehand
+        self.normalizations = None
+        if self.CONFIG.get('normalization', None) is not None and \
+                self.CONFIG.get('batch_normalization', None) is not None:
+            print_failure('The normalization and batch_normalization options cannot be used together. Please '
+                          'remove one of them from the train_options.yaml file.')
+
+    def __create_strategy(self):
+        strategy_type = self.CONFIG.get('distribution_strategy', None)
+        if strategy_type is None:
+            return tf.distribute.get_strategy()  # default strategy (no distribution)
+
+        elif strategy_type == 'mirrored':
+            return tf.distribute.MirroredStrategy()
+
+        elif strategy_type == 'multi_worker':
+            # the cluster (and the task of this process) is read from the TF_CONFIG environment variable
+            return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+
+        print_failure('The distribution_strategy "' + str(strategy_type) +
+                      '" is not valid. Please use one of: mirrored, multi_worker.')
 
     def __process_path(self, path):
         """
@@ -152,6 +317,57 @@ class Ignnition_model:
         """
         return os.path.normpath(os.path.join(self.model_dir, path))
 
+    def __get_statistics_path(self):
+        if 'statistics_file' in self.CONFIG:
+            return self.__process_path(self.CONFIG['statistics_file'])
+        return os.path.join(self.__process_path(self.CONFIG.get('output_path', './')), 'statistics.json')
+
+    def __get_statistics_names(self):
+        """
+        Returns the names of the features and of the output label whose statistics are computed
+        """
+
+        return sorted(self.model_info.get_all_features() + [self.model_info.get_output_info()])
+
+    def __load_statistics(self):
+        """
+        Returns the cached statistics of the training set, which must have been computed (with compute_statistics) over the same dataset and features as the current model
+        """
+
+        statistics_path = self.__get_statistics_path()
+        if not os.path.isfile(statistics_path):
+            print_failure('The normalization requires the statistics of the training set, but no statistics file was '
+                          'found in ' + statistics_path + '. Please compute them first with compute_statistics().')
+
+        with open(statistics_path, 'r') as f:
+            content = json.load(f)
+
+        # the statistics computed over an array of samples (without dataset) are always accepted
+        train_path = self.__process_path(self.CONFIG['train_dataset'])
+        if not isinstance(content, dict) or 'statistics' not in content or \
+                content.get('dataset', None) not in [None, train_path] or \
+                content.get('features', None) != self.__get_statistics_names():
+            print_failure('The statistics file ' + statistics_path + ' was not computed over the current training '
+                          'dataset (' + train_path + ') and features of the model. Please compute them again with '
+                          'compute_statistics().')
+        return content['statistics']
+
+    def __get_normalizations(self):
+        """
+        Returns the normalizations of the normalization section of the train_options.yaml file (creating them on the first call), or None if there is no such section
+        """
+
+        if self.CONFIG.get('normalization', None) is None:
+            return None
+
+        if self.normalizations is None:
+            statistics = None
+            # the parameters which are not defined explicitly are taken from the statistics of the training set
+            if requires_statistics(self.CONFIG['normalization']):
+                statistics = self.__load_statistics()
+            self.normalizations = create_normalizations(self.CONFIG['normalization'], statistics)
+        return self.normalizations
+
     def __loss_function(self, labels, predictions):
         """
         Parameters
@@ -163,15 +379,22 @@ class Ignnition_model:
         """
 
         loss_func_name = self.CONFIG['loss']
-        try:
+        if hasattr(tf.keras.losses, loss_func_name):
             loss_function = getattr(tf.keras.losses, loss_func_name)()
             regularization_loss = sum(self.gnn_model.losses)
             loss = loss_function(labels, predictions)
             total_loss = loss + regularization_loss
 
-        except:  # go to the main file and find the function by this name
+        else:  # go to the main file and find the function by this name
             loss_function = getattr(self.module, loss_func_name)
-            total_loss = tf.py_function(func=loss_function, inp=[predictions, labels, self.gnn_model], Tout=tf.float32)
+            if is_traceable(loss_function):
+                # executed inside the compiled train step
+                total_loss = loss_function(predictions, labels, self.gnn_model)
+            else:
+                # explicit fallback: the function is executed by the python interpreter at every step
+                timed_loss = self.py_function_overhead.wrap(loss_func_name,
+                                                            lambda p, l: loss_function(p, l, self.gnn_model))
+                total_loss = tf.py_function(func=timed_loss, inp=[predictions, labels], Tout=tf.float32)
 
         return total_loss
 
@@ -182,10 +405,34 @@ class Ignnition_model:
             if hasattr(tf.keras.metrics, name):
                 metrics.append(getattr(tf.keras.metrics, name)())
             elif hasattr(self.module, name):
-                metrics.append(getattr(self.module, name))
+                metric_function = getattr(self.module, name)
+                if is_traceable(metric_function):
+                    metrics.append(metric_function)
+                else:
+                    metrics.append(self.__get_py_function_metric(name, metric_function))
 
         return metrics
 
+    def __get_py_function_metric(self, name, metric_function):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the custom metric
+        metric_function:    function
+            Custom python function (not traceable) that computes the metric
+        """
+
+        print_info('The metric "' + name + '" is not decorated with @ignnition.traceable. '
+                   'It will be executed through tf.py_function.')
+        timed_metric = self.py_function_overhead.wrap(name, metric_function)
+
+        def metric(labels, predictions):
+            return tf.py_function(func=timed_metric, inp=[labels, predictions], Tout=tf.float32)
+
+        metric.__name__ = name
+        return metric
+
     @tf.autograph.experimental.do_not_convert
     def __get_compiled_model(self, model_info):
         """
@@ -195,7 +442,9 @@ class Ignnition_model:
             Object in charge of handling the information in the model_description.yaml file
         """
 
-        gnn_model = Gnn_model(model_info)
+        gnn_model = Gnn_model(model_info, recompute_message_passing=self.CONFIG.get('recompute_message_passing', None),
+                              gradient_accumulation_steps=self.CONFIG.get('gradient_accumulation_steps', 1),
+                              historical_embeddings=self.__get_historical_embeddings(model_info))
 
         # dynamically define the optimizer
         optimizer_params = self.CONFIG['optimizer']
@@ -234,11 +483,23 @@ class Ignnition_model:
         os.mkdir(output_path + '/ckpt')
 
         # HERE WE CAN ADD AN OPTION FOR EARLY STOPPING
-        return [tf.keras.callbacks.TensorBoard(log_dir=output_path + '/logs', update_freq='epoch', write_images=False,
-                                               histogram_freq=1),
-                tf.keras.callbacks.ModelCheckpoint(filepath=output_path + '/ckpt/weights.{epoch:02d}-{loss:.2f}.hdf5',
-                                                   save_freq='epoch', monitor='loss'),
-                K_best(output_path=output_path + '/logs', k=self.CONFIG.get('k_best', None))]
+        callbacks = [Async_checkpoint(output_path=output_path + '/ckpt', k=self.CONFIG.get('k_best', None),
+                                      monitor='val_loss'),
+                     self.py_function_overhead]
+
+        # tensorboard logging (histograms of the weights and profiling of the steps are disabled by default)
+        tensorboard = self.CONFIG.get('tensorboard', None) or {}
+        if str_to_bool(str(tensorboard.get('enabled', True))):
+            profile_batch = tensorboard.get('profile_batch', 0)
+            if isinstance(profile_batch, list):  # range [start, stop] of the steps to be traced
+                profile_batch = tuple(profile_batch)
+
+            callbacks.insert(0, tf.keras.callbacks.TensorBoard(log_dir=output_path + '/logs',
+                                                               update_freq=tensorboard.get('update_freq', 'epoch'),
+                                                               histogram_freq=int(tensorboard.get('histogram_freq', 0)),
+                                                               profile_batch=profile_batch,
+                                                               write_images=False))
+        return callbacks
 
     # here we pass a mini-batch. We want to be able to perform a normalization over each mini-batch seperately
     def __batch_normalization(self, x, feature_list, norm_type, y=None):
@@ -323,8 +584,204 @@ class Ignnition_model:
             return x, y
         return x
 
+    def __declarative_normalization(self, x, feature_list, output_name, y=None):
+        """
+        Parameters
+        ----------
+        x:    tensor
+            Tensor with the feature information
+        feature_list:    tensor
+            List of names with the names of the features in x
+        output_names:    tensor
+            List of names with the name of the output labels in y
+        y:    tensor
+            Tensor with the label information
+        """
+
+        # input data
+        for f_name in feature_list:
+            if f_name in self.normalizations:
+                x[f_name] = self.normalizations[f_name].normalize(x.get(f_name))
+
+        # output
+        if y is not None:
+            if output_name in self.normalizations:
+                y = self.normalizations[output_name].normalize(y)
+            return x, y
+        return x
+
+    def __denormalize_output(self, pred, output_name):
+        """
+        Parameters
+        ----------
+        pred:    tensor
+            Tensor with the predictions (or labels) to be denormalized
+        output_name:    str
+            Name of the output label
+        """
+
+        normalizations = self.__get_normalizations()
+        if normalizations is not None:
+            if output_name in normalizations:
+                pred = normalizations[output_name].denormalize(pred)
+            return pred
+
+        try:
+            denorm_func = getattr(self.module, 'denormalization')
+        except:
+            return pred
+
+        try:
+            pred = tf.py_function(func=denorm_func, inp=[pred, output_name], Tout=tf.float32)
+        except:
+            print_failure('The denormalization function failed')
+        return pred
+
+    def __normalize(self, x, feature_list, output_name, y):
+        """
+        Parameters
+        ----------
+        x:    tensor
+            Tensor with the feature information
+        feature_list:    tensor
+            List of names with the names of the features in x
+        output_name:    str
+            Name of the output label
+        y:    tensor
+            Tensor with the label information
+        """
+
+        # same normalization as the one applied by the input pipeline
+        if self.__get_normalizations() is not None:
+            return self.__declarative_normalization(x, feature_list, output_name, y)
+        elif self.CONFIG.get('batch_normalization', None) is None:
+            return self.__global_normalization(x, feature_list, output_name, y)
+        return self.__batch_normalization(x, feature_list, self.CONFIG['batch_normalization'], y)
+
+    def __get_historical_embeddings(self, model_info):
+        """
+        Parameters
+        ----------
+        model_info:    Yaml_preprocessing object
+            Object in charge of handling the information in the model_description.yaml file
+        """
+
+        options = self.CONFIG.get('historical_embeddings', None)
+        if options is None:
+            return None
+
+        path = self.__process_path(options.get('path', os.path.join(self.CONFIG.get('output_path', './'),
+                                                                    'historical_embeddings')))
+        num_slots = int(model_info.get_mp_iterations()) * len(model_info.get_mp_instances())
+        return Historical_embeddings(path, num_slots, options.get('max_staleness', None))
+
+    def __get_sampling_options(self):
+        sampling = self.CONFIG.get('sampling', None)
+        if sampling is None:
+            return None
+
+        if self.model_info.get_interleave_tensors():
+            print_failure('The neighbor sampling cannot be used together with an interleave aggregation.')
+
+        if 'seed_nodes' not in sampling or 'fanout' not in sampling:
+            print_failure('The sampling options must define the number of seed_nodes of each subgraph and the fanout '
+                          'of each message-passing iteration.')
+
+        # one fanout for each message-passing iteration (or the same one for all of them)
+        iterations = int(self.model_info.get_mp_iterations())
+        fanouts = sampling['fanout'] if isinstance(sampling['fanout'], list) else [sampling['fanout']] * iterations
+        if len(fanouts) != iterations:
+            print_failure('The sampling must define one fanout for each of the ' + str(iterations) +
+                          ' message-passing iterations (or a single one for all of them).')
+
+        return {'seed_nodes': int(sampling['seed_nodes']),
+                'fanouts': [int(f) for f in fanouts],
+                'iterations': iterations,
+                'stages': self.__get_mp_stages(),
+                'seed': sampling.get('seed', None)}
+
+    def __get_mp_stages(self):
+        return [[(mp.destination_entity, [src.name for src in mp.source_entities]) for mp in mps]
+                for _, mps in self.model_info.get_mp_instances()]
+
+    def __get_index_dtype(self):
+        index_dtype = self.CONFIG.get('index_dtype', 'int64')
+        if index_dtype not in ['int32', 'int64']:
+            print_failure('The index_dtype defined in the train_options.yaml file must be either int32 or int64, but '
+                          + str(index_dtype) + ' was found.')
+        return tf.as_dtype(index_dtype)
+
+    def __get_input_signature(self, training=True, batch_size=1, node_ids=False, label_mask=False):
+        """
+        Parameters
+        ----------
+        training:    bool
+            Bool indicating if we are performing a training operation (and thus the label lengths of a batch are expected)
+        batch_size:    int
+            Number of samples merged into each graph served (disjoint union)
+        node_ids:    bool
+            Indicates if the global ids and halo hops of the nodes are served (keys of the historical embeddings). It
+            must match the options given to the generator
+        label_mask:    bool
+            Indicates if the mask of the labeled nodes is served (seeds of the sampled subgraphs, or interior nodes of
+            the partitions). It must also match the options given to the generator
+        """
+
+        feature_list = self.model_info.get_all_features()
+        adj_names = self.model_info.get_adjacency_info()
+        interleave_sources = self.model_info.get_interleave_sources()
+        additional_input = self.model_info.get_additional_input_names()
+        unique_additional_input = [a for a in additional_input if a not in feature_list]
+        entity_names = self.model_info.get_entity_names()
+        types, shapes = {}, {}
+
+        for a in unique_additional_input:
+            types[a] = self.index_dtype
+            shapes[a] = tf.TensorShape(None)
+
+        for f_name in feature_list:
+            types[f_name] = tf.float32
+            shapes[f_name] = tf.TensorShape(None)
+
+        for a in adj_names:
+            types['src_' + a] = self.index_dtype
+            shapes['src_' + a] = tf.TensorShape([None])
+            types['dst_' + a] = self.index_dtype
+            shapes['dst_' + a] = tf.TensorShape([None])
+            types['seq_' + a] = self.index_dtype
+            shapes['seq_' + a] = tf.TensorShape([None])
+
+        for e in entity_names:
+            types['num_' + e] = self.index_dtype
+            shapes['num_' + e] = tf.TensorShape([])
+
+        for i in interleave_sources:
+            types['indices_' + i[0] + '_to_' + i[1]] = self.index_dtype
+            shapes['indices_' + i[0] + '_to_' + i[1]] = tf.TensorShape([None])
+
+        # number of labels of each of the merged samples (to split the batch afterwards)
+        if training and batch_size > 1:
+            types['label_lens'] = self.index_dtype
+            shapes['label_lens'] = tf.TensorShape([None])
+
+        # seeds of the sampled subgraphs, or interior nodes of the partitions (the nodes whose predictions are compared
+        # with the labels)
+        if training and label_mask:
+            types['label_mask'] = tf.bool
+            shapes['label_mask'] = tf.TensorShape([None])
+
+        # global ids and halo hops of the nodes of each entity (keys of the historical embeddings)
+        if node_ids:
+            for e in entity_names:
+                for name in [GLOBAL_ID_ATTRIBUTE + '_' + e, HALO_ATTRIBUTE + '_' + e]:
+                    types[name] = self.index_dtype
+                    shapes[name] = tf.TensorShape([None])
+
+        return types, shapes
+
     @tf.autograph.experimental.do_not_convert
-    def __input_fn_generator(self, filenames=None, shuffle=False, training=True, data_samples=None, iterator=False):
+    def __input_fn_generator(self, filenames=None, shuffle=False, training=True, data_samples=None, iterator=False,
+                             batch_size=1, repeat=True, num_shards=1, shard_index=0, sampling=False):
         """
         Parameters
         ----------
@@ -338,93 +795,106 @@ class Ignnition_model:
             List of samples to be used as input (if any)
         iterator: bool
             Indicates if we need to transform the dataset to an iterator
+        batch_size:    int
+            Number of samples merged into each graph served (disjoint union)
+        repeat:    bool
+            Indicates if the training dataset must be repeated indefinitely (only applicable if using dataset input)
+        num_shards:    int
+            Number of shards in which the input is split (e.g., one for each worker)
+        shard_index:    int
+            Index of the shard to be served
+        sampling:    bool
+            Indicates if the neighbor sampling (if defined in the train_options.yaml file) is applied, which is only
+            the case of the training dataset, so that the validation and evaluation use the full graphs
         """
 
         with tf.name_scope('get_data') as _:
             feature_list = self.model_info.get_all_features()
-            adj_names = self.model_info.get_adjacency_info()
             interleave_list = self.model_info.get_interleave_tensors()
-            interleave_sources = self.model_info.get_interleave_sources()
             output_name = self.model_info.get_output_info()
             additional_input = self.model_info.get_additional_input_names()
             unique_additional_input = [a for a in additional_input if a not in feature_list]
             entity_names = self.model_info.get_entity_names()
-            types, shapes = {}, {}
-            feature_names = []
-
-            for a in unique_additional_input:
-                types[a] = tf.int64
-                shapes[a] = tf.TensorShape(None)
+            feature_names = [f_name for f_name in feature_list]
+            sampling = self.__get_sampling_options() if training and sampling else None
+            mask_halo_nodes = bool(self.CONFIG.get('mask_halo_nodes', False))
+            historical_embeddings = self.CONFIG.get('historical_embeddings', None) is not None
+            types, shapes = self.__get_input_signature(training, batch_size, node_ids=historical_embeddings,
+                                                       label_mask=sampling is not None or mask_halo_nodes)
 
-            for f_name in feature_list:
-                feature_names.append(f_name)
-                types[f_name] = tf.float32
-                shapes[f_name] = tf.TensorShape(None)
-
-            for a in adj_names:
-                types['src_' + a] = tf.int64
-                shapes['src_' + a] = tf.TensorShape([None])
-                types['dst_' + a] = tf.int64
-                shapes['dst_' + a] = tf.TensorShape([None])
-                types['seq_' + a] = tf.int64
-                shapes['seq_' + a] = tf.TensorShape([None])
-
-                # we now include this values in the additional_params
-            # if a[3] == 'True':
-            #     types['params_' + a[0]] = tf.int64
-            #     shapes['params_' + a[0]] = tf.TensorShape(None)
-
-            for e in entity_names:
-                types['num_' + e] = tf.int64
-                shapes['num_' + e] = tf.TensorShape([])
+            if data_samples is not None and num_shards > 1:
+                data_samples = data_samples[shard_index::num_shards]
 
-            for i in interleave_sources:
-                types['indices_' + i[0] + '_to_' + i[1]] = tf.int64
-                shapes['indices_' + i[0] + '_to_' + i[1]] = tf.TensorShape([None])
+            # the options of the generation (e.g., the sampling) and the caches are kept in the generator, so that each
+            # pipeline uses its own copy, with its own caches (the training and validation pipelines are both
+            # prefetched, so their generators may run concurrently)
+            generator = copy.copy(self.generator)
 
             if training:  # if we do training, we also expect the labels
                 if data_samples is None:
                     ds = tf.data.Dataset.from_generator(
-                        lambda: self.generator.generate_from_dataset(filenames, entity_names, feature_names,
-                                                                     output_name,  # adjacency_info,
-                                                                     interleave_list, unique_additional_input, training,
-                                                                     shuffle),
+                        lambda: generator.generate_from_dataset(filenames, entity_names, feature_names,
+                                                                output_name,  # adjacency_info,
+                                                                interleave_list, unique_additional_input, training,
+                                                                shuffle, num_shards=num_shards,
+                                                                shard_index=shard_index, batch_size=batch_size,
+                                                                sampling=sampling, mask_halo_nodes=mask_halo_nodes,
+                                                                historical_embeddings=historical_embeddings),
                         output_types=(types, tf.float32),
                         output_shapes=(shapes, tf.TensorShape(None)))
-                    ds = ds.repeat()
+                    if repeat:
+                        ds = ds.repeat()
                 else:
                     data_samples = [json.dumps(t) for t in data_samples]
                     ds = tf.data.Dataset.from_generator(
-                        lambda: self.generator.generate_from_array(data_samples, entity_names, feature_names,
-                                                                   output_name,  # adjacency_info,
-                                                                   interleave_list,
-                                                                   unique_additional_input, training, shuffle),
+                        lambda: generator.generate_from_array(data_samples, entity_names, feature_names,
+                                                              output_name,  # adjacency_info,
+                                                              interleave_list,
+                                                              unique_additional_input, training, shuffle,
+                                                              batch_size=batch_size, sampling=sampling,
+                                                              mask_halo_nodes=mask_halo_nodes,
+                                                              historical_embeddings=historical_embeddings),
                         output_types=(types, tf.float32),
                         output_shapes=(shapes, tf.TensorShape(None)))
 
             else:
                 if data_samples is None:
                     ds = tf.data.Dataset.from_generator(
-                        lambda: self.generator.generate_from_dataset(filenames, entity_names, feature_names,
-                                                                     output_name,  # adjacency_info,
-                                                                     interleave_list, unique_additional_input, training,
-                                                                     shuffle),
+                        lambda: generator.generate_from_dataset(filenames, entity_names, feature_names,
+                                                                output_name,  # adjacency_info,
+                                                                interleave_list, unique_additional_input, training,
+                                                                shuffle, num_shards=num_shards,
+                                                                shard_index=shard_index, batch_size=batch_size,
+                                                                historical_embeddings=historical_embeddings),
                         output_types=(types),
                         output_shapes=(shapes))
 
                 else:
                     data_samples = [json.dumps(t) for t in data_samples]
                     ds = tf.data.Dataset.from_generator(
-                        lambda: self.generator.generate_from_array(data_samples, entity_names, feature_names,
-                                                                   output_name,  # adjacency_info,
-                                                                   interleave_list,
-                                                                   unique_additional_input, training, shuffle),
+                        lambda: generator.generate_from_array(data_samples, entity_names, feature_names,
+                                                              output_name,  # adjacency_info,
+                                                              interleave_list,
+                                                              unique_additional_input, training, shuffle,
+                                                              batch_size=batch_size,
+                                                              historical_embeddings=historical_embeddings),
                         output_types=(types),
                         output_shapes=(shapes))
 
             with tf.name_scope('normalization') as _:
                 batch_norm = self.CONFIG.get('batch_normalization', None)
-                if batch_norm is None:
+                if self.__get_normalizations() is not None:
+                    if training:
+                        ds = ds.map(
+                            lambda x, y: self.__declarative_normalization(x, feature_list, output_name, y),
+                            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+                    else:
+                        ds = ds.map(
+                            lambda x: self.__declarative_normalization(x, feature_list, output_name),
+                            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+                    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+                elif batch_norm is None:
                     if training:
                         ds = ds.map(
                             lambda x, y: self.__global_normalization(x, feature_list, output_name, y),
@@ -456,7 +926,11 @@ class Ignnition_model:
     def __create_model(self):
         print_header(
             "\nProcessing the described model...\n---------------------------------------------------------------------------\n")
-        return Yaml_preprocessing(self.model_dir)  # read json
+        model_info = Yaml_preprocessing(self.model_dir)  # read json
+        # the first dense layer of the neural networks over gathered hs is computed per node (gather after transform)
+        if not self.CONFIG.get('gather_after_transform', True):
+            model_info.set_gather_after_transform(False)
+        return model_info
 
     def __create_gnn(self, samples=None, path=None, verbose=True):
         """
@@ -477,9 +951,11 @@ class Ignnition_model:
         dimensions, sample = self.find_dataset_dimensions(samples=samples, path=path)
         self.model_info.add_dimensions(dimensions)
 
-        gnn_model = self.__get_compiled_model(self.model_info)
-        # restore a warm-start Checkpoint (if any)
-        self.gnn_model = self.__restore_model(gnn_model, sample=sample)
+        # the variables (and the optimizer) must be created under the scope of the distribution strategy
+        with self.strategy.scope():
+            gnn_model = self.__get_compiled_model(self.model_info)
+            # restore a warm-start Checkpoint (if any)
+            self.gnn_model = self.__restore_model(gnn_model, sample=sample)
 
     def __restore_model(self, gnn_model, sample):
         """
@@ -502,10 +978,22 @@ class Ignnition_model:
             # Call only one tf.function when tracing.
             _ = gnn_model(sample, training=False)
             gnn_model.load_weights(checkpoint_path)
+            self.weights_version += 1
+
+        # checkpoint written by Async_checkpoint (its prefix, or the directory to restore the best one)
+        elif os.path.isfile(checkpoint_path + '.index') or tf.train.latest_checkpoint(checkpoint_path) is not None:
+            print("Restoring from", checkpoint_path)
+            sample_it = self.__input_fn_generator(training=False,
+                                                  data_samples=[sample])
+            sample = sample_it.get_next()
+            _ = gnn_model(sample, training=False)
+            restore_checkpoint(gnn_model, checkpoint_path)
+            self.weights_version += 1
 
         elif checkpoint_path != '':
             print_info(
-                "The file in the directory " + checkpoint_path + ' was not a valid checkpoint file in hdf5 format.')
+                "The file in the directory " + checkpoint_path + ' was not a valid checkpoint file (in hdf5 format, or '
+                                                                 'a checkpoint prefix or directory).')
 
         return gnn_model
 
@@ -551,49 +1039,118 @@ class Ignnition_model:
             except:
                 print_failure('Failed to read the data file ' + sample)
 
-            # Now that we have the sample, we can process the dimensions
-            dimensions = {}  # for each key, we have a tuple of (length, num_elements)
-
-            # COMPUTE THE DIMENSIONS USING ONE OF THE SAMPLES
-            # 1) Transform it to networkx
-            # 2) Obtain all the nodes attributes
-            # 3) Obtain all the edge attributes
-            # 4) Obtain all the graph attributes
-
-            # 1) Obtain the corresponding graph
-            G = json_graph.node_link_graph(sample)
-
-            # 1) Node attributes
-            node_attrs = list(set(chain.from_iterable(d.keys() for _, d in G.nodes(data=True))))
-            for n in node_attrs:
-                if n != 'entity:':
-                    features = list(nx.get_node_attributes(G, n).values())
-                    elem = features[0]
-                    # if features has dimension 1, then dim = 1.
-                    if isinstance(elem, list):
-                        dimensions[n] = len(elem)
-                    else:
-                        dimensions[n] = 1
-
-            # 2) Edge attributes
-            edge_attrs = list(set(chain.from_iterable(d.keys() for *_, d in G.edges(data=True))))
-            for e in edge_attrs:
-                features = list(nx.get_edge_attributes(G, e).values())
-                if isinstance(features[0], list):
-                    dimensions[e] = len(features[0])
+        # Now that we have the sample, we can process the dimensions
+        dimensions = {}  # for each key, we have a tuple of (length, num_elements)
+
+        # COMPUTE THE DIMENSIONS USING ONE OF THE SAMPLES
+        # 1) Transform it to networkx
+        # 2) Obtain all the nodes attributes
+        # 3) Obtain all the edge attributes
+        # 4) Obtain all the graph attributes
+
+        # 1) Obtain the corresponding graph
+        G = json_graph.node_link_graph(sample)
+
+        # 1) Node attributes
+        node_attrs = list(set(chain.from_iterable(d.keys() for _, d in G.nodes(data=True))))
+        for n in node_attrs:
+            if n != 'entity:':
+                features = list(nx.get_node_attributes(G, n).values())
+                elem = features[0]
+                # if features has dimension 1, then dim = 1.
+                if isinstance(elem, list):
+                    dimensions[n] = len(elem)
                 else:
-                    dimensions[e] = 1
+                    dimensions[n] = 1
+
+        # 2) Edge attributes
+        edge_attrs = list(set(chain.from_iterable(d.keys() for *_, d in G.edges(data=True))))
+        for e in edge_attrs:
+            features = list(nx.get_edge_attributes(G, e).values())
+            if isinstance(features[0], list):
+                dimensions[e] = len(features[0])
+            else:
+                dimensions[e] = 1
+
+        # 3) Graph attributes
+        graph_attrs = list(G.graph.keys())
+        for g in graph_attrs:
+            feature = G.graph[g]
+            dimensions[g] = len(feature)
+
+        return dimensions, sample
 
-            # 3) Graph attributes
-            graph_attrs = list(G.graph.keys())
-            for g in graph_attrs:
-                feature = G.graph[g]
-                dimensions[g] = len(feature)
+    def __distribute_input(self, filenames, shuffle, data_samples, sampling=False):
+        """
+        Parameters
+        ----------
+        filenames:    str
+            Path of the dataset (if using dataset input only)
+        shuffle:    bool
+            Bool indicating if we need to shuffle the input data.
+        data_samples:    [array]
+            List of samples to be used as input (if any)
+        sampling:    bool
+            Indicates if the neighbor sampling is applied (only to the training dataset)
+        """
 
-            return dimensions, sample
+        # each worker builds its own input pipeline over a disjoint shard of the data. The graphs of different sizes
+        # cannot be re-batched, so tf.distribute must not split (nor auto-shard) the pipeline of each worker
+        return self.strategy.experimental_distribute_datasets_from_function(
+            lambda input_context: self.__input_fn_generator(filenames, shuffle=shuffle, data_samples=data_samples,
+                                                            num_shards=input_context.num_input_pipelines,
+                                                            shard_index=input_context.input_pipeline_id,
+                                                            sampling=sampling))
 
     # FUNCTIONALITIES
     # --------------------------------------------------
+    def build_gnn(self, samples=None, path=None, verbose=True):
+        """
+        Parameters
+        ----------
+        samples:    [array]
+            Array of samples whose dimensions define the model (if any)
+        path:    str
+            Path of the dataset whose dimensions define the model (by default, the training dataset)
+        verbose:    bool
+            Indicates if we want verbosity in the prints of the terminal
+        """
+
+        if not hasattr(self, 'gnn_model'):
+            if samples is None:
+                path = self.__process_path(path if path is not None else self.CONFIG['train_dataset'])
+            self.__create_gnn(samples=samples, path=path, verbose=verbose)
+        return self.gnn_model
+
+    def get_dataset(self, path=None, samples=None, training=True, shuffle=False, repeat=True, iterator=False,
+                    distribute=False):
+        """
+        Parameters
+        ----------
+        path:    str
+            Path of the dataset (by default, the training dataset)
+        samples:    [array]
+            Array of samples to be used as input (if any)
+        training:    bool
+            Bool indicating if the labels are served together with the features
+        shuffle:    bool
+            Bool indicating if we need to shuffle the input data.
+        repeat:    bool
+            Indicates if the training dataset must be repeated indefinitely (only applicable if using dataset input)
+        iterator:    bool
+            Indicates if we need to transform the dataset to an iterator
+        distribute:    bool
+            Indicates if the training dataset is distributed with the distribution strategy (each worker serving its
+            own shard of the data), as in train_and_validate
+        """
+
+        if samples is None:
+            path = self.__process_path(path if path is not None else self.CONFIG['train_dataset'])
+        if distribute:
+            return self.__distribute_input(path, shuffle, samples)
+        return self.__input_fn_generator(path, shuffle=shuffle, training=training, data_samples=samples,
+                                         iterator=iterator, repeat=repeat)
+
     def train_and_validate(self, training_samples=None, val_samples=None):
         """
         Parameters
@@ -619,26 +1176,40 @@ class Ignnition_model:
         filenames_train = self.__process_path(self.CONFIG['train_dataset'])
         filenames_val = self.__process_path(self.CONFIG['validation_dataset'])
 
-        output_path = self.__process_path(self.CONFIG['output_path'])
-        output_path = os.path.join(output_path, 'CheckPoint')
+        # only the chief worker keeps the checkpoints and logs, the rest write them in a temporary directory which
+        # is removed after the training
+        temporary_dir = None
+        if self.strategy.extended.should_checkpoint:
+            output_path = self.__process_path(self.CONFIG['output_path'])
+            output_path = os.path.join(output_path, 'CheckPoint')
 
-        if not os.path.isdir(output_path):
-            os.mkdir(output_path)
+            if not os.path.isdir(output_path):
+                os.mkdir(output_path)
 
-        output_path = os.path.join(output_path,
-                                   'experiment_' + str(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")))
-        os.mkdir(output_path)
-
-        strategy = tf.distribute.MirroredStrategy()  # change this not to use GPU
-        print('Number of devices: {}'.format(strategy.num_replicas_in_sync))
-        train_dataset = self.__input_fn_generator(filenames_train,
-                                                  shuffle=str_to_bool(
-                                                      self.CONFIG['shuffle_training_set']),
-                                                  data_samples=training_samples)
-        validation_dataset = self.__input_fn_generator(filenames_val,
-                                                       shuffle=str_to_bool(
-                                                           self.CONFIG['shuffle_validation_set']),
-                                                       data_samples=val_samples)
+            output_path = os.path.join(output_path,
+                                       'experiment_' + str(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")))
+            os.mkdir(output_path)
+        else:
+            temporary_dir = tempfile.TemporaryDirectory()
+            output_path = temporary_dir.name
+
+        print('Number of replicas: {}'.format(self.strategy.num_replicas_in_sync))
+        if self.CONFIG.get('distribution_strategy', None) is None:
+            train_dataset = self.__input_fn_generator(filenames_train,
+                                                      shuffle=str_to_bool(
+                                                          self.CONFIG['shuffle_training_set']),
+                                                      data_samples=training_samples,
+                                                      sampling=True)
+            validation_dataset = self.__input_fn_generator(filenames_val,
+                                                           shuffle=str_to_bool(
+                                                               self.CONFIG['shuffle_validation_set']),
+                                                           data_samples=val_samples)
+        else:
+            train_dataset = self.__distribute_input(filenames_train, str_to_bool(self.CONFIG['shuffle_training_set']),
+                                                    training_samples, sampling=True)
+            validation_dataset = self.__distribute_input(filenames_val,
+                                                         str_to_bool(self.CONFIG['shuffle_validation_set']),
+                                                         val_samples)
 
         mini_epoch_size = self.CONFIG.get('epoch_size', None)
         if mini_epoch_size is not None:
@@ -648,17 +1219,21 @@ class Ignnition_model:
 
         callbacks = self.__get_model_callbacks(output_path=output_path)
 
-        self.gnn_model.fit(train_dataset,
-                           epochs=num_epochs,
-                           initial_epoch=self.CONFIG.get('initial_epoch', 0),
-                           steps_per_epoch=mini_epoch_size,
-                           batch_size=self.CONFIG.get('batch_size', 1),
-                           validation_data=validation_dataset,
-                           validation_freq=int(self.CONFIG['val_frequency']),
-                           validation_steps=int(self.CONFIG['val_samples']),
-                           callbacks=callbacks,
-                           use_multiprocessing=True,
-                           verbose=1)
+        try:
+            self.gnn_model.fit(train_dataset,
+                               epochs=num_epochs,
+                               initial_epoch=self.CONFIG.get('initial_epoch', 0),
+                               steps_per_epoch=mini_epoch_size,
+                               batch_size=self.CONFIG.get('batch_size', 1),
+                               validation_data=validation_dataset,
+                               validation_freq=int(self.CONFIG['val_frequency']),
+                               validation_steps=int(self.CONFIG['val_samples']),
+                               callbacks=callbacks,
+                               use_multiprocessing=True,
+                               verbose=1)
+        finally:
+            if temporary_dir is not None:
+                temporary_dir.cleanup()
 
     def predict(self, prediction_samples=None, verbose=True):
         """
@@ -671,44 +1246,36 @@ class Ignnition_model:
         """
 
         prediction_path = None
-        if not hasattr(self, 'gnn_model'):
-            if prediction_samples is None:  # look for the dataset path
-                try:
-                    prediction_path = self.__process_path(self.CONFIG['predict_dataset'])
+        if prediction_samples is None:  # look for the dataset path (also if the model was already created)
+            try:
+                prediction_path = self.__process_path(self.CONFIG['predict_dataset'])
+                if not hasattr(self, 'gnn_model'):
                     self.__create_gnn(path=prediction_path, verbose=verbose)
-                except:
-                    print_failure(
-                        'Make sure to either pass an array of samples or to define in the train_options.yaml the path to the prediction dataset')
+            except:
+                print_failure(
+                    'Make sure to either pass an array of samples or to define in the train_options.yaml the path to the prediction dataset')
 
-            else:
-                self.__create_gnn(samples=prediction_samples, verbose=verbose)
+        elif not hasattr(self, 'gnn_model'):
+            self.__create_gnn(samples=prediction_samples, verbose=verbose)
 
         if verbose:
             print()
             print_header(
                 'Starting to make the predictions...\n---------------------------------------------------------\n')
 
+        if self.prediction_cache is not None:
+            return self.__cached_predict(prediction_path, prediction_samples)
+
         sample_it = self.__input_fn_generator(prediction_path, training=False, data_samples=prediction_samples,
                                               iterator=True)
         all_predictions = []
         try:
-            # find the denormalization function
-            try:
-                denorm_func = getattr(self.module, 'denormalization')
-            except:
-                denorm_func = None
-
             # while there are predictions
             while True:
                 pred = self.gnn_model(sample_it.get_next(), training=False)
                 pred = tf.squeeze(pred)
                 output_name = self.model_info.get_output_info()  # for now suppose we only have one output type
-
-                if denorm_func is not None:
-                    try:
-                        pred = tf.py_function(func=denorm_func, inp=[pred, output_name], Tout=tf.float32)
-                    except:
-                        print_failure('The denormalization function failed')
+                pred = self.__denormalize_output(pred, output_name)
 
                 all_predictions.append(pred)
 
@@ -717,6 +1284,312 @@ class Ignnition_model:
 
         return all_predictions
 
+    def set_base_sample(self, sample, verbose=False):
+        """
+        Predicts the sample with a full forward pass, caching the hidden states of all its nodes after every stage of
+        the message passing, which predict_incremental reuses for the modified versions of the sample. The time of a
+        full forward pass (without the cache) is also measured, as the reference of the speedup of predict_incremental.
+
+        Parameters
+        ----------
+        sample:    dict
+            Base sample (networkx node-link dictionary)
+        verbose: bool
+            Indicates if there should be verbosity in the prints of the terminal or not.
+        """
+
+        if not hasattr(self, 'gnn_model'):
+            self.__create_gnn(samples=[sample], verbose=verbose)
+
+        # the store is created only once (and overwritten by every base sample), since the compiled forward pass
+        # looks it up in the gnn_model
+        if self.incremental_store is None:
+            num_slots = int(self.model_info.get_mp_iterations()) * len(self.model_info.get_mp_instances())
+            self.incremental_store = Historical_embeddings(tempfile.mkdtemp(), num_slots)
+
+        self.incremental_store.write_inference = True
+        predictions = self.__predict_sample(sample, self.incremental_store)
+        self.incremental_store.write_inference = False
+
+        # the first forward pass without the cache only traces the function
+        self.__predict_sample(sample)
+        start = time.perf_counter()
+        self.__predict_sample(sample)
+        full_time = time.perf_counter() - start
+
+        self.incremental_base = {'sample': sample, 'predictions': predictions, 'full_time': full_time}
+        return np.squeeze(predictions, axis=-1) if predictions.shape[-1] == 1 else predictions
+
+    def predict_incremental(self, sample, max_affected_fraction=0.5):
+        """
+        Returns the predictions of a modified version of the base sample (see set_base_sample), and a report of the
+        incremental computation. Only the nodes whose state may have changed (those within the receptive field of the
+        changed nodes, edges or features) are recomputed, in a partition whose halo nodes read their states from the
+        cache of the base sample; the rest of the predictions are the ones of the base sample. If the affected nodes
+        exceed max_affected_fraction of the nodes, or the model does not allow it, the full sample is recomputed.
+
+        Parameters
+        ----------
+        sample:    dict
+            Modified sample (networkx node-link dictionary)
+        max_affected_fraction:    float
+            Maximum fraction of affected nodes for the incremental computation (otherwise, the sample is fully
+            recomputed)
+        """
+
+        if self.incremental_base is None:
+            print_failure('The base sample must be set (with set_base_sample) before predicting incrementally.')
+        base = self.incremental_base
+
+        start = time.perf_counter()
+        changed = get_changed_nodes(base['sample'], sample)
+        affected = get_affected_nodes(sample, changed, self.__get_mp_stages(),
+                                      int(self.model_info.get_mp_iterations()))
+        reason = self.__get_incremental_limitation()
+        if reason is None and affected.sum() > max_affected_fraction * len(affected):
+            reason = 'the affected nodes exceed max_affected_fraction'
+
+        if reason is not None:
+            predictions = self.__predict_sample(sample)
+            recomputed_nodes = len(affected)
+        else:
+            # the global ids are the indices of the nodes in the base sample (the new nodes are always affected)
+            base_ids = {}
+            counters = {}
+            for node in base['sample']['nodes']:
+                entity = node.get('entity')
+                base_ids[node['id']] = counters.get(entity, 0)
+                counters[entity] = base_ids[node['id']] + 1
+            global_ids = []
+            for node in sample['nodes']:
+                entity = node.get('entity')
+                if node['id'] not in base_ids:
+                    base_ids[node['id']] = counters.get(entity, 0)
+                    counters[entity] = base_ids[node['id']] + 1
+                global_ids.append(base_ids[node['id']])
+
+            # the predictions of the affected nodes of the output entity come from the partition, and the rest from
+            # the base sample (all of them if no node is affected, e.g., if only unused attributes changed)
+            output_entity = self.model_info.get_readout_operations()[0].input[0]
+            recomputed = {}
+            recomputed_nodes = 0
+            if affected.any():
+                partition = build_partition(sample, affected, 1, global_ids)
+                partition_predictions = self.__predict_sample(partition, self.incremental_store)
+                recomputed_nodes = len(partition['nodes'])
+                partition_nodes = [node for node in partition['nodes'] if node.get('entity') == output_entity]
+                recomputed = {node['id']: partition_predictions[k] for k, node in enumerate(partition_nodes)
+                              if node[HALO_ATTRIBUTE] == 0}
+            output_nodes = [node['id'] for node in sample['nodes'] if node.get('entity') == output_entity]
+            predictions = np.array([recomputed[n] if n in recomputed else base['predictions'][base_ids[n]]
+                                    for n in output_nodes]).reshape(len(output_nodes), -1)
+        elapsed = time.perf_counter() - start
+
+        report = {'incremental': reason is None,
+                  'reason': reason,
+                  'changed_nodes': int(changed.sum()),
+                  'affected_nodes': int(affected.sum()),
+                  'recomputed_nodes': recomputed_nodes,
+                  'total_nodes': len(affected),
+                  'time': elapsed,
+                  'full_time': base['full_time'],
+                  'speedup': base['full_time'] / elapsed}
+        return (np.squeeze(predictions, axis=-1) if predictions.shape[-1] == 1 else predictions), report
+
+    def __get_incremental_limitation(self):
+        """
+        Returns the reason why the predictions of the model cannot be computed incrementally (or None if they can).
+        """
+
+        readout = self.model_info.get_readout_operations()
+        if len(readout) != 1 or readout[0].type != 'neural_network' or len(readout[0].input) != 1 or \
+                readout[0].input[0] not in self.model_info.get_entity_names():
+            return 'the readout is not a neural network applied to the nodes of one entity'
+        if self.model_info.get_interleave_tensors():
+            return 'the model uses an interleave aggregation'
+        for _, mps in self.model_info.get_mp_instances():
+            for mp in mps:
+                # the symmetric normalization depends on the degrees of the sources, which the halo nodes do not keep
+                if any(isinstance(a, Conv_aggr) and a.normalization == 'symmetric' for a in mp.aggregations):
+                    return 'the model uses a convolution with symmetric normalization'
+        if self.CONFIG.get('batch_normalization', None) is not None:
+            return 'the features are normalized with the statistics of each batch'
+        return None
+
+    def __predict_sample(self, sample, store=None):
+        """
+        Returns the (denormalized) predictions of one sample, as an array with one row per prediction.
+
+        Parameters
+        ----------
+        sample:    dict
+            Sample (networkx node-link dictionary)
+        store:    Historical_embeddings
+            Store from which the states of the halo nodes are read (None to compute the sample on its own)
+        """
+
+        features = self.__process_prediction_sample(sample, node_ids=store is not None)
+        predictions = self.__predict_features(features, store)
+        return predictions.reshape(len(predictions), -1)
+
+    def __process_prediction_sample(self, sample, node_ids=False):
+        """
+        Returns the processed tensors (before the normalization) of one sample to be predicted.
+
+        Parameters
+        ----------
+        sample:    dict
+            Sample (networkx node-link dictionary)
+        node_ids:    bool
+            Indicates if the global ids and halo hops of the nodes are served
+        """
+
+        feature_list = self.model_info.get_all_features()
+        additional_input = self.model_info.get_additional_input_names()
+        unique_additional_input = [a for a in additional_input if a not in feature_list]
+        return self.generator.process_samples([sample], self.model_info.get_entity_names(), feature_list,
+                                              self.model_info.get_output_info(),
+                                              self.model_info.get_interleave_tensors(), unique_additional_input, False,
+                                              historical_embeddings=node_ids)[0]
+
+    def __predict_features(self, features, store=None):
+        """
+        Returns the (denormalized) predictions of the processed tensors of one sample.
+
+        Parameters
+        ----------
+        features:    dict
+            Processed tensors of the sample (see __process_prediction_sample)
+        store:    Historical_embeddings
+            Store from which the states of the halo nodes are read (None to compute the sample on its own)
+        """
+
+        feature_list = self.model_info.get_all_features()
+        output_name = self.model_info.get_output_info()
+        node_ids = store is not None
+
+        types, _ = self.__get_input_signature(training=False, node_ids=node_ids)
+        features = {k: tf.convert_to_tensor(features[k], dtype=types[k]) for k in types}
+        features = self.__normalize(features, feature_list, output_name, None)
+
+        previous_store = self.gnn_model.historical_embeddings
+        self.gnn_model.historical_embeddings = store
+        try:
+            predictions = self.__get_predict_function(node_ids)(features)
+        finally:
+            self.gnn_model.historical_embeddings = previous_store
+
+        return self.__denormalize_output(predictions, output_name).numpy()
+
+    def __cached_predict(self, prediction_path, prediction_samples):
+        """
+        Returns the predictions of the samples (as predict), reusing the ones stored in the prediction cache. The raw
+        samples given as an array skip both the preprocessing and the forward pass if they were already predicted,
+        while the samples of a dataset (which are served already processed) only skip the forward pass.
+
+        Parameters
+        ----------
+        prediction_path:    str
+            Path of the prediction dataset (only used if no samples are given)
+        prediction_samples:    [array]
+            Array of samples to be predicted
+        """
+
+        cache = self.prediction_cache
+        output_name = self.model_info.get_output_info()
+        # some of the weights are only created in the first forward pass of the model, so that the cache is bound again
+        # to the weights if they change after a forward pass
+        num_weights = self.__bind_prediction_cache()
+
+        all_predictions = []
+        if prediction_samples is None:
+            sample_it = self.__input_fn_generator(prediction_path, training=False, iterator=True)
+            try:
+                while True:
+                    features = sample_it.get_next()
+                    key = hash_features({k: v.numpy() for k, v in features.items()})
+                    pred = cache.get(key)
+                    if pred is None:
+                        pred = self.gnn_model(features, training=False)
+                        pred = self.__denormalize_output(tf.squeeze(pred), output_name).numpy()
+                        if len(self.gnn_model.weights) != num_weights:
+                            num_weights = self.__bind_prediction_cache()
+                        cache.put(key, pred)
+                    all_predictions.append(tf.convert_to_tensor(pred))
+            except tf.errors.OutOfRangeError:
+                pass
+            return all_predictions
+
+        for sample in prediction_samples:
+            sample_hash = hash_sample(sample)
+            key = cache.get_sample_key(sample_hash)
+            features = None
+            if key is None:
+                features = self.__process_prediction_sample(sample)
+                key = hash_features(features)
+
+            pred = cache.get(key)
+            if pred is None:
+                if features is None:
+                    features = self.__process_prediction_sample(sample)
+                pred = np.squeeze(self.__predict_features(features))
+                if len(self.gnn_model.weights) != num_weights:
+                    num_weights = self.__bind_prediction_cache()
+                cache.put(key, pred)
+            cache.put_sample_key(sample_hash, key)
+            all_predictions.append(tf.convert_to_tensor(pred))
+
+        return all_predictions
+
+    def __bind_prediction_cache(self):
+        """
+        Binds the prediction cache to the current weights of the model (clearing it if its predictions were computed
+        with other weights), and returns the number of weights. The weights are only hashed again if their version
+        (number of weights, iterations of the optimizer and weights_version) changed since the last binding.
+        """
+
+        # hashing the weights is proportional to the size of the model, so that it is only done when they may have
+        # changed (e.g., not between the queries of a trained model)
+        version = (len(self.gnn_model.weights), int(self.gnn_model.optimizer.iterations), self.weights_version)
+        if version != self.prediction_cache_version:
+            weights = self.gnn_model.get_weights()
+            self.prediction_cache.set_model(hash_features({str(i): w for i, w in enumerate(weights)}))
+            self.prediction_cache_version = version
+        return version[0]
+
+    def __create_prediction_cache(self):
+        options = self.CONFIG.get('prediction_cache', None)
+        if options is None:
+            return None
+
+        # the memory bound is defined in megabytes
+        max_memory = options.get('max_memory', None)
+        path = options.get('path', None)
+        return Prediction_cache(max_entries=options.get('max_entries', 1024),
+                                max_memory=None if max_memory is None else float(max_memory) * 2 ** 20,
+                                path=None if path is None else self.__process_path(path))
+
+    def __get_predict_function(self, node_ids):
+        """
+        Parameters
+        ----------
+        node_ids:    bool
+            Indicates if the global ids and halo hops of the nodes are served
+        """
+
+        if node_ids not in self.predict_functions:
+            types, shapes = self.__get_input_signature(training=False, node_ids=node_ids)
+            input_signature = [{k: tf.TensorSpec(shapes[k], types[k]) for k in types}]
+            gnn_model = self.gnn_model
+
+            # the signature is fixed, so that the function is traced only once regardless of the size of the graphs
+            @tf.function(input_signature=input_signature)
+            def predict_function(features):
+                return gnn_model(features, training=False)
+
+            self.predict_functions[node_ids] = predict_function
+        return self.predict_functions[node_ids]
+
     def computational_graph(self):
         # Check if we can generate the computational graph without a dataset
         train_path = self.__process_path(self.CONFIG['train_dataset'])
@@ -748,7 +1621,8 @@ class Ignnition_model:
                 step=0,
                 profiler_outdir=path)
 
-    def evaluate(self, evaluation_samples=None, verbose=True):
+    def evaluate(self, evaluation_samples=None, verbose=True, compiled=False, batch_size=1, return_samples=False,
+                 quantiles=None):
         """
         Parameters
         ----------
@@ -756,6 +1630,14 @@ class Ignnition_model:
             Array of samples to be used for evaluation, useful only if no prediction dataset is specified.
         verbose: bool
             Indicates if there should be verbosity in the prints of the terminal or not.
+        compiled:    bool
+            Indicates if the evaluation runs as a compiled loop with streaming metric accumulation. In this case, a dictionary with the aggregates of the metric is returned.
+        batch_size:    int
+            Number of samples merged into each graph evaluated (only applicable if compiled)
+        return_samples:    bool
+            Indicates if the value of the metric for each sample must also be returned (only applicable if compiled)
+        quantiles:    [array]
+            Quantiles (between 0 and 1) of the metric to be estimated (only applicable if compiled)
         """
 
         # Generate the model if it doesn't exist
@@ -772,43 +1654,39 @@ class Ignnition_model:
 
         if evaluation_samples is None:
             try:
-                data_path = self.CONFIG['validation_dataset']
+                data_path = self.__process_path(self.CONFIG['validation_dataset'])
             except:
                 print_failure(
                     'Make sure to either pass an array of samples or to define in the train_options.yaml the path to the validation dataset')
         else:
             data_path = None
 
-        sample_it = self.__input_fn_generator(data_path, training=True, data_samples=evaluation_samples, iterator=True)
-
-        all_metrics = []
+        # metric for the evaluation
         try:
-            try:
-                denorm_func = getattr(self.module, 'denormalization')
-            except:
-                denorm_func = None
+            metric_func = getattr(self.module, 'evaluation_metric')
 
-            # metric for the evaluation
-            try:
-                metric_func = getattr(self.module, 'evaluation_metric')
+        except:
+            print_failure('The evaluation metric function failed. '
+                          'Please make sure you define a valid python function taking as input the label '
+                          'and the prediction, and returning one single numerical value.')
 
-            except:
-                print_failure('The evaluation metric function failed. '
-                              'Please make sure you define a valid python function taking as input the label '
-                              'and the prediction, and returning one single numerical value.')
+        if compiled:
+            return self.__compiled_evaluation(data_path, evaluation_samples, metric_func, batch_size, return_samples,
+                                              quantiles)
 
+        sample_it = self.__input_fn_generator(data_path, training=True, data_samples=evaluation_samples, iterator=True,
+                                              repeat=False)
+
+        all_metrics = []
+        try:
             # while there are predictions
             while True:
                 features, label = sample_it.get_next()
                 pred = self.gnn_model(features, training=False)
                 pred = tf.squeeze(pred)
                 output_name = self.model_info.get_output_info()  # for now suppose we only have one output type
-                if denorm_func is not None:
-                    try:
-                        pred = tf.py_function(func=denorm_func, inp=[pred, output_name], Tout=tf.float32)
-                        label = tf.py_function(func=denorm_func, inp=[label, output_name], Tout=tf.float32)
-                    except:
-                        print_failure('The denormalization function failed')
+                pred = self.__denormalize_output(pred, output_name)
+                label = self.__denormalize_output(label, output_name)
 
                 # compute the metric value
                 value = tf.py_function(func=metric_func, inp=[label, pred], Tout=tf.float32)
@@ -818,16 +1696,345 @@ class Ignnition_model:
             pass
         return all_metrics
 
+    def __compiled_evaluation(self, data_path, evaluation_samples, metric_func, batch_size, return_samples, quantiles):
+        """
+        Parameters
+        ----------
+        data_path:    str
+            Path of the evaluation dataset (if no array of samples is used)
+        evaluation_samples:    [array]
+            Array of samples to be used for evaluation
+        metric_func:    function
+            Evaluation metric, taking as input the label and the prediction of one sample
+        batch_size:    int
+            Number of samples merged into each graph evaluated
+        return_samples:    bool
+            Indicates if the value of the metric for each sample must also be returned
+        quantiles:    [array]
+            Quantiles (between 0 and 1) of the metric to be estimated
+        """
+
+        if batch_size > 1 and any(op.type == 'pooling' for op in self.model_info.get_readout_operations()):
+            print_failure('The samples cannot be merged into batches when the readout uses a pooling operation. '
+                          'Please use a batch size of 1.')
+
+        if not is_traceable(metric_func):
+            print_info('The evaluation_metric is not decorated with @ignnition.traceable. '
+                       'It will be executed through tf.py_function.')
+            python_metric = metric_func
+            metric_func = lambda label, pred: tf.py_function(func=python_metric, inp=[label, pred], Tout=tf.float32)
+
+        if quantiles is None:
+            quantiles = [0.5, 0.9, 0.95, 0.99]
+
+        output_name = self.model_info.get_output_info()
+        streaming_metric = Streaming_metric()
+        dataset = self.__input_fn_generator(data_path, training=True, data_samples=evaluation_samples,
+                                            batch_size=batch_size, repeat=False)
+
+        # bound outside of the compiled loop, since autograph does not resolve the mangled private names
+        denormalize_output = self.__denormalize_output
+        gnn_model = self.gnn_model
+
+        def sample_metric(label, pred):
+            return tf.reshape(tf.cast(metric_func(label, pred), tf.float32), [])
+
+        @tf.function
+        def evaluation_loop(dataset):
+            values = tf.TensorArray(tf.float32, size=0, dynamic_size=True, infer_shape=False,
+                                    element_shape=tf.TensorShape([None]))
+            step = 0
+            for features, label in dataset:
+                pred = gnn_model(features, training=False)
+                pred = tf.reshape(pred, tf.shape(label))
+                pred = denormalize_output(pred, output_name)
+                label = denormalize_output(label, output_name)
+
+                if batch_size > 1:
+                    # split the merged graph back into its samples
+                    lens = features['label_lens']
+                    value = tf.map_fn(lambda x: sample_metric(x[0], x[1]),
+                                      (tf.RaggedTensor.from_row_lengths(label, lens),
+                                       tf.RaggedTensor.from_row_lengths(pred, lens)),
+                                      fn_output_signature=tf.float32)
+                else:
+                    value = tf.reshape(sample_metric(label, pred), [1])
+
+                streaming_metric.update_state(value)
+                values = values.write(step, value)
+                step += 1
+            return values.concat()
+
+        values = evaluation_loop(dataset)
+
+        result = streaming_metric.result(quantiles)
+        if return_samples:
+            result['samples'] = values.numpy()
+        return result
+
     def batch_training(self, input_samples):
         """
         Parameters
         ----------
         input_samples:    [array]
            Array of samples to be used for training (following the same format as if they were in a dataset)
+
+        The samples are merged into one single batch to which one gradient update is applied (see train_step),
+        instead of applying one update per sample (except if the readout uses a pooling operation).
+        """
+
+        return self.train_step(input_samples)
+
+    def train_step(self, samples):
+        """
+        Parameters
+        ----------
+        samples:    [array]
+           Array of samples to be merged into one single batch. Each of them is either a networkx node-link dictionary (following the same format as if they were in a dataset) or a pair (features, label) already processed by the generator.
+
+        One gradient update is applied on the merged batch, so that this cannot be used together with the
+        gradient_accumulation_steps option. If the readout uses a pooling operation, the samples cannot be merged (one
+        single prediction would be computed for all of them), so that one update is applied per sample, and the mean
+        loss is returned.
+        """
+
+        if int(self.CONFIG.get('gradient_accumulation_steps', 1)) > 1:
+            print_failure('The train_step applies one gradient update per call, so that it cannot be used together '
+                          'with the gradient_accumulation_steps option.')
+
+        feature_list = self.model_info.get_all_features()
+        interleave_list = self.model_info.get_interleave_tensors()
+        output_name = self.model_info.get_output_info()
+        additional_input = self.model_info.get_additional_input_names()
+        unique_additional_input = [a for a in additional_input if a not in feature_list]
+        entity_names = self.model_info.get_entity_names()
+
+        raw_samples = [s for s in samples if isinstance(s, dict)]
+        processed_samples = [s for s in samples if not isinstance(s, dict)]
+
+        if not hasattr(self, 'gnn_model'):
+            if raw_samples == []:
+                print_failure('The first call to train_step must contain at least one sample in the node-link format, '
+                              'which is used to create the GNN model.')
+            self.__create_gnn(samples=raw_samples, verbose=False)
+
+        processed_samples += self.generator.process_samples(raw_samples, entity_names, feature_list, output_name,
+                                                            interleave_list, unique_additional_input, True)
+        if len(processed_samples) == 1:
+            batches = processed_samples
+        elif any(op.type == 'pooling' for op in self.model_info.get_readout_operations()):
+            # the pooled prediction is per graph, so that each sample is its own batch
+            batches = processed_samples
+        else:
+            batches = [self.generator.merge_samples(*zip(*processed_samples))]
+
+        types, _ = self.__get_input_signature(training=True)
+        losses = []
+        for features, label in batches:
+            features = {k: tf.convert_to_tensor(features[k], dtype=types[k]) for k in types}
+            label = tf.convert_to_tensor(label, dtype=tf.float32)
+
+            features, label = self.__normalize(features, feature_list, output_name, label)
+            losses.append(self.__get_train_function()(features, label))
+            self.weights_version += 1
+        return losses[0] if len(losses) == 1 else tf.reduce_mean(losses)
+
+    def __get_train_function(self):
+        if self.train_function is None:
+            types, shapes = self.__get_input_signature(training=True)
+            input_signature = [{k: tf.TensorSpec(shapes[k], types[k]) for k in types},
+                               tf.TensorSpec(None, tf.float32)]
+            gnn_model = self.gnn_model
+
+            # the signature is fixed, so that the function is traced only once regardless of the size of the graphs
+            @tf.function(input_signature=input_signature)
+            def train_function(features, label):
+                gnn_model.reset_metrics()
+                logs = gnn_model.train_step((features, label))
+                return logs['loss']
+
+            self.train_function = train_function
+        return self.train_function
+
+    def profile(self, samples=None, path=None, num_steps=20, output_path=None):
+        """
+        Parameters
+        ----------
+        samples:    [array]
+            Array of samples to be used, if no dataset is used.
+        path:    str
+            Path of the dataset to be used (by default, the training dataset)
+        num_steps:    int
+            Number of steps measured (after one warm-up step)
+        output_path:    str
+            Path of the directory where the json report and the tensorboard scalars are written (by default, the profiling directory in the output_path)
         """
 
+        if samples is None and path is None:
+            path = self.__process_path(self.CONFIG['train_dataset'])
         if not hasattr(self, 'gnn_model'):
-            self.__create_gnn(samples=input_samples)
+            self.__create_gnn(samples=samples, path=path, verbose=False)
+
+        feature_list = self.model_info.get_all_features()
+        interleave_list = self.model_info.get_interleave_tensors()
+        output_name = self.model_info.get_output_info()
+        additional_input = self.model_info.get_additional_input_names()
+        unique_additional_input = [a for a in additional_input if a not in feature_list]
+        entity_names = self.model_info.get_entity_names()
+
+        if samples is None:
+            data_generator = self.generator.generate_from_dataset(path, entity_names, feature_list, output_name,
+                                                                  interleave_list, unique_additional_input, True)
+        else:
+            data_generator = self.generator.generate_from_array([json.dumps(s) for s in samples], entity_names,
+                                                                feature_list, output_name, interleave_list,
+                                                                unique_additional_input, True)
+
+        types, shapes = self.__get_input_signature(training=True)
+        input_signature = [{k: tf.TensorSpec(shapes[k], types[k]) for k in types}, tf.TensorSpec(None, tf.float32)]
+        gnn_model = self.gnn_model
+
+        # compiled forward and backward pass (without applying the gradients, so that the model is not modified)
+        @tf.function(input_signature=input_signature)
+        def compute_gradients(features, label):
+            with tf.GradientTape() as tape:
+                predictions = gnn_model(features, training=True)
+                loss = gnn_model.compiled_loss(label, predictions, regularization_losses=gnn_model.losses)
+            return tape.gradient(loss, gnn_model.trainable_variables)
+
+        timer = Phase_timer()
+        self.gnn_model.timer = timer
+        # the global setting (e.g., enabled by the user for debugging) is restored after each eager forward pass
+        run_eagerly = tf.config.functions_run_eagerly()
+        try:
+            for step in range(num_steps + 1):
+                with timer.phase('input_pipeline/process_sample'):
+                    features, label = next(data_generator, (None, None))
+                if features is None:
+                    break
+
+                features = {k: tf.convert_to_tensor(features[k], dtype=types[k]) for k in types}
+                label = tf.convert_to_tensor(label, dtype=tf.float32)
+                with timer.phase('input_pipeline/normalization'):
+                    features, label = self.__normalize(features, feature_list, output_name, label)
+
+                # the phases of the forward pass can only be measured eagerly
+                tf.config.run_functions_eagerly(True)
+                with timer.phase('forward_eager'):
+                    self.gnn_model(features, training=False)
+                tf.config.run_functions_eagerly(run_eagerly)
+
+                with timer.phase('compiled_step'):
+                    tf.nest.map_structure(lambda g: g.numpy() if g is not None else None,
+                                          compute_gradients(features, label))
+
+                if step == 0:  # discard the warm-up step (tracing)
+                    timer.reset()
+        finally:
+            tf.config.run_functions_eagerly(run_eagerly)
+            self.gnn_model.timer = Phase_timer(enabled=False)
+
+        report = timer.report()
+        if report == {}:
+            print_failure('There were not enough samples to profile the model (at least two are needed).')
+
+        # the input pipeline time per sample is compared with the compiled step, which runs concurrently to it
+        input_ms = report['input_pipeline/process_sample']['mean_ms'] + report['input_pipeline/normalization']['mean_ms']
+        compute_ms = report['compiled_step']['mean_ms']
+        report['summary'] = {'input_ms_per_sample': input_ms,
+                             'compute_ms_per_step': compute_ms,
+                             'bound': 'input' if input_ms > compute_ms else 'compute'}
+
+        if output_path is None:
+            output_path = os.path.join(self.__process_path(self.CONFIG['output_path']), 'profiling')
+        os.makedirs(output_path, exist_ok=True)
+        with open(os.path.join(output_path, 'profiling.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        timer.write_summaries(os.path.join(output_path, 'logs'))
+
+        print_info('Input pipeline: {:.3f} ms per sample. Compiled step: {:.3f} ms. The training is {}-bound.'.format(
+            input_ms, compute_ms, report['summary']['bound']))
+        return report
+
+    def compute_statistics(self, path=None, samples=None, num_workers=None, quantiles=None, save=True):
+        """
+        Parameters
+        ----------
+        path:    str
+            Path of the dataset to be used (by default, the training dataset)
+        samples:    [array]
+            Array of samples to be used, if no dataset is used.
+        num_workers:    int
+            Number of processes used to compute the statistics in parallel (each over a different shard of the files)
+        quantiles:    [array]
+            Quantiles (between 0 and 1) to be estimated for every feature
+        save:    bool
+            Indicates if the statistics must be saved in the cache file (statistics_file) to be reused by the input pipeline
+        """
 
-        dataset = self.__input_fn_generator(None, training=True, data_samples=input_samples, iterator=False)
-        self.gnn_model.fit(dataset, batch_size=len(input_samples), verbose=0)
+        feature_list = self.model_info.get_all_features()
+        interleave_list = self.model_info.get_interleave_tensors()
+        output_name = self.model_info.get_output_info()
+        additional_input = self.model_info.get_additional_input_names()
+        unique_additional_input = [a for a in additional_input if a not in feature_list]
+        entity_names = self.model_info.get_entity_names()
+
+        if num_workers is None:
+            num_workers = int(self.CONFIG.get('statistics_workers', 1))
+        if quantiles is None:
+            quantiles = self.CONFIG.get('statistics_quantiles', [0.01, 0.25, 0.5, 0.75, 0.99])
+
+        if samples is None:
+            path = self.__process_path(path if path is not None else self.CONFIG['train_dataset'])
+
+            shard_args = [(path, shard, num_workers, entity_names, feature_list, output_name, interleave_list,
+                           unique_additional_input) for shard in range(num_workers)]
+            if num_workers > 1:
+                # each worker streams a disjoint shard of the files. The partial results are merged afterwards
+                context = multiprocessing.get_context('spawn')
+                with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+                    shard_statistics = list(executor.map(compute_shard_statistics, *zip(*shard_args)))
+            else:
+                shard_statistics = [compute_shard_statistics(*shard_args[0])]
+
+        else:
+            data_generator = self.generator.generate_from_array([json.dumps(s) for s in samples], entity_names,
+                                                                feature_list, output_name, interleave_list,
+                                                                unique_additional_input, True, False)
+
+            statistics = {name: Running_statistics() for name in feature_list + [output_name]}
+            for data, label in data_generator:
+                for f_name in feature_list:
+                    statistics[f_name].update(data[f_name])
+                statistics[output_name].update(label)
+            shard_statistics = [statistics]
+
+        statistics = shard_statistics[0]
+        for partial in shard_statistics[1:]:
+            for name in statistics:
+                statistics[name].merge(partial[name])
+
+        result = {name: s.get_statistics(quantiles) for name, s in statistics.items()}
+
+        if save:
+            # the cache file must be valid json, so that the statistics of a feature without values (or with
+            # non-finite ones) are rejected
+            for name, s in result.items():
+                values = [s['mean'], s['std'], s['min'], s['max']] + list(s.get('quantiles', {}).values())
+                if s['count'] == 0:
+                    print_failure('The statistics of "' + name + '" cannot be computed, since it has no values in '
+                                  'the dataset.')
+                elif not np.all(np.isfinite(values)):
+                    print_failure('The statistics of "' + name + '" are not finite. Please check that the dataset '
+                                  'does not contain NaN or infinite values.')
+
+            # the dataset and the features are also written, so that the file is not used for a different model
+            statistics_path = self.__get_statistics_path()
+            os.makedirs(os.path.dirname(statistics_path), exist_ok=True)
+            with open(statistics_path, 'w') as f:
+                json.dump({'dataset': path, 'features': self.__get_statistics_names(), 'statistics': result}, f,
+                          indent=4)
+            # the normalizations are created again (from the new file) on their next use
+            self.normalizations = None
+
+        return result
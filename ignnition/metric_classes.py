@@ -0,0 +1,155 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+import math
+import numpy as np
+import tensorflow as tf
+
+
+class Streaming_metric(tf.Module):
+    """
+    Class that accumulates the values of an evaluation metric with streaming state (tf.Variables), so that it can be updated inside a compiled loop.
+    The quantiles are estimated with a sketch of logarithmic buckets (as in DDSketch), which guarantees a relative error of at most relative_accuracy for every quantile.
+
+    Attributes
+    ----------
+    relative_accuracy:    float
+        Maximum relative error of the estimated quantiles
+    num_buckets:    int
+        Number of buckets of the sketch for each sign (values outside the range are clipped)
+    count:    tf.Variable
+        Number of values seen
+    total:    tf.Variable
+        Sum of the values seen
+    total_squares:    tf.Variable
+        Sum of the squares of the values seen
+    min:    tf.Variable
+        Minimum value seen
+    max:    tf.Variable
+        Maximum value seen
+    buckets:    tf.Variable
+        Counts of the sketch, ordered by increasing value (negative buckets, zero bucket and positive buckets)
+
+    Methods:
+    ----------
+    update_state(self, values)
+        Adds the new values to the streaming state
+    result(self, quantiles)
+        Returns a dictionary with the aggregates (mean, std, min, max, count) and the estimated quantiles
+    """
+
+    def __init__(self, relative_accuracy=0.01, num_buckets=2048, min_value=1e-9):
+        """
+        Parameters
+        ----------
+        relative_accuracy:    float
+            Maximum relative error of the estimated quantiles
+        num_buckets:    int
+            Number of buckets of the sketch for each sign
+        min_value:    float
+            Values whose absolute value is smaller than this are counted in the zero bucket
+        """
+
+        super(Streaming_metric, self).__init__()
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.half_range = num_buckets // 2
+
+        # keys go from -half_range to half_range for each sign, plus one bucket for zeros
+        self.num_keys = 2 * self.half_range + 1
+        self.count = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.total = tf.Variable(0., dtype=tf.float64, trainable=False)
+        self.total_squares = tf.Variable(0., dtype=tf.float64, trainable=False)
+        self.min = tf.Variable(np.inf, dtype=tf.float64, trainable=False)
+        self.max = tf.Variable(-np.inf, dtype=tf.float64, trainable=False)
+        self.buckets = tf.Variable(tf.zeros([2 * self.num_keys + 1], dtype=tf.int64), trainable=False)
+
+    def update_state(self, values):
+        """
+        Parameters
+        ----------
+        values:    tensor
+            New values of the metric (of any shape)
+        """
+
+        values = tf.cast(tf.reshape(values, [-1]), tf.float64)
+        self.count.assign_add(tf.size(values, out_type=tf.int64))
+        self.total.assign_add(tf.reduce_sum(values))
+        self.total_squares.assign_add(tf.reduce_sum(tf.square(values)))
+        self.min.assign(tf.minimum(self.min, tf.reduce_min(values)))
+        self.max.assign(tf.maximum(self.max, tf.reduce_max(values)))
+
+        # logarithmic key of each value: ceil(log_gamma(|x|))
+        abs_values = tf.abs(values)
+        keys = tf.math.ceil(tf.math.log(tf.maximum(abs_values, self.min_value)) / self.log_gamma)
+        keys = tf.cast(tf.clip_by_value(keys, -self.half_range, self.half_range), tf.int64)
+
+        # negative values are placed in reversed order, so that the bucket index grows with the value
+        negative_idx = self.half_range - keys
+        positive_idx = self.num_keys + 1 + self.half_range + keys
+        idx = tf.where(abs_values < self.min_value, tf.cast(self.num_keys, tf.int64),
+                       tf.where(values < 0, negative_idx, positive_idx))
+
+        self.buckets.assign_add(tf.math.unsorted_segment_sum(tf.ones_like(idx), idx, 2 * self.num_keys + 1))
+
+    def __bucket_value(self, idx):
+        """
+        Parameters
+        ----------
+        idx:    int
+            Index of the bucket
+        """
+
+        if idx == self.num_keys:
+            return 0.0
+        if idx < self.num_keys:
+            return -2 * self.gamma ** (self.half_range - idx) / (self.gamma + 1)
+        return 2 * self.gamma ** (idx - self.num_keys - 1 - self.half_range) / (self.gamma + 1)
+
+    def result(self, quantiles=None):
+        """
+        Parameters
+        ----------
+        quantiles:    [array]
+            Quantiles (between 0 and 1) to be estimated
+        """
+
+        count = int(self.count.numpy())
+        if count == 0:
+            return {'count': 0}
+
+        mean = self.total.numpy() / count
+        variance = max(self.total_squares.numpy() / count - mean ** 2, 0.)
+        result = {'mean': float(mean), 'std': float(math.sqrt(variance)), 'min': float(self.min.numpy()),
+                  'max': float(self.max.numpy()), 'count': count}
+
+        if quantiles is not None:
+            cumulative = np.cumsum(self.buckets.numpy())
+            result['quantiles'] = {}
+            for q in quantiles:
+                rank = q * (count - 1)
+                idx = int(np.searchsorted(cumulative, rank, side='right'))
+                # the sketch estimate is clipped to the exact range of the values seen
+                value = min(max(self.__bucket_value(idx), result['min']), result['max'])
+                result['quantiles'][str(q)] = value
+
+        return result
@@ -151,9 +151,45 @@ class Recurrent_Update_Cell(Custom_layer):
             Number of source nodes for each destination
         """
 
-        rnn = tf.keras.layers.RNN(model, name=str(dst_name) + '_update')
-        final_len.set_shape([None])
-        new_state = rnn(inputs=src_input, initial_state=old_state, mask=tf.sequence_mask(final_len))
+        # the cell is applied directly (instead of through a padded and masked tf.keras.layers.RNN), so it must be
+        # built before entering the loop
+        if not model.built:
+            model.build(tf.TensorShape([None, src_input.shape[-1]]))
+
+        # sort the destinations by decreasing number of inputs, so that the ones that still have an input at step t
+        # are always the first ones. Thus, each step only processes its active destinations (sum of the lengths in
+        # total), and the destinations that receive their last input are written out of the loop state
+        final_len = tf.cast(tf.reshape(final_len, [-1]), tf.int32)
+        order = tf.argsort(final_len, direction='DESCENDING', stable=True)
+        sorted_len = tf.gather(final_len, order)
+        # max_len x num_dst x dim, unstacked so that reading (and back-propagating) one step does not touch the rest
+        inputs = tf.transpose(tf.gather(src_input, order), [1, 0, 2])
+        inputs = tf.TensorArray(inputs.dtype, size=tf.shape(inputs)[0]).unstack(inputs)
+        max_len = tf.reduce_max(tf.concat([sorted_len, [0]], axis=0))
+        num_active = tf.reduce_sum(tf.cast(sorted_len > 0, tf.int32))
+        dim = tf.nest.flatten(model.state_size)[0]
+
+        def step(t, state, finished):
+            output, _ = model(inputs.read(t)[:tf.shape(state)[0]], [state])
+            num_next = tf.reduce_sum(tf.cast(sorted_len > t + 1, tf.int32))
+            # the destinations are finished in increasing length, so they are written from the end
+            finished = finished.write(max_len - 1 - t, output[num_next:])
+            return t + 1, output[:num_next], finished
+
+        finished = tf.TensorArray(old_state.dtype, size=max_len, infer_shape=False, element_shape=[None, dim])
+        _, _, finished = tf.while_loop(lambda t, *_: t < max_len, step,
+                                       [tf.constant(0), tf.ensure_shape(tf.gather(old_state, order[:num_active]),
+                                                                        [None, dim]), finished],
+                                       shape_invariants=[tf.TensorShape([]), tf.TensorShape([None, dim]),
+                                                         tf.TensorShape(None)],
+                                       name=str(dst_name) + '_update')
+
+        # as with a masked RNN, the output of the destinations without any input is zero
+        state = tf.concat([tf.reshape(finished.concat(), [-1, dim]),
+                           tf.zeros(tf.stack([tf.shape(order)[0] - num_active, dim]), dtype=old_state.dtype)], axis=0)
+
+        # restore the original order of the destinations
+        new_state = tf.gather(state, tf.math.invert_permutation(order))
         return new_state
 
 
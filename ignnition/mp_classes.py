@@ -120,6 +120,8 @@ class Message_Passing:
         Array of aggregation operations that define the aggregation function
     update:     object
         Object with the update model to be used
+    gathers_edge_destinations:     bool
+        Indicates if the aggregation needs the destination hs of each edge (set by the dependency analysis of Yaml_preprocessing)
 
     Methods:
     --------
@@ -146,6 +148,7 @@ class Message_Passing:
 
         self.aggregations, self.aggregations_global_type = self.create_aggregations(m.get('aggregation'))
         self.update = self.create_update(m.get('update', {'type': 'direct_assignment'}))
+        self.gathers_edge_destinations = True
 
     def create_update(self, u):
         """
@@ -239,6 +242,10 @@ class Mp_source_entity:
         Name of the source entity
     message_formation:      str
         Array of Operation instances
+    gathers_source:      bool
+        Indicates if the message creation needs the source hs of each edge (set by the dependency analysis of Yaml_preprocessing)
+    gathers_destination:      bool
+        Indicates if the message creation needs the destination hs of each edge (set by the dependency analysis of Yaml_preprocessing)
 
     Methods:
     --------
@@ -259,6 +266,8 @@ class Mp_source_entity:
 
         self.name = attr.get('name')
         self.message_formation = self.create_message_formation(attr.get('message')) if 'message' in attr else [None]
+        self.gathers_source = True
+        self.gathers_destination = True
 
     def create_message_formation(self, operations):
         """
@@ -0,0 +1,395 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import tensorflow as tf
+from ignnition.utils import *
+
+
+class Normalization:
+    """
+    A class that represents the declarative normalization of one feature (or of the output label), as defined in the normalization section of the train_options.yaml file.
+    All the subclasses are implemented with pure tensorflow operations, so that they can run inside the map of the input pipeline without going back to the Python interpreter.
+
+    Attributes
+    ----------
+    name:    str
+        Name of the feature (or label) to be normalized
+    type:    str
+        Type of normalization
+
+    Methods:
+    ----------
+    normalize(self, x)
+        Returns the normalized tensor
+    denormalize(self, x)
+        Returns the tensor in its original scale (inverse of normalize)
+    """
+
+    def __init__(self, name, attr, statistics=None):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the feature (or label) to be normalized
+        attr:    dict
+            Data corresponding to the normalization definition
+        statistics:    dict
+            Precomputed statistics of this feature (if any), used for the parameters that are not defined explicitly
+        """
+        self.name = name
+        self.type = attr.get('type')
+        self.statistics = statistics
+
+    def get_parameter(self, attr, param):
+        """
+        Parameters
+        ----------
+        attr:    dict
+            Data corresponding to the normalization definition
+        param:    str
+            Name of the parameter to read
+        """
+
+        if param in attr:
+            return float(attr.get(param))
+        if self.statistics is not None and param in self.statistics:
+            return float(self.statistics[param])
+
+        print_failure('The normalization of type "' + str(self.type) + '" of "' + self.name +
+                      '" requires the parameter "' + param + '" in the train_options.yaml file.')
+
+
+class Mean_std_normalization(Normalization):
+    """
+    A subclass that represents the normalization (x - mean) / std
+    """
+
+    def __init__(self, name, attr, statistics=None):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the feature (or label) to be normalized
+        attr:    dict
+            Data corresponding to the normalization definition
+        statistics:    dict
+            Precomputed statistics of this feature (if any)
+        """
+        super(Mean_std_normalization, self).__init__(name, attr, statistics)
+        self.mean = self.get_parameter(attr, 'mean')
+        self.std = self.get_parameter(attr, 'std')
+        if self.std == 0:
+            print_failure('The std used to normalize "' + name + '" cannot be 0.')
+
+    def normalize(self, x):
+        return (x - self.mean) / self.std
+
+    def denormalize(self, x):
+        return x * self.std + self.mean
+
+
+class Min_max_normalization(Normalization):
+    """
+    A subclass that represents the normalization (x - min) / (max - min)
+    """
+
+    def __init__(self, name, attr, statistics=None):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the feature (or label) to be normalized
+        attr:    dict
+            Data corresponding to the normalization definition
+        statistics:    dict
+            Precomputed statistics of this feature (if any)
+        """
+        super(Min_max_normalization, self).__init__(name, attr, statistics)
+        self.min = self.get_parameter(attr, 'min')
+        self.max = self.get_parameter(attr, 'max')
+        if self.max == self.min:
+            print_failure('The min and max used to normalize "' + name + '" cannot be equal.')
+
+    def normalize(self, x):
+        return (x - self.min) / (self.max - self.min)
+
+    def denormalize(self, x):
+        return x * (self.max - self.min) + self.min
+
+
+class Log_normalization(Normalization):
+    """
+    A subclass that represents the normalization log(x)
+    """
+
+    def __init__(self, name, attr, statistics=None):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the feature (or label) to be normalized
+        attr:    dict
+            Data corresponding to the normalization definition
+        statistics:    dict
+            Precomputed statistics of this feature (if any)
+        """
+        super(Log_normalization, self).__init__(name, attr, statistics)
+
+    def normalize(self, x):
+        return tf.math.log(x)
+
+    def denormalize(self, x):
+        return tf.math.exp(x)
+
+
+class Log1p_normalization(Normalization):
+    """
+    A subclass that represents the normalization log(1 + x)
+    """
+
+    def __init__(self, name, attr, statistics=None):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the feature (or label) to be normalized
+        attr:    dict
+            Data corresponding to the normalization definition
+        statistics:    dict
+            Precomputed statistics of this feature (if any)
+        """
+        super(Log1p_normalization, self).__init__(name, attr, statistics)
+
+    def normalize(self, x):
+        return tf.math.log1p(x)
+
+    def denormalize(self, x):
+        return tf.math.expm1(x)
+
+
+def create_normalizations(definition, statistics=None):
+    """
+    Creates the normalization objects from the normalization section of the train_options.yaml file
+
+    Parameters
+    ----------
+    definition:    dict
+        Dictionary mapping each feature (or label) name to its normalization definition
+    statistics:    dict
+        Precomputed statistics of each feature (if any), used for the parameters that are not defined explicitly
+    """
+
+    normalizations = {}
+    for name, attr in definition.items():
+        type = attr.get('type') if isinstance(attr, dict) else None
+        feature_statistics = statistics.get(name, None) if statistics is not None else None
+        if type == 'mean_std':
+            normalizations[name] = Mean_std_normalization(name, attr, feature_statistics)
+        elif type == 'min_max':
+            normalizations[name] = Min_max_normalization(name, attr, feature_statistics)
+        elif type == 'log':
+            normalizations[name] = Log_normalization(name, attr, feature_statistics)
+        elif type == 'log1p':
+            normalizations[name] = Log1p_normalization(name, attr, feature_statistics)
+        else:
+            print_failure('The normalization type "' + str(type) + '" of "' + str(name) +
+                          '" is not valid. Please use one of: mean_std, min_max, log, log1p.')
+    return normalizations
+
+
+def requires_statistics(definition):
+    """
+    Returns True if any normalization of the normalization section leaves a parameter undefined (and thus needs the precomputed statistics)
+
+    Parameters
+    ----------
+    definition:    dict
+        Dictionary mapping each feature (or label) name to its normalization definition
+    """
+
+    required_parameters = {'mean_std': ['mean', 'std'], 'min_max': ['min', 'max']}
+    for attr in definition.values():
+        if isinstance(attr, dict):
+            for param in required_parameters.get(attr.get('type'), []):
+                if param not in attr:
+                    return True
+    return False
+
+
+class Running_statistics:
+    """
+    This class accumulates the statistics of a stream of values in one single pass. The moments are computed with the online (Welford) algorithm, using the parallel update of Chan et al. so that the statistics of different shards can be merged.
+    The quantiles are estimated from a bounded reservoir sample of the stream.
+
+    Attributes
+    ----------
+    count:    int
+        Number of values seen
+    mean:    float
+        Running mean
+    m2:    float
+        Running sum of the squared differences to the mean
+    min:    float
+        Minimum value seen
+    max:    float
+        Maximum value seen
+    reservoir:    array
+        Uniform sample of the values seen (of at most reservoir_size elements)
+    reservoir_size:    int
+        Maximum number of values kept to estimate the quantiles
+
+    Methods:
+    ----------
+    update(self, values)
+        Adds a new batch of values to the statistics
+    merge(self, other)
+        Merges the statistics of another Running_statistics object (e.g., computed over a different shard)
+    get_statistics(self, quantiles=None)
+        Returns a dictionary with the mean, std, min, max, count and quantiles of the values seen
+    """
+
+    def __init__(self, reservoir_size=4096, seed=None):
+        """
+        Parameters
+        ----------
+        reservoir_size:    int
+            Maximum number of values kept to estimate the quantiles
+        seed:    int
+            Seed of the random generator used for the reservoir sampling
+        """
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.reservoir = np.empty(0, dtype=np.float64)
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.RandomState(seed)
+
+    def update(self, values):
+        """
+        Parameters
+        ----------
+        values:    array
+            New values (of any shape) to be added to the statistics
+        """
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+
+        batch = Running_statistics(self.reservoir_size)
+        batch.count = values.size
+        batch.mean = values.mean()
+        batch.m2 = np.square(values - batch.mean).sum()
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        if values.size > self.reservoir_size:
+            values = self.rng.choice(values, self.reservoir_size, replace=False)
+        batch.reservoir = values
+        self.merge(batch)
+
+    def merge(self, other):
+        """
+        Parameters
+        ----------
+        other:    Running_statistics
+            Statistics to be merged into this object
+        """
+
+        # the empty accumulators (e.g., of an empty shard) are skipped, so that their infinite min and max are not kept
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max, self.reservoir = other.min, other.max, other.reservoir
+            return
+
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / n
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        # each element of a reservoir represents count / len(reservoir) values of its stream
+        reservoir = np.concatenate([self.reservoir, other.reservoir])
+        if reservoir.size > self.reservoir_size:
+            weights = np.concatenate([np.full(self.reservoir.size, self.count / max(self.reservoir.size, 1)),
+                                      np.full(other.reservoir.size, other.count / other.reservoir.size)])
+            reservoir = self.rng.choice(reservoir, self.reservoir_size, replace=False, p=weights / weights.sum())
+        self.reservoir = reservoir
+        self.count = n
+
+    def get_statistics(self, quantiles=None):
+        """
+        Parameters
+        ----------
+        quantiles:    [array]
+            Quantiles (between 0 and 1) to be estimated
+        """
+
+        std = float(np.sqrt(self.m2 / self.count)) if self.count > 0 else 0.0
+        result = {'mean': float(self.mean), 'std': std, 'min': self.min, 'max': self.max, 'count': self.count}
+        if quantiles is not None and self.reservoir.size > 0:
+            values = np.quantile(self.reservoir, quantiles)
+            result['quantiles'] = {str(q): float(v) for q, v in zip(quantiles, values)}
+        return result
+
+
+def compute_shard_statistics(path, shard_index, num_shards, entity_names, feature_names, output_name,
+                             interleave_names, additional_input):
+    """
+    Computes the statistics of every feature and of the output label over one shard of the dataset. This is a module-level function so that it can be executed in a separate process.
+
+    Parameters
+    ----------
+    path:    str
+        Path of the dataset
+    shard_index:    int
+        Index of the shard to be processed
+    num_shards:    int
+        Total number of shards in which the files of the dataset are split
+    entity_names: [array]
+        Name of the entities to be found in the dataset
+    feature_names:    [array]
+        Name of the features to be found in the dataset
+    output_name:    str
+        Name of the output data to be found in the dataset
+    interleave_names:    [array]
+        First parameter is the name of the interleave, and the second the destination entity
+    additional_input:    [array]
+        Name of other vectors that need to be retrieved because they appear in other parts of the model definition
+    """
+
+    from ignnition.data_generator import Generator
+
+    generator = Generator()
+    data_generator = generator.generate_from_dataset(path, entity_names, feature_names, output_name,
+                                                     interleave_names, additional_input, True, False,
+                                                     num_shards=num_shards, shard_index=shard_index)
+
+    statistics = {name: Running_statistics(seed=shard_index) for name in feature_names + [output_name]}
+    for data, label in data_generator:
+        for f_name in feature_names:
+            statistics[f_name].update(data[f_name])
+        statistics[output_name].update(label)
+    return statistics
@@ -0,0 +1,445 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+"""
+Offline partitioner of single huge graphs.
+
+Each sample (networkx node-link dictionary) is split into K partitions with balanced numbers of nodes and edges and a
+small cut. The nodes of each partition are its interior nodes, and every partition also carries the halo nodes at
+1..L hops (following the incoming edges, i.e., the nodes whose messages reach the interior nodes within L
+message-passing steps).
+Each partition is an ordinary sample, whose nodes keep their attributes and are annotated with:
+    - halo_hops: 0 for the interior nodes, and the number of hops to the interior for the halo nodes,
+    - global_id: index of the node within its entity in the original graph (as numbered by the Generator), offset by
+      the nodes of the entity in the previous samples of the dataset, so that the ids of different samples are disjoint
+      (they key the historical embeddings).
+With mask_halo_nodes enabled in the train_options.yaml file, only the interior nodes contribute to the loss.
+
+The same partitions serve the incremental inference (Ignnition_model.predict_incremental): the nodes affected by a
+modification of a sample are the interior nodes, and the states of their halo nodes are read from a cache.
+
+Usage:
+    python -m ignnition.partitioning data/train/data.json data/partitions --num_partitions 8 --num_hops 8
+"""
+
+import argparse
+import collections
+import json
+import os
+
+import numpy as np
+from networkx.readwrite import json_graph
+
+# node attributes added to the partitions
+HALO_ATTRIBUTE = 'halo_hops'
+GLOBAL_ID_ATTRIBUTE = 'global_id'
+
+
+def partition_graph(G, num_partitions, imbalance=1.05, refinement_rounds=20, seed=0):
+    """
+    Returns the partition of each node of the graph (in the order of G.nodes). The nodes are first split into
+    contiguous blocks of a breadth-first order (with balanced nodes and edges), which are then refined by label
+    propagation: the nodes with more neighbors in another partition move to it, as long as the partition does not
+    exceed imbalance times the mean weight (where the weight of the nodes accounts for both their number and their
+    edges).
+
+    Parameters
+    ----------
+    G:    networkx.Graph
+        Graph to be partitioned (the direction of the edges is ignored)
+    num_partitions:    int
+        Number of partitions
+    imbalance:    float
+        Maximum ratio between the weight of a partition and the mean of all the partitions
+    refinement_rounds:    int
+        Maximum number of rounds of label propagation
+    seed:    int
+        Seed of the random number generator
+    """
+
+    rng = np.random.default_rng(seed)
+    index = {node: i for i, node in enumerate(G.nodes())}
+    num_nodes = len(index)
+    edges = np.array([(index[u], index[v]) for u, v in G.edges()], dtype=np.int64).reshape(-1, 2)
+
+    # undirected adjacency, sorted by node
+    u = np.concatenate([edges[:, 0], edges[:, 1]])
+    v = np.concatenate([edges[:, 1], edges[:, 0]])
+    order = np.argsort(u, kind='stable')
+    u, v = u[order], v[order]
+    degrees = np.bincount(u, minlength=num_nodes)
+    ptr = np.concatenate([[0], np.cumsum(degrees)])
+
+    # weight of each node: the mean of its fraction of the nodes and its fraction of the (undirected) edges, so that
+    # the partitions balance the memory of both the states of the nodes and the messages of the edges
+    weights = 0.5 / num_nodes + 0.5 * degrees / max(degrees.sum(), 1)
+    max_weight = imbalance / num_partitions
+
+    # initial partition: contiguous blocks of a breadth-first order with the same weight
+    bfs_order = _breadth_first_order(ptr, v, num_nodes, rng)
+    cumulative = np.cumsum(weights[bfs_order]) - weights[bfs_order] / 2
+    partition = np.empty(num_nodes, dtype=np.int64)
+    partition[bfs_order] = np.minimum((cumulative * num_partitions).astype(np.int64), num_partitions - 1)
+
+    for _ in range(refinement_rounds):
+        # number of neighbors of each node in each partition
+        keys, counts = np.unique(u * num_partitions + partition[v], return_counts=True)
+        nodes, parts = keys // num_partitions, keys % num_partitions
+        own = np.zeros(num_nodes, dtype=np.int64)
+        is_own = parts == partition[nodes]
+        own[nodes[is_own]] = counts[is_own]
+
+        # best partition of each node (the one with the most neighbors)
+        best_order = np.lexsort((counts, nodes))
+        last = np.concatenate([nodes[best_order][1:] != nodes[best_order][:-1], [True]])
+        best = best_order[last]
+        candidates, targets = nodes[best], parts[best]
+        gains = counts[best] - own[candidates]
+
+        # only half of the nodes (at random) may move in each round, to avoid the oscillation of neighbors
+        movable = (gains > 0) & (targets != partition[candidates]) & (rng.random(len(candidates)) < 0.5)
+        candidates, targets, gains = candidates[movable], targets[movable], gains[movable]
+        if len(candidates) == 0:
+            break
+
+        # the moves with more gain are accepted first, as long as the target partition keeps the balance
+        move_order = np.lexsort((-gains, targets))
+        candidates, targets = candidates[move_order], targets[move_order]
+        group_start = np.searchsorted(targets, targets)
+        load = np.bincount(partition, weights=weights, minlength=num_partitions)
+        cumulative = np.cumsum(weights[candidates])
+        cumulative = cumulative - cumulative[group_start] + weights[candidates][group_start]
+        accepted = load[targets] + cumulative <= max_weight
+        if not accepted.any():
+            break
+        partition[candidates[accepted]] = targets[accepted]
+
+    return partition
+
+
+def _breadth_first_order(ptr, neighbors, num_nodes, rng):
+    """
+    Returns the nodes in breadth-first order (starting each connected component from a random node).
+
+    Parameters
+    ----------
+    ptr:    array
+        Start of the neighbors of each node
+    neighbors:    array
+        Neighbors of all the nodes, sorted by node
+    num_nodes:    int
+        Number of nodes
+    rng:    np.random.Generator
+        Random number generator
+    """
+
+    visited = np.zeros(num_nodes, dtype=bool)
+    order = []
+    for start in rng.permutation(num_nodes):
+        if visited[start]:
+            continue
+        visited[start] = True
+        frontier = np.array([start])
+        while len(frontier) > 0:
+            order.append(frontier)
+            degrees = ptr[frontier + 1] - ptr[frontier]
+            positions = np.repeat(ptr[frontier] - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+            next_nodes = np.unique(neighbors[positions])
+            frontier = next_nodes[~visited[next_nodes]]
+            visited[frontier] = True
+    return np.concatenate(order) if order else np.zeros(0, dtype=np.int64)
+
+
+def partition_sample(sample, num_partitions, num_hops, imbalance=1.05, refinement_rounds=20, seed=0, global_ids=None):
+    """
+    Returns the partitions (node-link dictionaries) of the sample, each one with its interior nodes and its halo nodes.
+
+    Parameters
+    ----------
+    sample:    dict
+        Sample (networkx node-link dictionary) to be partitioned
+    num_partitions:    int
+        Number of partitions
+    num_hops:    int
+        Number of hops of the halo nodes (e.g., the num_iterations of the message passing, times its number of stages
+        for the receptive field of the interior nodes to be complete)
+    imbalance:    float
+        Maximum ratio between the weight of a partition and the mean of all the partitions
+    refinement_rounds:    int
+        Maximum number of rounds of label propagation
+    seed:    int
+        Seed of the random number generator
+    global_ids:    [int]
+        Global id of each node (by default, its index within its entity)
+    """
+
+    G = json_graph.node_link_graph(sample)
+    index = {node: i for i, node in enumerate(G.nodes())}
+    partition = partition_graph(G, num_partitions, imbalance, refinement_rounds, seed)
+    partition = partition[[index[node['id']] for node in sample['nodes']]]
+
+    edges = _get_edges(sample)
+    if global_ids is None:
+        global_ids = _get_global_ids(sample)
+    return [_build_partition(sample, partition == p, num_hops, edges, global_ids) for p in range(num_partitions)]
+
+
+def build_partition(sample, interior, num_hops, global_ids=None):
+    """
+    Returns the partition (node-link dictionary) of the sample with the given interior nodes, and the halo nodes at
+    1..num_hops hops of them.
+
+    Parameters
+    ----------
+    sample:    dict
+        Sample (networkx node-link dictionary)
+    interior:    array
+        Mask of the interior nodes (in the order of the nodes of the sample)
+    num_hops:    int
+        Number of hops of the halo nodes
+    global_ids:    [int]
+        Global id of each node (by default, its index within its entity)
+    """
+
+    if global_ids is None:
+        global_ids = _get_global_ids(sample)
+    return _build_partition(sample, np.asarray(interior, dtype=bool), num_hops, _get_edges(sample), global_ids)
+
+
+def _build_partition(sample, interior, num_hops, edges, global_ids):
+    """
+    Parameters
+    ----------
+    sample:    dict
+        Sample (networkx node-link dictionary)
+    interior:    array
+        Mask of the interior nodes
+    num_hops:    int
+        Number of hops of the halo nodes
+    edges:    tuple
+        Positions of the sources and destinations of the links, and of the directed edges (see _get_edges)
+    global_ids:    [int]
+        Global id of each node
+    """
+
+    src, dst, directed_src, directed_dst = edges
+    hops = np.where(interior, 0, -1)
+    for hop in range(1, num_hops + 1):
+        # sources of the edges whose destination is already in the partition
+        reached = directed_src[(hops[directed_dst] >= 0) & (hops[directed_src] < 0)]
+        if len(reached) == 0:
+            break
+        hops[reached] = hop
+
+    # the nodes and edges keep their original order, so that the Generator assigns the same sequence numbers to the
+    # messages of each destination
+    nodes = [dict(node, **{HALO_ATTRIBUTE: int(hops[i]), GLOBAL_ID_ATTRIBUTE: int(global_ids[i])})
+             for i, node in enumerate(sample['nodes']) if hops[i] >= 0]
+    kept = (hops[src] >= 0) & (hops[dst] >= 0)
+    links = [link for link, keep in zip(sample['links'], kept) if keep]
+    return dict(sample, nodes=nodes, links=links)
+
+
+def _get_edges(sample):
+    """
+    Returns the positions (in the list of nodes) of the sources and destinations of the links, and of the directed
+    edges along which the messages are sent (both directions of the links of an undirected graph).
+
+    Parameters
+    ----------
+    sample:    dict
+        Sample (networkx node-link dictionary)
+    """
+
+    position = {node['id']: i for i, node in enumerate(sample['nodes'])}
+    src = np.array([position[link['source']] for link in sample['links']], dtype=np.int64)
+    dst = np.array([position[link['target']] for link in sample['links']], dtype=np.int64)
+    if sample.get('directed', False):
+        return src, dst, src, dst
+    return src, dst, np.concatenate([src, dst]), np.concatenate([dst, src])
+
+
+def _get_global_ids(sample):
+    """
+    Returns the index of each node within its entity (the numbering of the Generator).
+
+    Parameters
+    ----------
+    sample:    dict
+        Sample (networkx node-link dictionary)
+    """
+
+    entity_counter = {}
+    global_ids = []
+    for node in sample['nodes']:
+        entity = node.get('entity')
+        global_ids.append(entity_counter.get(entity, 0))
+        entity_counter[entity] = global_ids[-1] + 1
+    return global_ids
+
+
+def get_changed_nodes(base_sample, sample):
+    """
+    Returns the mask (in the order of the nodes of the sample) of the nodes whose initial state or messages may differ
+    from the ones of the base sample: the new nodes, the nodes with different attributes, and the nodes whose incoming
+    edges differ (in their sources, their order or their attributes), which includes the destinations of the added or
+    removed edges and the neighbors of the removed nodes.
+
+    Parameters
+    ----------
+    base_sample:    dict
+        Base sample (networkx node-link dictionary)
+    sample:    dict
+        Modified sample (networkx node-link dictionary)
+    """
+
+    base_nodes = {node['id']: node for node in base_sample['nodes']}
+    base_incoming = _get_incoming_edges(base_sample)
+    incoming = _get_incoming_edges(sample)
+    return np.array([node['id'] not in base_nodes or node != base_nodes[node['id']] or
+                     incoming.get(node['id'], []) != base_incoming.get(node['id'], []) for node in sample['nodes']],
+                    dtype=bool)
+
+
+def _get_incoming_edges(sample):
+    """
+    Returns the incoming edges (source and attributes) of each node, in the order in which the Generator numbers their
+    messages (by the position of the source node, and then by the order of the links).
+
+    Parameters
+    ----------
+    sample:    dict
+        Sample (networkx node-link dictionary)
+    """
+
+    position = {node['id']: i for i, node in enumerate(sample['nodes'])}
+    edges = [(link['source'], link['target'], link) for link in sample['links']]
+    if not sample.get('directed', False):
+        edges += [(link['target'], link['source'], link) for link in sample['links']]
+
+    incoming = {}
+    for k, (source, target, link) in enumerate(edges):
+        attributes = {key: value for key, value in link.items() if key not in ('source', 'target')}
+        incoming.setdefault(target, []).append((position.get(source, -1), k, source, attributes))
+    return {target: [(source, attributes) for _, _, source, attributes in sorted(edges, key=lambda e: e[:2])]
+            for target, edges in incoming.items()}
+
+
+def get_affected_nodes(sample, changed, stages, num_iterations):
+    """
+    Returns the mask of the nodes whose hidden state may differ from the one of the base sample after some stage of
+    the message passing: the changed nodes, and the nodes that receive (directly or indirectly) a message from them
+    within the stages of num_iterations iterations.
+
+    Parameters
+    ----------
+    sample:    dict
+        Modified sample (networkx node-link dictionary)
+    changed:    array
+        Mask of the changed nodes (see get_changed_nodes)
+    stages:    [array]
+        Message passings of each stage, as pairs (destination entity, [source entities])
+    num_iterations:    int
+        Number of message-passing iterations
+    """
+
+    _, _, src, dst = _get_edges(sample)
+    entities = np.array([node.get('entity') for node in sample['nodes']], dtype=object)
+    affected = np.array(changed, dtype=bool)
+    for _ in range(num_iterations):
+        for stage in stages:
+            for dst_entity, src_entities in stage:
+                reached = affected[src] & np.isin(entities[src], src_entities) & (entities[dst] == dst_entity)
+                affected[dst[reached]] = True
+    return affected
+
+
+def partition_dataset(input_file, output_dir, num_partitions, num_hops, imbalance=1.05, refinement_rounds=20, seed=0):
+    """
+    Partitions every sample of the json file, and writes the k-th partition of all of them in the file
+    partition_k.json of the output directory (so that the files can be split among the workers).
+
+    Parameters
+    ----------
+    input_file:    str
+        Path of the json file with the samples
+    output_dir:    str
+        Path of the directory where the partitions are written
+    num_partitions:    int
+        Number of partitions
+    num_hops:    int
+        Number of hops of the halo nodes
+    imbalance:    float
+        Maximum ratio between the weight of a partition and the mean of all the partitions
+    refinement_rounds:    int
+        Maximum number of rounds of label propagation
+    seed:    int
+        Seed of the random number generator
+    """
+
+    # each sample is a single huge graph, so the samples are partitioned one at a time
+    with open(input_file, 'r') as f:
+        samples = json.load(f)
+
+    # the historical embeddings are keyed by the global ids, so that the ids of each sample are offset by the number
+    # of nodes of each entity in the previous samples (otherwise, the partitions of different samples would overwrite
+    # the states of each other)
+    partitions = [[] for _ in range(num_partitions)]
+    offsets = {}
+    for sample in samples:
+        entities = [node.get('entity') for node in sample['nodes']]
+        global_ids = [offsets.get(entity, 0) + i for entity, i in zip(entities, _get_global_ids(sample))]
+        for entity, count in collections.Counter(entities).items():
+            offsets[entity] = offsets.get(entity, 0) + count
+        for k, p in enumerate(partition_sample(sample, num_partitions, num_hops, imbalance, refinement_rounds, seed,
+                                               global_ids)):
+            partitions[k].append(p)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for k, samples in enumerate(partitions):
+        with open(os.path.join(output_dir, 'partition_' + str(k) + '.json'), 'w') as f:
+            json.dump(samples, f)
+
+    # summary of the partitions of the first sample
+    return [{'interior_nodes': sum(1 for n in p['nodes'] if n[HALO_ATTRIBUTE] == 0),
+             'nodes': len(p['nodes']),
+             'edges': len(p['links'])} for p in (samples[0] for samples in partitions if samples)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Partitions the graphs of a dataset, adding the halo nodes.')
+    parser.add_argument('input_file', help='Path of the json file with the samples')
+    parser.add_argument('output_dir', help='Path of the directory where the partitions are written')
+    parser.add_argument('--num_partitions', type=int, required=True, help='Number of partitions')
+    parser.add_argument('--num_hops', type=int, required=True, help='Number of hops of the halo nodes')
+    parser.add_argument('--imbalance', type=float, default=1.05,
+                        help='Maximum ratio between the size of a partition and the mean size')
+    parser.add_argument('--refinement_rounds', type=int, default=20, help='Maximum number of rounds of refinement')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random number generator')
+    args = parser.parse_args()
+
+    summary = partition_dataset(args.input_file, args.output_dir, args.num_partitions, args.num_hops, args.imbalance,
+                                args.refinement_rounds, args.seed)
+    for k, p in enumerate(summary):
+        print('partition {}:  interior nodes: {interior_nodes}  nodes: {nodes}  edges: {edges}'.format(k, **p))
+
+
+if __name__ == '__main__':
+    main()
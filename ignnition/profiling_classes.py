@@ -0,0 +1,138 @@
+'''
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+'''
+
+# -*- coding: utf-8 -*-
+
+import time
+import contextlib
+import tensorflow as tf
+
+
+class Phase_timer:
+    """
+    Class that accumulates the wall time and the tensor sizes (e.g., number of nodes, edges or bytes of the messages) of each phase of an execution.
+    The time of a phase is only meaningful when the operations are executed eagerly, since within a tf.function the Python code only runs while tracing. When the timer is disabled, the phases do nothing.
+
+    Attributes
+    ----------
+    enabled:    bool
+        Indicates if the phases are being measured
+    times:    dict
+        Dictionary mapping the name of each phase to its accumulated time (in seconds) and number of calls
+    sizes:    dict
+        Dictionary mapping the name of each phase to the accumulated value of each of its sizes
+
+    Methods:
+    ----------
+    phase(self, name)
+        Context manager that measures the wall time of the phase
+    record_sizes(self, name, **sizes)
+        Accumulates the sizes (tensors or numbers) of the phase
+    reset(self)
+        Discards all the measurements (e.g., those of a warm-up step)
+    report(self)
+        Returns a dictionary with the mean time and sizes per call of each phase
+    write_summaries(self, log_dir, step=0)
+        Writes the mean time of each phase as tensorboard scalars
+    """
+
+    def __init__(self, enabled=True):
+        """
+        Parameters
+        ----------
+        enabled:    bool
+            Indicates if the phases are being measured
+        """
+
+        self.enabled = enabled
+        self.times = {}
+        self.sizes = {}
+
+    @tf.autograph.experimental.do_not_convert
+    def phase(self, name):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the phase (using / to denote its sub-phases)
+        """
+
+        if not self.enabled or not tf.executing_eagerly():
+            return contextlib.nullcontext()
+        return self.__measure(name)
+
+    @contextlib.contextmanager
+    def __measure(self, name):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the phase
+        """
+
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        total, calls = self.times.get(name, (0.0, 0))
+        self.times[name] = (total + elapsed, calls + 1)
+
+    @tf.autograph.experimental.do_not_convert
+    def record_sizes(self, name, **sizes):
+        """
+        Parameters
+        ----------
+        name:    str
+            Name of the phase
+        sizes:    dict
+            Sizes (tensors or numbers) to be accumulated in this phase
+        """
+
+        if not self.enabled or not tf.executing_eagerly():
+            return
+
+        phase_sizes = self.sizes.setdefault(name, {})
+        for size_name, value in sizes.items():
+            phase_sizes[size_name] = phase_sizes.get(size_name, 0) + int(value)
+
+    def reset(self):
+        self.times = {}
+        self.sizes = {}
+
+    def report(self):
+        result = {}
+        for name, (total, calls) in sorted(self.times.items()):
+            result[name] = {'calls': calls, 'total_ms': 1000 * total, 'mean_ms': 1000 * total / calls}
+            for size_name, value in self.sizes.get(name, {}).items():
+                result[name]['mean_' + size_name] = value / calls
+        return result
+
+    def write_summaries(self, log_dir, step=0):
+        """
+        Parameters
+        ----------
+        log_dir:    str
+            Directory of the tensorboard logs
+        step:    int
+            Step associated to the scalars
+        """
+
+        writer = tf.summary.create_file_writer(log_dir)
+        with writer.as_default():
+            for name, phase in self.report().items():
+                tf.summary.scalar('profiling/' + name + '/mean_ms', phase['mean_ms'], step=step)
+        writer.flush()
@@ -165,3 +165,29 @@ def get_global_var_or_input(calculations, var_name, f_):
         return get_global_variable(calculations, var_name)
     except:
         return f_[var_name]
+
+
+def traceable(func):
+    """
+    Decorator that marks a custom function of the additional_functions_file (e.g., a loss or a metric) as traceable, i.e., written only with tensorflow operations.
+    These functions are executed inside the compiled graph of the model instead of going through tf.py_function.
+
+    Parameters
+    ----------
+    func:    function
+        Custom function to be marked
+    """
+    func._ignnition_traceable = True
+    return func
+
+
+def is_traceable(func):
+    """
+    Returns True if the custom function was marked with the traceable decorator (or is already a tf.function)
+
+    Parameters
+    ----------
+    func:    function
+        Custom function to be checked
+    """
+    return getattr(func, '_ignnition_traceable', False) or hasattr(func, 'get_concrete_function')
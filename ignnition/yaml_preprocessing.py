@@ -44,6 +44,8 @@ class Yaml_preprocessing:
         Contains the different MP object
     readout_op:    dict
         Information of the different combined message passings
+    gather_after_transform:    bool
+        Indicates if the neural networks whose first layer is dense transform the hs of the nodes before gathering them for every edge
 
     Methods:
     ----------
@@ -67,6 +69,10 @@ class Yaml_preprocessing:
         Adds the NN architecture corresponding to each of the NN references in the rest of the parts of the model description file (by name)
     __get_mp_instances(self, inst)
         Computes the MP objects corresponding to the different message passings
+    __analyze_gather_dependencies(self)
+        Determines which neural networks are factorized (gather after transform), and which of the per-edge gathers of the hidden states are still needed
+    set_gather_after_transform(self, enabled)
+        Enables or disables the factorization of the first dense layer of the neural networks over gathered hidden states
     __add_readout_architecture(self, output)
         Adds the NN corresponding to the readout (wherever specified, by its referenced name)
     __get_readout_op(self, output_operations)
@@ -128,6 +134,8 @@ class Yaml_preprocessing:
         self.iterations_mp = int(self.data['message_passing']['num_iterations'])
         self.mp_instances = self.__get_mp_instances(self.data['message_passing']['stages'])
         self.readout_op = self.__get_readout_op(self.data['readout'])
+        self.gather_after_transform = True
+        self.__analyze_gather_dependencies()
 
     # PRIVATE
     def __read_json(self, path):
@@ -352,6 +360,54 @@ class Yaml_preprocessing:
 
         return [['stage_' + str(step_number), [Message_Passing(self.__add_nn_architecture_mp(m)) for m in stage['stage_message_passings']]] for step_number, stage in enumerate(inst)]
 
+    def __analyze_gather_dependencies(self):
+        # each message passing gathers (for every edge) the hs of the source and destination nodes. They are only
+        # gathered if they are used by the message creation or by the aggregation. The neural networks whose first
+        # layer is dense, and whose input concatenates gathered hs, transform the hs before gathering them instead
+        # (see Feed_forward_operation.apply_nn_factorized), so they do not need the gathered hs
+        for stage_name, mps in self.mp_instances:
+            for mp in mps:
+                # the destination hs of each edge are gathered once and shared by all the aggregations that use them
+                mp.gathers_edge_destinations = False
+                for aggr in mp.aggregations:
+                    if aggr.type == 'edge_attention':
+                        aggr.aggr_model.factorized = self.gather_after_transform and \
+                                                     aggr.aggr_model.has_dense_input_layer()
+                        mp.gathers_edge_destinations |= not aggr.aggr_model.factorized
+
+                for src in mp.source_entities:
+                    inputs = set()
+                    for idx, op in enumerate(src.message_formation):
+                        # only the first operation takes the hs of the nodes (the next ones may take its output)
+                        if isinstance(op, Feed_forward_operation):
+                            op.factorized = idx == 0 and self.gather_after_transform and op.has_dense_input_layer() \
+                                            and ('source' in op.input or 'destination' in op.input)
+                        if op is not None and op.input is not None and not getattr(op, 'factorized', False):
+                            inputs.update(op.input)
+
+                    # the source hs are the message unless an operation overwrites it (direct_assignment is None)
+                    src.gathers_source = 'source' in inputs or all(op is None for op in src.message_formation)
+                    src.gathers_destination = 'destination' in inputs
+
+        # the outputs of the extend_adjacencies of the readout are the hs of the nodes gathered for every edge
+        extended = {}
+        for op in self.readout_op:
+            if isinstance(op, Extend_adjacencies):
+                extended[op.output_name[0]] = (op.input[0], 'src_' + op.adj_list)
+                extended[op.output_name[1]] = (op.input[1], 'dst_' + op.adj_list)
+
+        used = set()
+        for op in self.readout_op:
+            if isinstance(op, Feed_forward_operation):
+                op.node_inputs = {i: extended[i] for i in op.input if i in extended}
+                op.factorized = self.gather_after_transform and op.has_dense_input_layer() and len(op.node_inputs) > 0
+            if op.input is not None and not getattr(op, 'factorized', False):
+                used.update(op.input)
+
+        for op in self.readout_op:
+            if isinstance(op, Extend_adjacencies):
+                op.gathers = [name in used for name in op.output_name]
+
     def __add_readout_architecture(self, output):
         """
         Parameters
@@ -394,6 +450,17 @@ class Yaml_preprocessing:
 
     # ----------------------------------------------------------------
     # PUBLIC FUNCTIONS
+    def set_gather_after_transform(self, enabled):
+        """
+        Parameters
+        ----------
+        enabled:    bool
+            Indicates if the neural networks whose input concatenates gathered hs transform them before the gather
+        """
+
+        self.gather_after_transform = enabled
+        self.__analyze_gather_dependencies()
+
     def add_dimensions(self, dimensions):
         """
         Parameters
@@ -415,14 +482,14 @@ class Yaml_preprocessing:
         return self.input_dim
 
     def get_interleave_sources(self):
-        aux =  [[[src.name, mp.destination_entity] for src in mp.source_entities] for stage_name, mps in self.mp_instances for mp in mps if isinstance(mp.aggregations,Interleave_aggr)]
+        aux =  [[[src.name, mp.destination_entity] for src in mp.source_entities] for stage_name, mps in self.mp_instances for mp in mps if mp.aggregations and isinstance(mp.aggregations[0], Interleave_aggr)]
         return reduce(lambda accum, a: accum +a, aux, [])
 
     def get_mp_iterations(self):
         return self.iterations_mp
 
     def get_interleave_tensors(self):
-        return [[mp.aggregations.combination_definition, mp.destination_entity] for stage_name, mps in self.mp_instances for mp in mps if isinstance(mp.aggregations, Interleave_aggr)]
+        return [[mp.aggregations[0].combination_definition, mp.destination_entity] for stage_name, mps in self.mp_instances for mp in mps if mp.aggregations and isinstance(mp.aggregations[0], Interleave_aggr)]
 
     def get_mp_instances(self):
         return self.mp_instances